@@ -0,0 +1,600 @@
+## backends.py - Ways of running puppy commands on the PVR
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# A backend runs one of puppy's commands (size, dir, get, put, mkdir, rename,
+# delete) and returns a process object that looks like popen2.Popen4: its
+# output, in puppy's format, is read from fromchild, poll() returns -1 while
+# the command is running, wait() returns an os.wait() style status and
+# cancel() stops it. Puppy and the readers in puppy.py don't need to know
+# which backend they are using.
+#
+# SubprocessBackend runs the puppy program for each command. SessionBackend
+# runs commands in a thread of guppy's own against a transport which stays
+# connected between commands: LoopbackTransport uses a local directory as
+# the PVR's disk for testing, topfield.TopfieldTransport talks to the PVR
+# over USB. BrokerBackend hands commands to puppyd so several programs can
+# share the PVR. Users of a SessionBackend or BrokerBackend that run a gobject
+# main loop must call gobject.threads_init().
+
+import os
+import sys
+import time
+import errno
+import popen2
+import signal
+import shutil
+import atexit
+import threading
+import Queue
+import socket
+
+import config
+
+# Set to True for debug output
+DEBUG = False
+
+# Bytes moved in one go by a SessionBackend transfer
+CHUNK_SIZE = 64 * 1024
+
+# Seconds between the progress records printed by a SessionBackend transfer
+PROGRESS_INTERVAL = 1.0
+
+def shellQuote(arg):
+	return "'" + arg.replace("'", "'\\''") + "'"
+
+# Output in puppy's formats, for backends which don't run puppy
+
+def formatSize(label, bytes):
+	kib = long(bytes) / 1024
+	return '%s %10u kiB %7u MiB %4u GiB\n' % (label, kib % 1024, kib / 1024 % 1024, kib / 1024 / 1024)
+
+def formatListEntry(type, size, mtime, name):
+	return '%s %20d %s %s\n' % (type, size, time.ctime(mtime), name)
+
+def formatProgress(done, size, elapsed):
+	percent = 100.0
+	if size > 0:
+		percent = 100.0 * done / size
+	mbits = 0.0
+	if elapsed > 0:
+		mbits = done * 8 / elapsed / 1000000
+	remaining = 0
+	if done > 0:
+		remaining = int(elapsed * (size - done) / done)
+	elapsed = int(elapsed)
+
+	return '\r%6.2f%%, %5.2f Mbits/s, %02d:%02d:%02d elapsed, %d:%02d:%02d remaining' % \
+	       (percent, mbits, elapsed / 3600, elapsed / 60 % 60, elapsed % 60,
+	        remaining / 3600, remaining / 60 % 60, remaining % 60)
+
+# Run the puppy program for every command
+class SubprocessBackend:
+	def __init__(self, cmd='puppy'):
+		self.cmd = cmd
+
+	def execute(self, command, args=(), turbo=False):
+		cmd = self.cmd
+		if turbo:
+			cmd += ' -t'
+		cmd += ' -c ' + command
+		for arg in args:
+			# Single quotes so the shell leaves \ alone
+			cmd += ' ' + shellQuote(arg)
+
+		if DEBUG:
+			print 'cmd = ', cmd
+
+		return SubprocessProcess(cmd)
+
+class SubprocessProcess:
+	def __init__(self, cmd):
+		self.popen_obj = popen2.Popen4(cmd)
+		self.popen_obj.tochild.close()
+		self.fromchild = self.popen_obj.fromchild
+		self.pid = self.popen_obj.pid
+
+	def poll(self):
+		return self.popen_obj.poll()
+
+	def wait(self):
+		return self.popen_obj.wait()
+
+	def cancel(self):
+		if self.poll() == -1:
+			os.kill(self.pid, signal.SIGTERM)
+
+# Runs commands one at a time in a thread against a transport which is
+# connected on the first command and stays connected until close() or an
+# error. Commands from every Puppy using the backend are queued, so they
+# never compete for the PVR.
+class SessionBackend:
+	def __init__(self, transport):
+		self.transport = transport
+		self.connected = False
+		self.queue = Queue.Queue()
+		self.thread = None
+		self.lock = threading.Lock()
+
+	def execute(self, command, args=(), turbo=False):
+		process = SessionProcess(command, args, turbo)
+
+		self.lock.acquire()
+		try:
+			if self.thread == None:
+				self.thread = threading.Thread(target=self._run)
+				self.thread.setDaemon(True)
+				self.thread.start()
+				# Python tears a daemon thread down messily at exit
+				atexit.register(self.close)
+		finally:
+			self.lock.release()
+
+		self.queue.put(process)
+		return process
+
+	# Disconnect once the queued commands have run
+	def close(self):
+		thread = self.thread
+		if thread == None:
+			return
+
+		self.queue.put(None)
+		if thread != threading.currentThread():
+			thread.join()
+
+	def _run(self):
+		while True:
+			process = self.queue.get()
+			if process == None:
+				break
+			# Cancelled while it was queued and already finished
+			if not process.start():
+				continue
+
+			status = 1 << 8
+			try:
+				try:
+					if not self.connected:
+						self.transport.open()
+						self.connected = True
+					self._runCommand(process)
+					status = 0
+				except TransferCancelled:
+					status = signal.SIGTERM
+				except TransportError, error:
+					self._write(process, 'ERROR: ' + error.value + '\n')
+					# Start again with a fresh connection
+					self._disconnect()
+				except Exception, error:
+					# Anything else mustn't stop the thread or later
+					# commands would never run
+					self._write(process, 'ERROR: ' + str(error) + '\n')
+					self._disconnect()
+			finally:
+				process.finish(status)
+
+		self._disconnect()
+		self.lock.acquire()
+		self.thread = None
+		self.lock.release()
+
+	def _disconnect(self):
+		if not self.connected:
+			return
+
+		self.connected = False
+		try:
+			self.transport.close()
+		except (TransportError, IOError, OSError):
+			pass
+
+	def _write(self, process, data):
+		try:
+			os.write(process.write_fd, data)
+		except OSError, error:
+			# Nobody is reading any more
+			if error.errno != errno.EPIPE:
+				raise
+
+	def _runCommand(self, process):
+		command = process.command
+		args = process.args
+		transport = self.transport
+
+		if command == 'size':
+			total, free = transport.getDiskSpace()
+			self._write(process, formatSize('Total', total) + formatSize('Free ', free))
+		elif command == 'dir':
+			path = '\\'
+			if len(args) > 0:
+				path = args[0]
+			lines = [ formatListEntry(*entry) for entry in transport.listDir(path) ]
+			self._write(process, ''.join(lines))
+		elif command == 'get':
+			dst = os.path.basename(args[0].replace('\\', '/'))
+			if len(args) > 1:
+				dst = args[1]
+			self._get(process, args[0], dst)
+		elif command == 'put':
+			dst = '\\' + os.path.basename(args[0])
+			if len(args) > 1:
+				dst = args[1]
+			self._put(process, args[0], dst)
+		elif command == 'mkdir':
+			transport.makeDir(args[0])
+		elif command == 'rename':
+			transport.rename(args[0], args[1])
+		elif command == 'delete':
+			transport.delete(args[0])
+		else:
+			raise TransportError("Unknown command " + command)
+
+	def _get(self, process, src, dst):
+		self.transport.setTurbo(process.turbo)
+		reader = self.transport.openRead(src)
+		try:
+			file = open(dst, 'wb')
+			try:
+				self._copy(process, reader.read, file.write, reader.size)
+			finally:
+				file.close()
+		except:
+			reader.cancel()
+			raise
+		reader.close()
+
+	def _put(self, process, src, dst):
+		size = os.path.getsize(src)
+		file = open(src, 'rb')
+		try:
+			self.transport.setTurbo(process.turbo)
+			writer = self.transport.openWrite(dst, size, os.path.getmtime(src))
+			try:
+				self._copy(process, file.read, writer.write, size)
+			except:
+				writer.cancel()
+				raise
+			writer.close()
+		finally:
+			file.close()
+
+	def _copy(self, process, read, write, size):
+		start = time.time()
+		last_report = start
+		done = 0
+		while True:
+			if process.cancelled:
+				raise TransferCancelled()
+
+			data = read(CHUNK_SIZE)
+			if len(data) == 0:
+				break
+			write(data)
+			done += len(data)
+
+			now = time.time()
+			if now - last_report >= PROGRESS_INTERVAL:
+				last_report = now
+				self._write(process, formatProgress(done, size, now - start))
+
+		self._write(process, formatProgress(done, size, time.time() - start) + '\n')
+
+# A command run by a thread. Waiting for one from the main loop can mean
+# waiting for every command queued before it, so a command cancelled before
+# it has started is finished straight away and skipped by the thread.
+class SessionProcess:
+	def __init__(self, command, args, turbo):
+		self.command = command
+		self.args = args
+		self.turbo = turbo
+		self.cancelled = False
+		self.started = False
+		self.status = None
+		self.done = threading.Event()
+		self.lock = threading.Lock()
+		self.pid = None
+
+		read_fd, self.write_fd = os.pipe()
+		self.fromchild = os.fdopen(read_fd)
+
+	def poll(self):
+		if self.status == None:
+			return -1
+		return self.status
+
+	def wait(self):
+		self.done.wait()
+		return self.status
+
+	def cancel(self):
+		self.lock.acquire()
+		try:
+			self.cancelled = True
+			if not self.started and self.status == None:
+				self.finish(signal.SIGTERM)
+		finally:
+			self.lock.release()
+
+	# Called by the thread running the command. Returns False if the command
+	# was cancelled and mustn't be run.
+	def start(self):
+		self.lock.acquire()
+		try:
+			if self.status != None:
+				return False
+			self.started = True
+			return True
+		finally:
+			self.lock.release()
+
+	def finish(self, status):
+		self.status = status
+		os.close(self.write_fd)
+		self.done.set()
+
+# Sends commands to puppyd, which owns the PVR and runs the commands of
+# every program using it one at a time. Commands are run by fallback, puppy
+# by default, when puppyd isn't running.
+class BrokerBackend:
+	def __init__(self, socket_path=None, fallback=None):
+		if socket_path == None:
+			socket_path = config.getConfigPath('puppyd.sock')
+		if fallback == None:
+			fallback = SubprocessBackend()
+		self.socket_path = socket_path
+		self.fallback = fallback
+
+	def execute(self, command, args=(), turbo=False):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(self.socket_path)
+		except socket.error:
+			sock.close()
+			if DEBUG:
+				print 'puppyd is not running, using fallback'
+			return self.fallback.execute(command, args, turbo)
+
+		request = [ str(int(bool(turbo))), command ] + list(args)
+		if DEBUG:
+			print 'request = ', request
+
+		process = BrokerProcess(command, args, turbo, sock)
+		try:
+			sock.sendall('\t'.join(request) + '\n')
+		except socket.error, error:
+			process.fail('ERROR: puppyd: ' + str(error) + '\n')
+			return process
+
+		thread = threading.Thread(target=process.run)
+		thread.setDaemon(True)
+		thread.start()
+		return process
+
+# A command run by puppyd. A thread unpacks the frames puppyd sends into the
+# pipe read through fromchild.
+class BrokerProcess(SessionProcess):
+	def __init__(self, command, args, turbo, sock):
+		SessionProcess.__init__(self, command, args, turbo)
+		self.sock = sock
+		# puppyd queues the command, run() finishes it whether or not it is
+		# cancelled
+		self.started = True
+
+	def cancel(self):
+		SessionProcess.cancel(self)
+		try:
+			self.sock.sendall('C\n')
+		except socket.error:
+			pass
+
+	def fail(self, message):
+		os.write(self.write_fd, message)
+		self.sock.close()
+		self.finish(1 << 8)
+
+	def run(self):
+		buffer = ''
+		try:
+			while True:
+				data = self.sock.recv(CHUNK_SIZE)
+				if len(data) == 0:
+					break
+				buffer += data
+
+				while '\n' in buffer:
+					header, rest = buffer.split('\n', 1)
+					if header[:1] == 'S':
+						self.sock.close()
+						self.finish(int(header[1:]))
+						return
+
+					length = int(header[1:])
+					if len(rest) < length:
+						break
+					os.write(self.write_fd, rest[:length])
+					buffer = rest[length:]
+		except (socket.error, ValueError, OSError), error:
+			self.fail('ERROR: puppyd: ' + str(error) + '\n')
+			return
+
+		self.fail('ERROR: puppyd went away\n')
+
+# Uses a directory as the PVR's disk. bandwidth, in Mbits/s, limits the speed
+# of transfers like the USB bus would.
+class LoopbackTransport:
+	def __init__(self, root, bandwidth=None, disk_size=160 * 1024 ** 3):
+		self.root = root
+		self.bandwidth = bandwidth
+		self.disk_size = disk_size
+		self.turbo = False
+
+	def open(self):
+		if not os.path.isdir(self.root):
+			raise TransportError("PVR not found: " + self.root)
+
+	def close(self):
+		pass
+
+	def setTurbo(self, turbo):
+		self.turbo = turbo
+
+	def localPath(self, path):
+		parts = [ part for part in path.split('\\') if part != '' ]
+		if '..' in parts:
+			raise TransportError("Invalid filename: " + path)
+		return os.path.join(self.root, *parts)
+
+	def getDiskSpace(self):
+		used = 0
+		for dir, dirs, files in os.walk(self.root):
+			for name in files:
+				used += os.path.getsize(os.path.join(dir, name))
+		return self.disk_size, max(self.disk_size - used, 0)
+
+	def listDir(self, path):
+		dir = self.localPath(path)
+		if not os.path.isdir(dir):
+			raise TransportError("File not found: " + path)
+
+		entries = []
+		if dir != self.root:
+			entries.append(('d', 0, 0, '..'))
+		names = os.listdir(dir)
+		names.sort()
+		for name in names:
+			stats = os.stat(os.path.join(dir, name))
+			if os.path.isdir(os.path.join(dir, name)):
+				entries.append(('d', 0, stats.st_mtime, name))
+			else:
+				entries.append(('f', stats.st_size, stats.st_mtime, name))
+
+		return entries
+
+	def openRead(self, path):
+		filename = self.localPath(path)
+		if not os.path.isfile(filename):
+			raise TransportError("File not found: " + path)
+		return LoopbackFile(self, open(filename, 'rb'), os.path.getsize(filename))
+
+	def openWrite(self, path, size, mtime):
+		filename = self.localPath(path)
+		if not os.path.isdir(os.path.dirname(filename)):
+			raise TransportError("File not found: " + path)
+		return LoopbackFile(self, open(filename, 'wb'), size)
+
+	def makeDir(self, path):
+		dir = self.localPath(path)
+		if os.path.exists(dir):
+			raise TransportError("Invalid filename: " + path)
+		os.mkdir(dir)
+
+	def rename(self, old_path, new_path):
+		old_filename = self.localPath(old_path)
+		new_filename = self.localPath(new_path)
+		if not os.path.exists(old_filename) or os.path.exists(new_filename):
+			raise TransportError("Invalid filename: " + old_path)
+		os.rename(old_filename, new_filename)
+
+	def delete(self, path):
+		filename = self.localPath(path)
+		if os.path.isdir(filename):
+			shutil.rmtree(filename)
+		elif os.path.exists(filename):
+			os.remove(filename)
+		else:
+			raise TransportError("File not found: " + path)
+
+class LoopbackFile:
+	def __init__(self, transport, file, size):
+		self.transport = transport
+		self.file = file
+		self.size = size
+		self.start = time.time()
+		self.bytes = 0
+
+	def throttle(self, length):
+		self.bytes += length
+		if self.transport.bandwidth == None:
+			return
+
+		rate = self.transport.bandwidth * 1000000 / 8
+		if self.transport.turbo:
+			rate *= 2
+		delay = self.start + self.bytes / rate - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+	def read(self, length):
+		data = self.file.read(length)
+		self.throttle(len(data))
+		return data
+
+	def write(self, data):
+		self.file.write(data)
+		self.throttle(len(data))
+
+	def close(self):
+		self.file.close()
+
+	def cancel(self):
+		self.file.close()
+
+_default_backend = None
+
+# Create a backend from a description: 'puppy' or 'puppy:COMMAND' to run
+# puppy, 'usb' to talk to the PVR directly or 'loopback:DIR' to use DIR as the
+# PVR's disk. 'usb' needs pyusb and falls back to puppy without it.
+def createBackend(spec):
+	name, arg = (spec.split(':', 1) + [ None ])[:2]
+	if name == 'puppy':
+		if arg == None:
+			arg = 'puppy'
+		return SubprocessBackend(arg)
+	elif name == 'usb':
+		try:
+			import topfield
+		except ImportError:
+			print >> sys.stderr, 'guppy: pyusb is not installed, using puppy instead'
+			return SubprocessBackend()
+		return SessionBackend(topfield.TopfieldTransport())
+	elif name == 'loopback' and arg != None:
+		return SessionBackend(LoopbackTransport(arg))
+	elif name == 'broker':
+		return BrokerBackend(arg)
+
+	raise TransportError("Unknown backend: " + spec)
+
+# The backend shared by every Puppy that isn't given one. Chosen by the
+# GUPPY_BACKEND environment variable, puppy by default.
+def getDefaultBackend():
+	global _default_backend
+	if _default_backend == None:
+		_default_backend = createBackend(os.environ.get('GUPPY_BACKEND', 'puppy'))
+	return _default_backend
+
+def setDefaultBackend(backend):
+	global _default_backend
+	_default_backend = backend
+
+class TransferCancelled(Exception):
+	pass
+
+class TransportError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
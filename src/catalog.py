@@ -0,0 +1,271 @@
+## catalog.py - Index of every file on the PVR
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import time
+import cPickle
+
+import gobject
+
+import puppy
+import config
+
+# Bump when the format of the catalog file changes
+CATALOG_VERSION = 1
+
+# Seconds before the crawler lists a directory again
+CATALOG_REFRESH_AGE = 24 * 60 * 60
+
+# Maximum number of results returned by Catalog.search()
+SEARCH_LIMIT = 500
+
+# Index of the PVR's files, kept in a file in guppy's config directory. For
+# each directory it stores when it was listed and a (type, name, size, mtime)
+# tuple for every entry in it.
+class Catalog:
+	def __init__(self, filename=None):
+		if filename == None:
+			filename = config.getConfigPath('catalog')
+		self.filename = filename
+
+		self.dirs = {}
+		self.dirty = False
+		# Flat list of (lower case name, dir, entry) built for searching
+		self.search_index = None
+
+		self.load()
+
+	def load(self):
+		try:
+			file = open(self.filename, 'rb')
+			try:
+				version, dirs = cPickle.load(file)
+			finally:
+				file.close()
+		except config.LOAD_ERRORS:
+			return
+
+		if version == CATALOG_VERSION and isinstance(dirs, dict):
+			self.dirs = dirs
+			self.search_index = None
+
+	def save(self):
+		if not self.dirty:
+			return
+
+		data = cPickle.dumps((CATALOG_VERSION, self.dirs), cPickle.HIGHEST_PROTOCOL)
+		config.writeFile(self.filename, data)
+		self.dirty = False
+
+	# Replace what we know about path with listing, as returned by
+	# Puppy.listDir()
+	def updateDir(self, path, listing):
+		path = puppy.normPath(path)
+
+		entries = []
+		for entry in listing:
+			if entry.name == '..' or entry.name == '.':
+				continue
+			entries.append((entry.type, entry.name, entry.size, entry.mtime))
+
+		# Forget directories that no longer exist
+		subdirs = [ entry[1] for entry in entries if entry[0] == 'd' ]
+		for old_entry in self.getEntries(path):
+			if old_entry[0] == 'd' and old_entry[1] not in subdirs:
+				self.removeDir(puppy.joinPath(path, old_entry[1]))
+
+		self.dirs[path] = (time.time(), entries)
+		self.dirty = True
+		self.search_index = None
+
+	def removeDir(self, path):
+		path = puppy.normPath(path)
+		for dir in self.dirs.keys():
+			if dir == path or dir.startswith(path + '\\'):
+				del self.dirs[dir]
+
+		self.dirty = True
+		self.search_index = None
+
+	def getEntries(self, path):
+		path = puppy.normPath(path)
+		if not self.dirs.has_key(path):
+			return []
+
+		return self.dirs[path][1]
+
+	# Returns seconds since path was listed, or None if it never has been
+	def getAge(self, path):
+		path = puppy.normPath(path)
+		if not self.dirs.has_key(path):
+			return None
+
+		return time.time() - self.dirs[path][0]
+
+	# Returns the bytes in the files below path as far as the catalog knows
+	def getTreeSize(self, path):
+		size = 0
+		pending = [ puppy.normPath(path) ]
+		while len(pending) > 0:
+			dir = pending.pop()
+			for type, name, entry_size, mtime in self.getEntries(dir):
+				if type == 'd':
+					pending.append(puppy.joinPath(dir, name))
+				else:
+					size += entry_size
+
+		return size
+
+	# Find entries whose name contains text, ignoring case. Returns a list of
+	# (dir, (type, name, size, mtime)) sorted by path.
+	def search(self, text):
+		if self.search_index == None:
+			self.search_index = []
+			for dir, (listed, entries) in self.dirs.items():
+				for entry in entries:
+					self.search_index.append((entry[1].lower(), dir, entry))
+			self.search_index.sort()
+
+		text = text.lower()
+		results = []
+		for name, dir, entry in self.search_index:
+			if text in name:
+				results.append((dir, entry))
+				if len(results) == SEARCH_LIMIT:
+					break
+
+		return results
+
+# Walks the PVR's directory tree in the background, listing every directory
+# that hasn't been listed for CATALOG_REFRESH_AGE seconds and storing the
+# result in a Catalog. Directories that are still fresh are walked using the
+# catalog so they cost nothing over USB.
+class CatalogCrawler(gobject.GObject):
+	__gsignals__ = {
+		'dir-listed' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		                (gobject.TYPE_PYOBJECT,)),
+		'finished'   : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+	}
+
+	def __init__(self, catalog, puppy_obj):
+		gobject.GObject.__init__(self)
+
+		self.catalog = catalog
+		self.puppy = puppy_obj
+		self.pending = []
+		self.reader = None
+		self.watch_id = None
+		self.idle_id = None
+		# pause() may be called by several users of the PVR at once
+		self.pause_count = 0
+		self.refresh_age = CATALOG_REFRESH_AGE
+
+	def start(self, root='\\', refresh_age=CATALOG_REFRESH_AGE):
+		self.pending = [ puppy.normPath(root) ]
+		self.refresh_age = refresh_age
+		self._scheduleNext()
+
+	def stop(self):
+		self.pending = []
+		self._cancelListing()
+		if self.idle_id != None:
+			gobject.source_remove(self.idle_id)
+			self.idle_id = None
+
+	def isRunning(self):
+		return len(self.pending) > 0 or self.reader != None
+
+	# Stop using the PVR until resume() is called. A directory being listed is
+	# listed again later.
+	def pause(self):
+		self.pause_count += 1
+		if self.reader != None:
+			self.pending.insert(0, self.reader.path)
+			self._cancelListing()
+
+	def resume(self):
+		if self.pause_count > 0:
+			self.pause_count -= 1
+		if self.pause_count == 0 and len(self.pending) > 0:
+			self._scheduleNext()
+
+	def _scheduleNext(self):
+		if self.idle_id == None and self.reader == None:
+			self.idle_id = gobject.idle_add(self._listNext)
+
+	def _cancelListing(self):
+		if self.reader == None:
+			return
+
+		gobject.source_remove(self.watch_id)
+		self.watch_id = None
+		self.reader.cancel()
+		self.reader = None
+
+	def _queueSubdirs(self, path):
+		subdirs = []
+		for entry in self.catalog.getEntries(path):
+			if entry[0] == 'd':
+				subdirs.append(puppy.joinPath(path, entry[1]))
+
+		# Depth first so the pending list stays short
+		self.pending[0:0] = subdirs
+
+	def _listNext(self):
+		self.idle_id = None
+		if self.pause_count > 0:
+			return False
+
+		while len(self.pending) > 0:
+			path = self.pending.pop(0)
+			age = self.catalog.getAge(path)
+			if age == None or age > self.refresh_age:
+				self.reader = self.puppy.startListDir(path)
+				self.watch_id = gobject.io_add_watch(self.reader.fileno(),
+				                                     gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+				                                     self._on_listing_output)
+				return False
+
+			self._queueSubdirs(path)
+
+		self.catalog.save()
+		self.emit('finished')
+		return False
+
+	def _on_listing_output(self, source, condition):
+		self.reader.read()
+		if not self.reader.eof:
+			return True
+
+		reader = self.reader
+		self.reader = None
+		self.watch_id = None
+
+		try:
+			listing = reader.finish()
+		except puppy.PuppyError:
+			# Leave what we knew about the directory alone and carry on
+			listing = None
+
+		if listing != None:
+			self.catalog.updateDir(reader.path, listing)
+			self.emit('dir-listed', reader.path)
+		self._queueSubdirs(reader.path)
+
+		self._scheduleNext()
+		return False
+
+gobject.type_register(CatalogCrawler)
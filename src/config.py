@@ -0,0 +1,46 @@
+## config.py - Location of the files guppy keeps between runs
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import cPickle
+
+CONFIG_DIR = os.path.join(os.path.expanduser('~'), '.guppy')
+
+# Returns the path of the file called name in guppy's config directory,
+# creating the directory if needed
+def getConfigPath(name):
+	if not os.path.isdir(CONFIG_DIR):
+		os.makedirs(CONFIG_DIR)
+
+	return os.path.join(CONFIG_DIR, name)
+
+# Write data to filename without leaving a truncated file behind if guppy is
+# killed part way through
+def writeFile(filename, data):
+	tmp_filename = filename + '.tmp'
+	file = open(tmp_filename, 'wb')
+	try:
+		file.write(data)
+	finally:
+		file.close()
+
+	os.rename(tmp_filename, filename)
+
+# What reading back a pickled file can raise when the file is truncated,
+# corrupt or was written by another version of guppy
+LOAD_ERRORS = (IOError, EOFError, ValueError, TypeError, KeyError, IndexError,
+               AttributeError, ImportError, cPickle.UnpicklingError)
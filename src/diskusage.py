@@ -0,0 +1,125 @@
+## diskusage.py - Keep track of free disk space on the PVR and the PC
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# Asking the PVR for its free space means a command on the USB bus, so it is
+# asked once and the answer kept up to date from the uploads finished by a
+# TransferQueue. The PVR is only asked again by refresh(), or by
+# refreshIfStale() when the answer can no longer be worked out, after an
+# upload failed part way. Neither asks while the queue is running, as the
+# command would run on the Puppy the transfer is using; the PVR is asked
+# once the queue finishes instead. Free space on the PC comes from
+# os.statvfs(), which is cheap enough to call every time.
+
+import os
+
+import gobject
+
+import puppy
+
+class DiskUsage(gobject.GObject):
+	__gsignals__ = {
+		# Free space on the PVR or PC may have changed
+		'changed' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+	}
+
+	def __init__(self, puppy_obj, queue=None):
+		gobject.GObject.__init__(self)
+
+		self.puppy = puppy_obj
+		self.queue = queue
+		self.pvr_total = None
+		self.pvr_free = None
+		# False when the PVR must be asked again
+		self.queried = False
+
+		if queue != None:
+			queue.connect('job-finished', self.on_job_finished)
+			queue.connect('finished', self.on_queue_finished)
+
+	# Returns the PVR's total and free space in bytes, asking the PVR only if
+	# it hasn't been asked yet. Raises puppy.PuppyError if that fails. Both
+	# are None if they aren't known and a transfer is running.
+	def getPVRSpace(self):
+		if self.pvr_free == None:
+			self.refresh()
+		return self.pvr_total, self.pvr_free
+
+	def getPVRFree(self):
+		return self.getPVRSpace()[1]
+
+	# Returns the PVR's free space in bytes from the last answer, without
+	# asking the PVR, or None if it hasn't answered yet
+	def getKnownPVRFree(self):
+		return self.pvr_free
+
+	# Returns the bytes free for ordinary users on the file system holding
+	# path, or None if it can't be found
+	def getLocalFree(self, path):
+		try:
+			stats = os.statvfs(path)
+		except OSError:
+			return None
+		return stats.f_bavail * stats.f_frsize
+
+	def isBusy(self):
+		return self.queue != None and self.queue.isRunning()
+
+	def refresh(self):
+		if self.isBusy():
+			# Asked once the transfers are done
+			self.queried = False
+			return
+
+		self.pvr_total, self.pvr_free = self.puppy.getDiskSpace()
+		self.queried = True
+		self.emit('changed')
+
+	def isStale(self):
+		return not self.queried
+
+	# Ask the PVR again if the answer is out of date and the PVR isn't busy
+	def refreshIfStale(self):
+		if self.isStale() and not self.isBusy():
+			try:
+				self.refresh()
+			except puppy.PuppyError:
+				# Try again next time
+				pass
+
+	def fileAdded(self, size):
+		if self.pvr_free != None and size != None:
+			self.pvr_free = max(self.pvr_free - size, 0)
+		self.emit('changed')
+
+	def on_job_finished(self, queue, job):
+		if job.direction == 'download':
+			# Only the PC's free space has changed
+			if job.state == 'done':
+				self.emit('changed')
+			return
+
+		if job.state == 'done':
+			self.fileAdded(job.size)
+		elif job.state in ('failed', 'cancelled') and job.bytes_done > 0:
+			# Part of the file may have been left on the PVR
+			self.queried = False
+			self.emit('changed')
+
+	def on_queue_finished(self, queue):
+		self.refreshIfStale()
+
+gobject.type_register(DiskUsage)
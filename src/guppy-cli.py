@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+## guppy-cli.py - Command line interface for transfers without a display
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# Nothing here may import gtk, this has to run from cron on machines without
+# an X display.
+
+import sys
+import os
+import time
+import glob
+import fnmatch
+import optparse
+
+import puppy
+import backends
+import jsonwriter
+
+USAGE = """%prog [options] COMMAND [ARGS]
+
+Commands:
+  ls   [PVR_DIR]                    List a directory on the PVR
+  get  PVR_PATTERN... LOCAL_DIR     Download files matching the patterns
+  put  LOCAL_PATTERN... PVR_DIR     Upload files matching the patterns
+  sync PVR_DIR LOCAL_DIR            Mirror PVR_DIR and its subdirectories
+                                    into LOCAL_DIR
+  df                                Show PVR disk usage
+  history [FILE]                    Export the transfer history as CSV, or
+                                    JSON with --json
+  verify [LOCAL_DIR]                Read back the files downloaded with
+                                    --verify and compare their checksums
+
+PVR patterns use shell wildcards in the file name, e.g. '\\DataFiles\\*.rec'"""
+
+# Exit statuses
+EXIT_OK, EXIT_FAILED, EXIT_USAGE = range(3)
+
+# Print one event as a line of JSON
+class JSONReporter:
+	def __init__(self, out=sys.stdout):
+		self.out = out
+
+	def report(self, event, **values):
+		items = [ '"event": ' + jsonwriter.jsonString(event) ]
+		keys = values.keys()
+		keys.sort()
+		for key in keys:
+			items.append(jsonwriter.jsonString(key) + ': ' + jsonwriter.jsonValue(values[key]))
+		self.out.write('{' + ', '.join(items) + '}\n')
+		self.out.flush()
+
+# Print events for people
+class TextReporter:
+	def __init__(self, out=sys.stdout):
+		self.out = out
+
+	def report(self, event, **values):
+		if event == 'entry':
+			date = time.strftime('%a %b %d %H:%M %Y', time.localtime(values['mtime']))
+			self.out.write('%s %12d %s %s\n' % (values['type'], values['size'], date, values['name']))
+		elif event == 'progress':
+			line = '\r%6.2f%% %s, %s remaining' % (values['percent'], values['speed'], values['remaining'])
+			if values['batch_total'] > 0 and values['batch_remaining'] != None:
+				remaining = values['batch_remaining']
+				line += ', all files %d%% with %d:%02d:%02d remaining' % \
+				        (100 * values['batch_bytes'] / values['batch_total'],
+				         remaining / 3600, remaining / 60 % 60, remaining % 60)
+			sys.stderr.write(line + '  ')
+		elif event == 'start':
+			sys.stderr.write('%s -> %s\n' % (values['src'], values['dst']))
+		elif event in ('done', 'skipped', 'failed', 'cancelled'):
+			msg = '\r' + event
+			if values.get('error') != None:
+				msg += ': ' + values['error']
+			sys.stderr.write(msg + ' ' * 40 + '\n')
+		elif event == 'plan':
+			self.out.write('%(new)d new, %(changed)d changed, %(delete)d to delete, %(bytes)d bytes to download\n' % values)
+		elif event == 'deleted':
+			sys.stderr.write('deleted %s\n' % values['dst'])
+		elif event == 'summary':
+			self.out.write('%(done)d transferred, %(skipped)d skipped, %(failed)d failed\n' % values)
+		elif event == 'verify':
+			self.out.write('%s %s\n' % (values['result'], values['path']))
+		elif event == 'df':
+			self.out.write('Total %d bytes, free %d bytes\n' % (values['total'], values['free']))
+		elif event == 'error':
+			sys.stderr.write('error: %s\n' % values['message'])
+		self.out.flush()
+
+def splitPVRPath(path):
+	path = puppy.normPath(path)
+	index = path.rindex('\\')
+	return puppy.normPath(path[:index]), path[index + 1:]
+
+class GuppyCLI:
+	def __init__(self, options):
+		self.options = options
+		self.puppy = puppy.Puppy(puppy.ListingCache())
+		self.puppy.setTurbo(options.turbo)
+		# Set when a pattern matched nothing
+		self.unmatched = False
+
+		if options.json:
+			self.reporter = JSONReporter()
+		else:
+			self.reporter = TextReporter()
+
+	def ls(self, args):
+		if len(args) > 1:
+			raise UsageError("ls takes at most one directory")
+
+		path = None
+		if len(args) == 1:
+			path = args[0]
+
+		for entry in self.puppy.listDir(path):
+			if entry.name == '..':
+				continue
+			self.reporter.report('entry', type=entry.type, name=entry.name,
+			                     size=entry.size, mtime=entry.mtime)
+		return EXIT_OK
+
+	def df(self, args):
+		if len(args) != 0:
+			raise UsageError("df takes no arguments")
+
+		total, free = self.puppy.getDiskSpace()
+		self.reporter.report('df', total=long(total), free=long(free))
+		return EXIT_OK
+
+	def get(self, args):
+		if len(args) < 2:
+			raise UsageError("get needs at least one PVR pattern and a local directory")
+
+		dst_dir = args[-1]
+		if not os.path.isdir(dst_dir):
+			raise UsageError(dst_dir + " is not a directory")
+
+		# Imported here so ls and df don't pay for gobject
+		import transfer
+
+		jobs = []
+		for pattern in args[:-1]:
+			src_dir, name_pattern = splitPVRPath(pattern)
+			matched = False
+			for entry in self.puppy.listDir(src_dir):
+				if entry.name == '..' or not fnmatch.fnmatch(entry.name, name_pattern):
+					continue
+				if entry.type == 'd' and not self.options.recursive:
+					continue
+				matched = True
+				job = transfer.TransferJob(puppy.joinPath(src_dir, entry.name),
+				                           os.path.join(dst_dir, entry.name),
+				                           'download', entry.size, entry.mtime, entry.type)
+				if entry.type == 'd':
+					job.size = None
+				jobs.append(job)
+			if not matched:
+				self.reporter.report('error', message="No files match " + pattern)
+				self.unmatched = True
+
+		return self.runJobs(jobs)
+
+	def put(self, args):
+		if len(args) < 2:
+			raise UsageError("put needs at least one local pattern and a PVR directory")
+
+		import transfer
+
+		dst_dir = puppy.normPath(args[-1])
+		existing = [ entry.name for entry in self.puppy.listDir(dst_dir) ]
+
+		jobs = []
+		for pattern in args[:-1]:
+			files = [ file for file in glob.glob(pattern) if os.path.isfile(file) or
+			          (self.options.recursive and os.path.isdir(file)) ]
+			if len(files) == 0:
+				self.reporter.report('error', message="No files match " + pattern)
+				self.unmatched = True
+			for file in files:
+				name = os.path.basename(os.path.normpath(file))
+				type = 'f'
+				if os.path.isdir(file):
+					type = 'd'
+				job = transfer.TransferJob(file, puppy.joinPath(dst_dir, name), 'upload', type=type)
+				if type == 'f' and name in existing and self.options.overwrite == 'never':
+					job.state = 'skipped'
+				jobs.append(job)
+
+		return self.runJobs(jobs)
+
+	def sync(self, args):
+		if len(args) != 2:
+			raise UsageError("sync needs a PVR directory and a local directory")
+
+		src_dir = args[0]
+		dst_dir = args[1]
+		if not os.path.isdir(dst_dir):
+			raise UsageError(dst_dir + " is not a directory")
+
+		import transfer
+		import sync
+		import verify
+
+		# Files verified by earlier runs are skipped without being read
+		manifest = verify.Manifest()
+		planner = sync.SyncPlanner(self.puppy, self.options.priority, self.options.delete,
+		                           manifest=manifest)
+		plan = planner.plan(src_dir, dst_dir)
+		self.reporter.report('plan', **sync.summarisePlan(plan))
+
+		# The plan only holds files that differ so --overwrite doesn't apply
+		try:
+			jobs = planner.execute(plan)
+		except OSError, error:
+			self.reporter.report('error', message=error.strerror + ": " + error.filename)
+			return EXIT_FAILED
+
+		delete_failed = False
+		for action in plan:
+			if action.kind != 'delete':
+				continue
+			if action.error == None:
+				self.reporter.report('deleted', dst=action.dst, size=action.size)
+			else:
+				self.reporter.report('error', message=action.error.strerror + ": " + action.dst)
+				delete_failed = True
+
+		if not self.options.verify:
+			manifest = None
+		queue = transfer.TransferQueue(self.puppy, manifest)
+		for job in jobs:
+			queue.add(job)
+
+		status = self.runQueue(queue, jobs)
+		if delete_failed:
+			status = EXIT_FAILED
+		return status
+
+	def history(self, args):
+		if len(args) > 1:
+			raise UsageError("history takes at most one file")
+
+		import metrics
+
+		history = metrics.MetricsHistory()
+		out = sys.stdout
+		if len(args) == 1:
+			out = open(args[0], 'w')
+
+		try:
+			if self.options.json:
+				history.exportJSON(out)
+			else:
+				history.exportCSV(out, self.options.samples)
+		finally:
+			if out != sys.stdout:
+				out.close()
+
+		return EXIT_OK
+
+	# Check the files in the manifest, or those below a local directory
+	def verify(self, args):
+		if len(args) > 1:
+			raise UsageError("verify takes at most one local directory")
+
+		import verify
+
+		manifest = verify.Manifest()
+		dir = None
+		if len(args) == 1:
+			dir = args[0]
+
+		status = EXIT_OK
+		for path in manifest.getPaths(dir):
+			result = manifest.check(path)
+			self.reporter.report('verify', path=path, result=result)
+			if result != 'ok':
+				status = EXIT_FAILED
+
+		try:
+			manifest.save()
+		except (IOError, OSError):
+			# Only saves reading the files again next time
+			pass
+
+		return status
+
+	def runJobs(self, jobs):
+		import transfer
+		import verify
+
+		manifest = None
+		if self.options.verify:
+			manifest = verify.Manifest()
+		queue = transfer.TransferQueue(self.puppy, manifest)
+		for job in jobs:
+			# The queue skips downloads, and files in folders, that would
+			# replace a different file unless told to
+			job.overwrite = self.options.overwrite == 'always'
+			queue.add(job)
+
+		return self.runQueue(queue, jobs)
+
+	def runQueue(self, queue, jobs):
+		import gobject
+		import metrics
+		import transfer
+		import turbo
+
+		metrics.MetricsRecorder(queue, metrics.MetricsHistory(), self.puppy)
+		# Learn from every run so --auto-turbo has something to go on
+		device = self.options.backend or os.environ.get('GUPPY_BACKEND', 'puppy')
+		queue.setTurboTuner(turbo.TurboTuner(queue, self.puppy, device))
+		queue.setAutoTurbo(self.options.auto_turbo)
+		self.batch_progress = transfer.BatchProgress(queue)
+
+		# The USB and broker backends run commands in a thread
+		gobject.threads_init()
+		loop = gobject.MainLoop()
+		queue.connect('job-started', self.on_job_started)
+		queue.connect('job-progress', self.on_job_progress)
+		queue.connect('job-finished', self.on_job_finished)
+		queue.connect('finished', lambda queue: loop.quit())
+
+		for job in jobs:
+			if job.state == 'skipped':
+				self.on_job_finished(queue, job)
+
+		queue.start()
+		if queue.isRunning():
+			loop.run()
+
+		# Folders add the jobs for their contents to the queue
+		counts = { 'done' : 0, 'skipped' : 0, 'failed' : 0, 'cancelled' : 0 }
+		for job in queue.getJobs():
+			if job.type == 'd' and job.state == 'done':
+				continue
+			counts[job.state] = counts.get(job.state, 0) + 1
+		self.reporter.report('summary', **counts)
+
+		if counts['failed'] > 0 or counts['cancelled'] > 0 or self.unmatched:
+			return EXIT_FAILED
+		return EXIT_OK
+
+	def on_job_started(self, queue, job):
+		self.reporter.report('start', src=job.src, dst=job.dst,
+		                     direction=job.direction, size=job.size)
+
+	def on_job_progress(self, queue, job, percent, speed, time):
+		summary = self.batch_progress.getSummary()
+		batch_remaining = summary['remaining']
+		if batch_remaining != None:
+			batch_remaining = int(batch_remaining)
+		self.reporter.report('progress', file=job.getName(), percent=job.percent,
+		                     bytes=job.bytes_done, speed=speed.strip(),
+		                     elapsed=time['elapsed'], remaining=time['remaining'],
+		                     batch_bytes=summary['bytes_done'],
+		                     batch_total=summary['bytes_total'],
+		                     batch_remaining=batch_remaining)
+
+	def on_job_finished(self, queue, job):
+		if job.type == 'd' and job.state == 'done':
+			return
+		self.reporter.report(job.state, src=job.src, dst=job.dst,
+		                     size=job.size, error=job.error)
+
+class UsageError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def main(argv):
+	parser = optparse.OptionParser(usage=USAGE)
+	parser.disable_interspersed_args()
+	parser.add_option('-b', '--backend', default=None,
+	                  help="how to reach the PVR: 'puppy', 'puppy:COMMAND', "
+	                       "'loopback:DIR' or 'broker[:SOCKET]' "
+	                       "[default: $GUPPY_BACKEND or puppy]")
+	parser.add_option('-t', '--turbo', action='store_true', default=False,
+	                  help='use turbo mode')
+	parser.add_option('-a', '--auto-turbo', action='store_true', default=False,
+	                  help='choose turbo mode for each transfer from the speed of '
+	                       'earlier transfers, overriding --turbo')
+	parser.add_option('-j', '--json', action='store_true', default=False,
+	                  help='print progress and results as lines of JSON')
+	parser.add_option('-o', '--overwrite', choices=('never', 'always'), default='never',
+	                  help="'never' skips existing files that differ from the "
+	                       "source, 'always' replaces them [default: %default]. "
+	                       "Complete files are always skipped and partial "
+	                       "downloads always replaced")
+	parser.add_option('-p', '--priority', choices=('smallest', 'oldest', 'name'),
+	                  default='smallest',
+	                  help="order of sync downloads: 'smallest' first, 'oldest' "
+	                       "first or by 'name' [default: %default]")
+	parser.add_option('-d', '--delete', action='store_true', default=False,
+	                  help='sync deletes local files that are not on the PVR')
+	parser.add_option('-r', '--recursive', action='store_true', default=False,
+	                  help='get and put folders matching the patterns along with '
+	                       'everything in them')
+	parser.add_option('-V', '--verify', action='store_true', default=False,
+	                  help='read back each download and record its checksum, '
+	                       'so sync can trust it later without reading it')
+	parser.add_option('-s', '--samples', action='store_true', default=False,
+	                  help='history exports every progress sample as CSV instead '
+	                       'of one line per transfer')
+
+	options, args = parser.parse_args(argv[1:])
+	if len(args) == 0:
+		parser.print_help()
+		return EXIT_USAGE
+
+	if options.backend != None:
+		try:
+			backends.setDefaultBackend(backends.createBackend(options.backend))
+		except backends.TransportError, error:
+			parser.error(error.value)
+
+	cli = GuppyCLI(options)
+	commands = { 'ls' : cli.ls, 'get' : cli.get, 'put' : cli.put,
+	             'sync' : cli.sync, 'df' : cli.df,
+	             'history' : cli.history, 'verify' : cli.verify }
+	if not commands.has_key(args[0]):
+		parser.error('unknown command ' + args[0])
+
+	try:
+		return commands[args[0]](args[1:])
+	except UsageError, error:
+		parser.error(error.value)
+	except puppy.PuppyError, error:
+		cli.reporter.report('error', message=error.value)
+		return EXIT_FAILED
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
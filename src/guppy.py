@@ -21,8 +21,9 @@ import sys
 import os
 import stat
 import time
-import string
-import math
+
+# Taken before gtk is imported so the time to first paint includes it
+START_TIME = time.time()
 
 import gtk
 import gtk.glade
@@ -32,9 +33,32 @@ import locale
 import gettext
 
 import puppy
+import transfer
+import catalog
+import sync
+import metrics
+import diskusage
+import verify
+import turbo
+import schedule
+import session
 
 APP_NAME = 'guppy'
 
+# Number of directory entries added to a model in one go when a directory is
+# loaded in the background
+LOAD_CHUNK_SIZE = 256
+
+# Most rows added to a model one at a time when a directory listed again has
+# changed. Beyond this the rows are all replaced.
+MAX_ROW_UPDATES = 256
+
+# Milliseconds between redraws of the transfer dialog
+PROGRESS_FRAME_INTERVAL = 250
+
+# Seconds between attempts to list the PVR while it isn't connected
+RECONNECT_INTERVAL = 5
+
 def humanReadableSize(size):
 	div_count = 0
 	new_size = size
@@ -62,145 +86,372 @@ def humanReadableSize(size):
 
 	return human_size
 
-def convertToBytes(size):
-	size, unit = size.split()
-
-	size = float(size)
-	
-	if unit == 'GB':
-		size = size * math.pow(1024, 3)
-	elif unit == 'MB':
-		size = size * math.pow(1024, 2)
-	elif unit == 'KB':
-		size = size * 1024
-		
-	return size
-
-class FileSystemModel(gtk.ListStore):
+# Seconds as H:MM:SS, as puppy shows the time remaining
+def formatTime(seconds):
+	seconds = int(seconds)
+	return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+def formatDate(mtime):
+	return time.strftime('%a %b %d %Y', time.localtime(mtime))
+
+# A flat list of the directory's entries, as puppy.ListEntry records, seen
+# by the view through a list of the indexes of the rows shown in the order
+# they are shown. Hidden files are left out of that list and sorting reorders
+# it, both in one go rather than row by row. Dates and sizes are only
+# formatted when the view asks for a row's value.
+#
+# Changing many rows with a signal for each is slow, so when the rows are
+# sorted, filtered or replaced the model is taken away from its views and
+# given back afterwards. Views must be added with addView() for this.
+class FileSystemModel(gtk.GenericTreeModel):
 	TYPE_COL, ICON_COL, NAME_COL, DATE_COL, SIZE_COL = range(5)
-	
+	# Modification time in seconds since the epoch and size in bytes
+	MTIME_COL, BYTES_COL = range(5, 7)
 
+	COLUMN_TYPES = (gobject.TYPE_STRING, gobject.TYPE_STRING, gobject.TYPE_STRING,
+	                gobject.TYPE_STRING, gobject.TYPE_STRING, gobject.TYPE_INT64,
+	                gobject.TYPE_UINT64)
+	
+	__gsignals__ = {
+		'load-started'  : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ()),
+		# Error message, or None if the directory was listed successfully
+		'load-finished'  : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		                    (gobject.TYPE_PYOBJECT,)),
+		# The listing was stopped before it finished
+		'load-cancelled' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+	}
+
+	# Models are empty until changeDir() is first called, so creating one
+	# doesn't touch the PVR or the disk
 	def __init__(self):
+		gtk.GenericTreeModel.__init__(self)
+		# Row references are kept alive by self.rows
+		self.set_property('leak-references', False)
+
 		self.current_dir = None
-		gtk.ListStore.__init__(self, gobject.TYPE_STRING, gobject.TYPE_STRING,
-		                             gobject.TYPE_STRING, gobject.TYPE_STRING,
-		                             gobject.TYPE_STRING)
+		self.back_history = []
+		self.forward_history = []
+
+		self.records = []
+		# Index in self.records of each row shown
+		self.order = []
+		# Row references handed to gtk, row n is self.rows[n]
+		self.rows = []
+		self.views = []
+
+		self.sort_column = FileSystemModel.NAME_COL
+		self.sort_order = gtk.SORT_ASCENDING
+		self.show_hidden = False
+
+		# Rows are added unsorted while loading and sorted once at the end
+		self.unsorted = False
+		self.connect('load-finished', self.on_load_finished)
+		self.connect('load-cancelled', self.on_load_cancelled)
 
 	def getCWD(self):
 		return self.current_dir
-	
-	def sort_func(self, model, iter1, iter2, col=None):
-		type1 = model.get_value(iter1, FileSystemModel.TYPE_COL)
-		type2 = model.get_value(iter2, FileSystemModel.TYPE_COL)
-		
-		if type1 == type2:
-			if col == FileSystemModel.NAME_COL:
-				return self.string_sort_func(model, iter1, iter2, col)
-			elif col == FileSystemModel.DATE_COL:
-				return self.date_sort_func(model, iter1, iter2, col)
-			elif col == FileSystemModel.SIZE_COL:
-				return self.size_sort_func(model, iter1, iter2, col)
-			else:
-				# FIXME: Raise exception here
-				print "ERROR: Unknown column type: ", col
-				return 0
-		elif type1 == 'f' and type2 == 'd':
-			return 1
-		else:
-			return -1
-	
-	def string_sort_func(self, model, iter1, iter2, col=None):
-		string1 = string.lower(model.get_value(iter1, col))
-		string2 = string.lower(model.get_value(iter2, col))
-
-		if string1 == string2:
-			return 0;
-		elif string1 < string2:
-			return -1
-		else:
-			return 1
-
-	def date_sort_func(self, model, iter1, iter2, col=None):
-		# Date column is empty for '..' directory
-		date1_str = model.get_value(iter1, col)
-		if len(date1_str) == 0:
-			return -1
-		
-		date2_str = model.get_value(iter2, col)
-		if len(date2_str) == 0:
-			return 1
-
-		format = '%a %b %d %Y'
-		date1 = time.strptime(date1_str, format)
-		date2 = time.strptime(date2_str, format)
-
-		if date1 == date2:
-			return self.string_sort_func(model, iter1, iter2, FileSystemModel.NAME_COL);
-		elif date1 < date2:
-			return -1
-		else:
-			return 1
 
-	def size_sort_func(self, model, iter1, iter2, col=None):
-		size1 = model.get_value(iter1, col).split()
-		size2 = model.get_value(iter2, col).split()
+	def isLoading(self):
+		return False
 
-		size1_len = len(size1)
-		size2_len = len(size2)
-		
-		if size1_len < size2_len:
-			return -1
-		elif size1_len > size2_len:
-			return 1
-		else:
-			return 0
+	def addHistory(self, old_dir):
+		if old_dir and old_dir != self.current_dir:
+			self.back_history.append(old_dir)
+			self.forward_history = []
 
-		unit_weight = { 'B' : 1, 'KB' : 2, 'MB' : 3, 'GB' : 4 }
+	def goBack(self):
+		if len(self.back_history) == 0:
+			return
 
-		# Sizes in bytes may not have 'B' unit postfix
-		if len(size1) < 2:
-			size1[1] = unit_weight['B']
-		else:
-			size1[1] = unit_weight[size1[1]]
+		self.forward_history.append(self.current_dir)
+		self.changeDir(self.back_history.pop(), history=False)
 
-		return 1
-		# Sizes in bytes may not have 'B' unit appended
-		if len(size2) < 2:
-			size2[1] = unit_weight['B']
-		else:
-			size2[1] = unit_weight[size2[1]]
-			
-		if size1[1] == size2[1]:
-			size1[0] = float(size1[0])
-			size2[0] = float(size2[0])
-			if size1[0] == size2[0]:
-				return self.string_sort_func(model, iter1, iter2, FileSystemModel.NAME_COL);
-			elif size1[0] < size2[0]:
-				return -1
+	def goForward(self):
+		if len(self.forward_history) == 0:
+			return
+
+		self.back_history.append(self.current_dir)
+		self.changeDir(self.forward_history.pop(), history=False)
+
+	def addView(self, treeview):
+		self.views.append(treeview)
+		treeview.set_model(self)
+
+	def getSortColumn(self):
+		return self.sort_column, self.sort_order
+
+	# column is NAME_COL, DATE_COL or SIZE_COL
+	def setSortColumn(self, column, order=gtk.SORT_ASCENDING):
+		self.sort_column = column
+		self.sort_order = order
+		self._reset(self._sort)
+
+	def setShowHidden(self, show_hidden):
+		self.show_hidden = show_hidden
+		self._reset(self._filter)
+
+	def clearEntries(self):
+		self._reset(self._clear)
+
+	# Replace the rows with entries, a list of puppy.ListEntry
+	def setEntries(self, entries):
+		self._reset(self._setEntries, entries)
+
+	# Add entries after the rows already shown, unsorted
+	def appendEntries(self, entries):
+		start = len(self.records)
+		self.records.extend(entries)
+
+		for index in xrange(start, len(self.records)):
+			if not self._isVisible(self.records[index]):
+				continue
+
+			row = len(self.order)
+			self.unsorted = True
+			self.order.append(index)
+			self.rows.append(row)
+			path = (row,)
+			self.row_inserted(path, self.get_iter(path))
+
+	# Replace the rows with entries, a list of puppy.ListEntry, deleting and
+	# inserting only the rows whose entry has gone, changed or is new so that
+	# the views keep their place and selection
+	def updateEntries(self, entries):
+		old = {}
+		for index in xrange(len(self.records)):
+			old[self.records[index].name] = index
+
+		# Indexes in self.records of the entries which haven't changed
+		kept = {}
+		added = []
+		for entry in entries:
+			index = old.get(entry.name)
+			if index != None:
+				record = self.records[index]
+				if (record.type, record.size, record.mtime) == (entry.type, entry.size, entry.mtime):
+					kept[index] = True
+					continue
+			added.append(entry)
+
+		if len(added) == 0 and len(kept) == len(self.records):
+			return
+		if len(added) > MAX_ROW_UPDATES:
+			self.clearEntries()
+			self.setEntries(entries)
+			return
+
+		# Last first so the paths of the rows before stay valid
+		for row in xrange(len(self.order) - 1, -1, -1):
+			if not kept.has_key(self.order[row]):
+				del self.order[row]
+				self.rows.pop()
+				self.row_deleted((row,))
+
+		records = []
+		new_indexes = {}
+		for index in xrange(len(self.records)):
+			if kept.has_key(index):
+				new_indexes[index] = len(records)
+				records.append(self.records[index])
+		start = len(records)
+		records.extend(added)
+		self.records = records
+		order = [ new_indexes[index] for index in self.order ]
+
+		# Insert the new rows where sorting would put them
+		self._filter()
+		sorted_order = self.order
+		self.order = order
+		if [ index for index in sorted_order if index < start ] != order:
+			# Rows which sort the same are in another order
+			self._reset(self._filter)
+			return
+
+		for row in xrange(len(sorted_order)):
+			if sorted_order[row] >= start:
+				self.order.insert(row, sorted_order[row])
+				self.rows.append(len(self.rows))
+				path = (row,)
+				self.row_inserted(path, self.get_iter(path))
+
+	def on_load_finished(self, model, error):
+		if self.unsorted:
+			self._reset(self._sort)
+
+	def on_load_cancelled(self, model):
+		if self.unsorted:
+			self._reset(self._sort)
+
+	def _isVisible(self, record):
+		return self.show_hidden or not record.name.startswith('.') or record.name == '..'
+
+	def _clear(self):
+		self.records = []
+		self.order = []
+
+	def _setEntries(self, entries):
+		self.records = entries[:]
+		self._filter()
+
+	def _filter(self):
+		self.order = [ index for index in xrange(len(self.records))
+		               if self._isVisible(self.records[index]) ]
+		self._sort()
+
+	# The parent directory comes first, then directories and then files, each
+	# sorted on the sort column and then by name
+	def _sort(self):
+		records = self.records
+		parent = []
+		dirs = []
+		files = []
+		for index in self.order:
+			record = records[index]
+			if record.name == '..':
+				parent.append(index)
+			elif record.type == 'd':
+				dirs.append(index)
 			else:
-				return 1
-		elif size1[1] < size2[1]:
-			return -1
-		else:
-			return 1
+				files.append(index)
 
+		if self.sort_column == FileSystemModel.DATE_COL:
+			key = lambda index: (records[index].mtime, records[index].name.lower())
+		elif self.sort_column == FileSystemModel.SIZE_COL:
+			key = lambda index: (records[index].size, records[index].name.lower())
+		else:
+			key = lambda index: records[index].name.lower()
+
+		reverse = self.sort_order == gtk.SORT_DESCENDING
+		dirs.sort(key=key, reverse=reverse)
+		files.sort(key=key, reverse=reverse)
+		self.order = parent + dirs + files
+		self.unsorted = False
+
+	# Make a change to many rows with the model taken away from the views.
+	# Selected rows stay selected.
+	def _reset(self, func, *args):
+		selected = []
+		for treeview in self.views:
+			model, paths = treeview.get_selection().get_selected_rows()
+			selected.append([ self.order[path[0]] for path in paths ])
+			treeview.set_model(None)
+
+		func(*args)
+		self.rows = range(len(self.order))
+
+		rows = None
+		for treeview, indexes in zip(self.views, selected):
+			treeview.set_model(self)
+			if len(indexes) == 0:
+				continue
+
+			if rows == None:
+				rows = {}
+				for row in self.rows:
+					rows[self.order[row]] = row
+			selection = treeview.get_selection()
+			for index in indexes:
+				if rows.has_key(index):
+					selection.select_path((rows[index],))
+
+	def on_get_flags(self):
+		return gtk.TREE_MODEL_LIST_ONLY
+
+	def on_get_n_columns(self):
+		return len(FileSystemModel.COLUMN_TYPES)
+
+	def on_get_column_type(self, column):
+		return FileSystemModel.COLUMN_TYPES[column]
+
+	def on_get_iter(self, path):
+		if path[0] < len(self.rows):
+			return self.rows[path[0]]
+		return None
+
+	def on_get_path(self, row):
+		return (row,)
+
+	def on_get_value(self, row, column):
+		record = self.records[self.order[row]]
+		if column == FileSystemModel.NAME_COL:
+			return record.name
+		elif column == FileSystemModel.TYPE_COL:
+			return record.type
+		elif column == FileSystemModel.ICON_COL:
+			# TODO: Set icon based on file type. Use dummy icon for now
+			if record.type == 'd':
+				return gtk.STOCK_DIRECTORY
+			return gtk.STOCK_FILE
+		elif column == FileSystemModel.DATE_COL:
+			if record.name == '..':
+				return ''
+			return formatDate(record.mtime)
+		elif column == FileSystemModel.SIZE_COL:
+			if record.type == 'd':
+				return ''
+			return humanReadableSize(record.size)
+		elif column == FileSystemModel.MTIME_COL:
+			return record.mtime
+		elif column == FileSystemModel.BYTES_COL:
+			return record.size
+
+	def on_iter_next(self, row):
+		if row + 1 < len(self.rows):
+			return self.rows[row + 1]
+		return None
+
+	def on_iter_children(self, row):
+		if row == None and len(self.rows) > 0:
+			return self.rows[0]
+		return None
+
+	def on_iter_has_child(self, row):
+		return False
+
+	def on_iter_n_children(self, row):
+		if row == None:
+			return len(self.rows)
+		return 0
+
+	def on_iter_nth_child(self, row, n):
+		if row == None and n < len(self.rows):
+			return self.rows[n]
+		return None
+
+	def on_iter_parent(self, row):
+		return None
+
+gobject.type_register(FileSystemModel)
 
 class PVRFileSystemModel(FileSystemModel):
 	dir_sep = '\\'
-	def __init__(self):
+	# listing_cache is a puppy.ListingCache shared with the Puppy object used
+	# for transfers so that uploads invalidate our listings. dir is the
+	# directory to start in and snapshot an earlier listing of it, shown until
+	# changeDir() lists it again.
+	def __init__(self, listing_cache=None, dir='', snapshot=None):
 		FileSystemModel.__init__(self)
 
-		# FIXME: Get dir from when Guppy last exited
-		self.current_dir = ''
-		
-		self.puppy = puppy.Puppy()
+		self.current_dir = dir
 		
-		self.changeDir()
-
-
-	def changeDir(self, dir=None):
-		if len(self) > 0:
-			self.clear()
+		self.puppy = puppy.Puppy(listing_cache)
+		self.entries = []
+		self.listing = None
+		self.listing_watch_id = None
+		# True once a listing has finished without an error
+		self.connected = False
+		# True while the directory shown is being listed again
+		self.refreshing = False
+		# True once the listing of the directory shown has finished, not
+		# when it was cancelled or failed
+		self.complete = False
+
+		if snapshot != None:
+			self.entries = snapshot
+			self.setEntries(snapshot)
+
+	def changeDir(self, dir=None, history=True):
+		self.cancelListing()
 			
 		if dir:
 			if dir[0] != '\\':
@@ -208,38 +459,105 @@ class PVRFileSystemModel(FileSystemModel):
 		else:
 			dir = self.current_dir
 
-		norm_path = os.path.normpath(dir.replace('\\', '/'))
-		if norm_path != '.':
-			self.current_dir = norm_path.replace('/', '\\')
-		else:
-			self.current_dir = '\\'
+		old_dir = self.current_dir
+		self.current_dir = puppy.normPath(dir)
+		if history:
+			self.addHistory(old_dir)
+
+		# The rows of a directory listed again stay until the listing is
+		# complete and then only those which changed are replaced
+		self.refreshing = self.current_dir == old_dir and len(self.records) > 0
+		if not self.refreshing:
+			self.clearEntries()
+			self.entries = []
+
+		self.complete = False
+		self.emit('load-started')
+
+		pvr_files = self.puppy.getCachedDir(self.current_dir)
+		if pvr_files != None:
+			self.entries = pvr_files
+			if self.refreshing:
+				self.updateEntries(pvr_files)
+			else:
+				self.setEntries(pvr_files)
+			self.complete = True
+			self.emit('load-finished', None)
+			return
 
-		pvr_files = self.puppy.listDir(self.current_dir)
+		# Rows are added as puppy prints them so the UI doesn't wait for the
+		# PVR
+		try:
+			self.listing = self.puppy.startListDir(self.current_dir)
+		except puppy.PuppyError, e:
+			self.listingFailed(e.value)
+			return
+		self.listing_watch_id = gobject.io_add_watch(self.listing.fileno(),
+		                                             gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+		                                             self.on_listing_output)
 
-		for file in pvr_files:
-			# TODO: Set icon based on file type. Use dummy icon for now
-			if file[FileSystemModel.TYPE_COL] == 'd':
-				file.insert(FileSystemModel.ICON_COL, gtk.STOCK_DIRECTORY)
-			else:				
-				file.insert(FileSystemModel.ICON_COL, gtk.STOCK_FILE)
-				
-			file[FileSystemModel.SIZE_COL] = humanReadableSize(int(file[FileSystemModel.SIZE_COL]))
-			self.append(file)
-	
-	def freeSpace(self):
-		total, free = self.puppy.getDiskSpace()
-		return humanReadableSize(free)
+	# Stop listing a directory we have navigated away from
+	def cancelListing(self):
+		if self.listing == None:
+			return
+
+		gobject.source_remove(self.listing_watch_id)
+		self.listing.cancel()
+		self.listing = None
+		self.emit('load-cancelled')
+
+	def isLoading(self):
+		return self.listing != None
+
+	# Returns the entries of the current directory as returned by
+	# Puppy.listDir()
+	def getListing(self):
+		return self.entries
+
+	def listingFailed(self, error):
+		# Rows kept while refreshing may no longer be there
+		if self.refreshing:
+			self.clearEntries()
+			self.entries = []
+
+		self.emit('load-finished', error)
+
+	def on_listing_output(self, source, condition):
+		entries = self.listing.read()
+		if not self.refreshing:
+			self.appendEntries(entries)
+		if not self.listing.eof:
+			return True
+
+		try:
+			self.entries = self.listing.finish()
+		except puppy.PuppyError, e:
+			self.listing = None
+			self.listingFailed(e.value)
+			return False
+
+		self.listing = None
+		self.connected = True
+		self.complete = True
+		if self.refreshing:
+			self.updateEntries(self.entries)
+		self.emit('load-finished', None)
+		return False
 
 class PCFileSystemModel(FileSystemModel):
-	def __init__(self):
+	# dir is the directory to start in, the home directory if it is None or
+	# no longer exists
+	def __init__(self, dir=None):
 		FileSystemModel.__init__(self)
 		
-		# FIXME: Get dir from when Guppy last exited
-		self.current_dir = os.environ['HOME']
-		
-		self.changeDir()
-		
-	def changeDir(self, dir=None):
+		if dir == None or not os.path.isdir(dir):
+			dir = os.environ['HOME']
+		self.current_dir = dir
+		self.load_id = None
+		self.pending_files = []
+		self.pending_index = 0
+
+	def changeDir(self, dir=None, history=True):
 		if dir:
 			if dir[0] != '/':
 				dir = self.current_dir + '/' + dir
@@ -251,47 +569,99 @@ class PCFileSystemModel(FileSystemModel):
 		if not os.access(dir, os.F_OK):
 			return
 
+		old_dir = self.current_dir
 		self.current_dir = dir
+		if history:
+			self.addHistory(old_dir)
 			
-		if len(self) > 0:
-			self.clear()
+		self.cancelLoad()
+		self.clearEntries()
+		self.emit('load-started')
 		
 		# Parent directory
-		self.append(['d', gtk.STOCK_DIRECTORY, '..', '', ''])
+		self.appendEntries([ puppy.ListEntry('d', 0, 0, '..') ])
 		
-		for file in os.listdir(self.current_dir):
-			mode = os.stat(self.current_dir + '/' + file)
+		self.pending_files = os.listdir(self.current_dir)
+		self.pending_index = 0
+
+		# Show the first entries straight away and add the rest when idle
+		if self.loadEntries():
+			self.load_id = gobject.idle_add(self.loadEntries)
+
+	def cancelLoad(self):
+		if self.load_id == None:
+			return
+
+		gobject.source_remove(self.load_id)
+		self.load_id = None
+		self.emit('load-finished', None)
+
+	def isLoading(self):
+		return self.load_id != None
+
+	# Add the next LOAD_CHUNK_SIZE pending entries. Returns True while there
+	# are entries left to add.
+	def loadEntries(self):
+		end = self.pending_index + LOAD_CHUNK_SIZE
+		entries = []
+		for file in self.pending_files[self.pending_index:end]:
+			path = self.current_dir + '/' + file
+			# Each entry is stat'ed once and everything is taken from that
+			try:
+				mode = os.stat(path)
+			except OSError:
+				# Dangling symlink
+				mode = os.lstat(path)
 
 			if stat.S_ISDIR(mode[stat.ST_MODE]):
-				type = 'd'
-				icon = gtk.STOCK_DIRECTORY
-				size = ''
+				entries.append(puppy.ListEntry('d', 0L, mode[stat.ST_MTIME], file))
 			else:
-				type = 'f'
-				icon = gtk.STOCK_FILE
-				size = humanReadableSize(mode[stat.ST_SIZE])
-			
-			mtime = time.strftime('%a %b %d %Y', time.localtime(mode[stat.ST_MTIME]))
-			entry = [ type, icon, file, mtime, size ]
-			self.append(entry)
-
-	def freeSpace(self):
-		cmd = 'df ' + self.current_dir
-		pipe = os.popen(cmd)
-
-		# Skip Headers
-		pipe.readline()
-		output = pipe.readline().split()
-
-		exit_stat = pipe.close()
-		if exit_stat != None and os.WEXITSTATUS(exit_stat) != 0:
-			# TODO: Raise exception
-			print "ERROR: Failed to get disk free space (`%s')" % (cmd)
-			return None
-		
-		# Multiple by 1024 to convert from kilobytes to bytes
-		return humanReadableSize(int(output[3])*1024)
-			
+				entries.append(puppy.ListEntry('f', mode[stat.ST_SIZE], mode[stat.ST_MTIME], file))
+
+		self.appendEntries(entries)
+
+		self.pending_index = end
+		if self.pending_index < len(self.pending_files):
+			return True
+
+		self.pending_files = []
+		self.load_id = None
+		self.emit('load-finished', None)
+		return False
+
+# Small line graph of the recent values of a transfer's rate
+class Sparkline(gtk.DrawingArea):
+	def __init__(self):
+		gtk.DrawingArea.__init__(self)
+		self.values = []
+		self.set_size_request(-1, 40)
+		self.connect('expose-event', self.on_expose_event)
+
+	def setValues(self, values):
+		self.values = values
+		self.queue_draw()
+
+	def on_expose_event(self, widget, event):
+		x, y, width, height = self.get_allocation()
+		gc = self.style.fg_gc[gtk.STATE_NORMAL]
+		self.window.draw_rectangle(self.style.base_gc[gtk.STATE_NORMAL], True, 0, 0, width, height)
+
+		# One point per pixel, newest on the right
+		values = self.values[-width:]
+		if len(values) < 2:
+			return False
+
+		top = max(values)
+		if top <= 0:
+			top = 1.0
+		step = float(width - 1) / (len(values) - 1)
+		points = []
+		for i in range(len(values)):
+			points.append((int(i * step), int((height - 1) * (1 - values[i] / top))))
+		self.window.draw_lines(gc, points)
+
+		return False
+
 class GuppyWindow:
 	def __init__(self):	
 		# Find out proper way to find glade files
@@ -311,11 +681,40 @@ class GuppyWindow:
 		window = self.glade_xml.get_widget('guppy_window')
 		window.add_accel_group(accelgroup)
 		
-		self.puppy = puppy.Puppy()
+		# Listings are shared between the PVR view and transfers so that our
+		# own changes to the PVR invalidate them
+		self.listing_cache = puppy.ListingCache()
+		self.puppy = puppy.Puppy(self.listing_cache)
 		
 		self.show_hidden = False
 
 		self.transfer_dialog = self.glade_xml.get_widget('transfer_dialog')
+
+		self.manifest = verify.Manifest()
+		self.transfer_queue = transfer.TransferQueue(self.puppy)
+		# Connected first so a job's metrics are up to date in our handlers
+		self.metrics_history = metrics.MetricsHistory()
+		self.metrics_recorder = metrics.MetricsRecorder(self.transfer_queue,
+		                                                self.metrics_history,
+		                                                self.puppy)
+		self.transfer_queue.connect('job-started', self.on_transfer_job_started)
+		self.transfer_queue.connect('job-progress', self.on_transfer_job_progress)
+		self.transfer_queue.connect('finished', self.on_transfer_finished)
+		self.batch_progress = transfer.BatchProgress(self.transfer_queue)
+		self.turbo_tuner = turbo.TurboTuner(self.transfer_queue, self.puppy,
+		                                    os.environ.get('GUPPY_BACKEND', 'puppy'))
+		self.transfer_queue.setTurboTuner(self.turbo_tuner)
+		# The latest progress of the running job, drawn by updateTransferDialog()
+		self.transfer_progress = None
+		self.progress_timeout_id = None
+		self.disk_usage = diskusage.DiskUsage(self.puppy, self.transfer_queue)
+		self.disk_usage.connect('changed', self.on_disk_usage_changed)
+		self.crawler_paused = False
+		# None until the PVR has answered or failed to answer a listing
+		self.pvr_connected = None
+		self.reconnect_id = None
+		# Seconds from starting to the window first being drawn
+		self.first_paint_time = None
 		
 		self.pvr_total_size_label = self.glade_xml.get_widget('pvr_total_size_label')
 		self.pvr_free_space_label = self.glade_xml.get_widget('pvr_free_space_label')
@@ -323,10 +722,24 @@ class GuppyWindow:
 		self.pc_total_size_label = self.glade_xml.get_widget('pc_total_size_label')
 		self.pc_free_space_label = self.glade_xml.get_widget('pc_free_space_label')
 	
-		self.pvr_model = PVRFileSystemModel()
-		self.pc_model = PCFileSystemModel()
+		# Start where the last session left off
+		self.session = session.Session()
+		self.pvr_model = PVRFileSystemModel(self.listing_cache, self.session.pvr_dir or '',
+		                                    self.session.getPVRListing())
+		self.pc_model = PCFileSystemModel(self.session.pc_dir)
+		for fs_model, sort in ((self.pvr_model, self.session.pvr_sort),
+		                       (self.pc_model, self.session.pc_sort)):
+			if sort != None:
+				fs_model.setSortColumn(*sort)
+		self.active_model = self.pvr_model
+
+		self.catalog = catalog.Catalog()
+		self.crawler = catalog.CatalogCrawler(self.catalog, puppy.Puppy())
+
+		self.scheduler = schedule.Scheduler(self.transfer_queue)
+		self.scheduler.connect('due', self.on_schedule_due)
+		gobject.timeout_add(schedule.CHECK_INTERVAL * 1000, self.scheduler.check)
 		
-		self.free_space_timeout_id = gobject.timeout_add(5000, self.update_free_space)
 		self.update_free_space()
 		
 	def initUIManager(self):
@@ -339,24 +752,38 @@ class GuppyWindow:
 		                         ('View', None, '_View'),
 		                         ('Transfer', None, '_Transfer'),
 		                         ('Help', None, '_Help'),
+		                         ('Back', gtk.STOCK_GO_BACK, '_Back', '<Alt>Left', 'Go to the previous location', self.on_back),
+		                         ('Forward', gtk.STOCK_GO_FORWARD, '_Forward', '<Alt>Right', 'Go to the next location', self.on_forward),
+		                         ('ExportHistory', gtk.STOCK_SAVE_AS, '_Export Transfer History...', None, 'Save the speed of past transfers as CSV or JSON', self.on_export_history),
+		                         ('Sync', gtk.STOCK_REFRESH, '_Sync', None, 'Download new and changed files from the PVR folder', self.on_sync),
+		                         ('ClearSchedule', gtk.STOCK_CLEAR, '_Clear Scheduled Transfers', None, 'Forget the transfers waiting for their time', self.on_clear_schedule),
                                  ('About', gtk.STOCK_ABOUT , '_About', None, None, self.on_about)])
 
 		# FIXME: Use a proper icon for Turbo button
 		actiongroup.add_toggle_actions([('Turbo', gtk.STOCK_EXECUTE, 'Tur_bo', None, 'Turbo Transfer', self.on_turbo_toggled),
-		                                ('ShowHidden', None, 'Show Hidden Files', None, 'Show hidden files', self.on_show_hidden_toggled)])
+		                                ('ShowHidden', None, 'Show Hidden Files', None, 'Show hidden files', self.on_show_hidden_toggled),
+		                                ('AutoTurbo', None, '_Automatic Turbo', None, 'Choose turbo mode from the speed of earlier transfers', self.on_auto_turbo_toggled),
+		                                ('Verify', None, '_Verify Downloads', None, 'Read back downloaded files and record their checksums', self.on_verify_toggled)])
 		                                
 		
 		self.uimanager.insert_action_group(actiongroup, 0)
 		
 		self.upload_actiongrp = gtk.ActionGroup('UploadAction')                                 
-		self.upload_actiongrp.add_actions([('Upload', gtk.STOCK_GO_BACK, '_Upload', None, 'Upload File', self.on_upload_btn_clicked)])
+		self.upload_actiongrp.add_actions([('Upload', gtk.STOCK_GO_BACK, '_Upload', None, 'Upload File', self.on_upload_btn_clicked),
+		                                   ('UploadLater', None, 'U_pload Later...', None, 'Upload File at a chosen time of day', self.on_upload_later)])
 		self.upload_actiongrp.set_sensitive(False)
 		self.uimanager.insert_action_group(self.upload_actiongrp, 1)
 
 		self.download_actiongrp = gtk.ActionGroup('DownloadAction')                                 
-		self.download_actiongrp.add_actions([('Download', gtk.STOCK_GO_FORWARD, '_Download', None, 'Download File', self.on_download_btn_clicked)])
+		self.download_actiongrp.add_actions([('Download', gtk.STOCK_GO_FORWARD, '_Download', None, 'Download File', self.on_download_btn_clicked),
+		                                     ('DownloadLater', None, 'D_ownload Later...', None, 'Download File at a chosen time of day', self.on_download_later)])
 		self.download_actiongrp.set_sensitive(False)
 		self.uimanager.insert_action_group(self.download_actiongrp, 2)
+
+		# The PVR can't be asked for its free space during a transfer
+		self.refresh_actiongrp = gtk.ActionGroup('RefreshAction')
+		self.refresh_actiongrp.add_actions([('RefreshFreeSpace', gtk.STOCK_REFRESH, '_Refresh Free Space', None, 'Ask the PVR how much space is free', self.on_refresh_free_space)])
+		self.uimanager.insert_action_group(self.refresh_actiongrp, 3)
 		
 		self.uimanager.add_ui_from_file('guppy-gtk.xml')
 		
@@ -378,16 +805,7 @@ class GuppyWindow:
 
 	def createFileTrees(self):	
 		self.pvr_treeview = self.glade_xml.get_widget('pvr_treeview')	
-		pvr_liststore = self.pvr_model.filter_new()
-		pvr_liststore.set_visible_func(self.hiddenFileFilter)
-		pvr_liststore = gtk.TreeModelSort(pvr_liststore)
-		self.pvr_liststore = pvr_liststore
-
 		self.pc_treeview = self.glade_xml.get_widget('pc_treeview')	
-		pc_liststore = self.pc_model.filter_new()
-		pc_liststore.set_visible_func(self.hiddenFileFilter)
-		pc_liststore = gtk.TreeModelSort(pc_liststore)
-		self.pc_liststore = pc_liststore
 		
 		self.pvr_path_entry = self.glade_xml.get_widget('pvr_path_entry')
 		self.pc_path_entry = self.glade_xml.get_widget('pc_path_entry')
@@ -398,18 +816,21 @@ class GuppyWindow:
 		self.pvr_path_entry.set_text(self.pvr_model.getCWD())
 		self.pc_path_entry.set_text(self.pc_model.getCWD())
 		
-		for treeview, liststore in (self.pvr_treeview, pvr_liststore), (self.pc_treeview, pc_liststore):
-			treeview.set_model(liststore)
-			fs_model = liststore.get_model().get_model()
-
-			sort_func = fs_model.sort_func
-			liststore.set_default_sort_func(sort_func, FileSystemModel.NAME_COL)
+		for treeview, fs_model in (self.pvr_treeview, self.pvr_model), (self.pc_treeview, self.pc_model):
+			fs_model.addView(treeview)
 
 			treeview.get_selection().set_mode(gtk.SELECTION_MULTIPLE)
 			
 			treeview.connect('row-activated', self.on_treeview_row_activated, fs_model)
+			treeview.connect('focus-in-event', self.on_treeview_focus_in, fs_model)
 			handler_id = treeview.get_selection().connect('changed', self.on_treeview_changed, fs_model)
 			treeview.set_data('changed_handler_id', handler_id)
+
+			fs_model.connect('load-started', self.on_model_load_started, treeview)
+			fs_model.connect('load-finished', self.on_model_load_finished, treeview)
+			fs_model.connect('load-cancelled', self.on_model_load_cancelled, treeview)
+			if fs_model.isLoading():
+				self.on_model_load_started(fs_model, treeview)
 			
 			text_cell = gtk.CellRendererText()
 			pixb_cell = gtk.CellRendererPixbuf()
@@ -419,45 +840,109 @@ class GuppyWindow:
 			col.pack_start(text_cell, True)
 			col.set_attributes(text_cell, text=FileSystemModel.NAME_COL)
 			col.set_attributes(pixb_cell, stock_id=FileSystemModel.ICON_COL)
-			col.set_clickable(True)
-			col.set_sort_indicator(True)
-			col.set_sort_column_id(FileSystemModel.NAME_COL)
 			treeview.append_column(col)
-			liststore.set_sort_func(FileSystemModel.NAME_COL, sort_func, FileSystemModel.NAME_COL)
-						
+			col.set_data('sort_column', FileSystemModel.NAME_COL)
+
 			col = gtk.TreeViewColumn(_('Date'), text_cell, text=FileSystemModel.DATE_COL)
-			col.set_clickable(True)
-			col.set_sort_indicator(True)
-			col.set_sort_column_id(FileSystemModel.DATE_COL)
 			treeview.append_column(col)
-			liststore.set_sort_func(FileSystemModel.DATE_COL, sort_func, FileSystemModel.DATE_COL)
-				
+			col.set_data('sort_column', FileSystemModel.DATE_COL)
+
 			col = gtk.TreeViewColumn(_('Size'), text_cell, text=FileSystemModel.SIZE_COL)
-			col.set_clickable(True)
-			col.set_sort_indicator(True)
-			col.set_sort_column_id(FileSystemModel.SIZE_COL)
 			treeview.append_column(col)
-			liststore.set_sort_func(FileSystemModel.SIZE_COL, sort_func, FileSystemModel.SIZE_COL)
+			col.set_data('sort_column', FileSystemModel.SIZE_COL)
+
+			# The model sorts itself, the columns only show how
+			sort_column, order = fs_model.getSortColumn()
+			for col in treeview.get_columns():
+				col.set_clickable(True)
+				col.connect('clicked', self.on_column_clicked, (treeview, fs_model))
+				if col.get_data('sort_column') == sort_column:
+					col.set_sort_indicator(True)
+					col.set_sort_order(order)
 
 	def createMenuBar(self, str1, str2, int1, int2, *args):
 		return self.uimanager.get_widget('/MenuBar')
 		
+	def createSparkline(self, str1, str2, int1, int2, *args):
+		self.sparkline = Sparkline()
+		self.sparkline.show()
+		return self.sparkline
+
 	def createToolbar(self, str1, str2, int1, int2, *args):
 		toolbar = self.uimanager.get_widget('/Toolbar')
 		toolbar.set_orientation(gtk.ORIENTATION_VERTICAL)
 		return toolbar
 			
-	def hiddenFileFilter(self, model, iter, data=None):
-		name = model.get_value(iter, FileSystemModel.NAME_COL)
-		if self.show_hidden == False and (name == None or (name[0] == '.' and name[1] != '.')):
-			return False
-		
-		return True
-	
+	def getTotalSizeLabel(self, fs_model):
+		if isinstance(fs_model, PCFileSystemModel):
+			return self.pc_total_size_label
+		else:
+			return self.pvr_total_size_label
+
+	# The window is shown before anything is listed. The PVR and the disk are
+	# only used once it has been drawn, by startUp().
 	def run(self):
 		self.createFileTrees()
+		window = self.glade_xml.get_widget('guppy_window')
+		self.expose_handler_id = window.connect_after('expose-event', self.on_first_expose)
 		gtk.main()
 
+	def startUp(self):
+		self.pc_model.changeDir()
+		self.pvr_model.changeDir()
+		# Transfers whose time has come while guppy wasn't running
+		self.scheduler.check()
+		return False
+
+	# The PVR has answered a listing, for the first time or after not being
+	# connected
+	def pvrConnected(self):
+		self.pvr_connected = True
+		if self.reconnect_id != None:
+			gobject.source_remove(self.reconnect_id)
+			self.reconnect_id = None
+
+		self.crawler.start()
+		# After the listing has been drawn
+		gobject.idle_add(self.refreshFreeSpace)
+
+	# Ask the PVR for its free space if it hasn't been asked or the answer is
+	# out of date. Returns False so it can be used as a gobject idle handler.
+	def refreshFreeSpace(self):
+		# Nothing to ask while the PVR isn't connected
+		if self.pvr_connected:
+			self.disk_usage.refreshIfStale()
+		return False
+
+	# Remember the folders and sorts of the panes and what is in the PVR
+	# folder for the next start
+	def saveSession(self):
+		pc_column, pc_order = self.pc_model.getSortColumn()
+		self.session.pc_dir = self.pc_model.getCWD()
+		self.session.pc_sort = (pc_column, int(pc_order))
+
+		pvr_column, pvr_order = self.pvr_model.getSortColumn()
+		self.session.pvr_sort = (pvr_column, int(pvr_order))
+		# What was known about the PVR last time is still the best guess
+		if self.pvr_connected:
+			self.session.pvr_dir = self.pvr_model.getCWD()
+			if self.pvr_model.isLoading():
+				self.session.setPVRListing(None)
+			else:
+				self.session.setPVRListing(self.pvr_model.getListing())
+
+		try:
+			self.session.save()
+		except (IOError, OSError):
+			# Starting from the defaults next time is no great loss
+			pass
+
+	def pvrNotConnected(self):
+		self.pvr_connected = False
+		if self.reconnect_id == None:
+			self.reconnect_id = gobject.timeout_add(RECONNECT_INTERVAL * 1000,
+			                                        self.on_reconnect_timeout)
+
 
 	def on_about(self, widget, data=None):	
 		dialog = gtk.AboutDialog()
@@ -468,59 +953,319 @@ class GuppyWindow:
 		dialog.set_license('GNU Public License')
 		dialog.show()
 	
+	def on_back(self, widget, data=None):
+		self.active_model.goBack()
+		self.updatePathEntry(self.active_model)
+
+	# Sort on the column clicked, or reverse the order if it is already
+	# sorted on it
 	def on_column_clicked(self, col, data):
-		order = col.get_sort_order()
-		print order
-		if order == gtk.SORT_ASCENDING:
-			print 'foo'
+		treeview, fs_model = data
+		column = col.get_data('sort_column')
+		old_column, order = fs_model.getSortColumn()
+		if column == old_column and order == gtk.SORT_ASCENDING:
 			order = gtk.SORT_DESCENDING
 		else:
-			print 'bar'
 			order = gtk.SORT_ASCENDING
 
+		for other_col in treeview.get_columns():
+			other_col.set_sort_indicator(other_col == col)
 		col.set_sort_order(order)
-		data[0].set_sort_column_id(data[1], order)
+
+		fs_model.setSortColumn(column, order)
 	
 	def on_download_btn_clicked(self, widget, data=None):
 		self.transferFile('download')
 
+	def on_download_later(self, widget, data=None):
+		self.transferFile('download', later=True)
+
+	def on_export_history(self, widget, data=None):
+		dialog = gtk.FileChooserDialog(_('Export Transfer History'), None,
+		                               gtk.FILE_CHOOSER_ACTION_SAVE,
+		                               (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+		                                gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+		dialog.set_current_name('guppy-history.csv')
+		for name, pattern in ((_('CSV files'), '*.csv'), (_('JSON files'), '*.json')):
+			filter = gtk.FileFilter()
+			filter.set_name(name)
+			filter.add_pattern(pattern)
+			dialog.add_filter(filter)
+
+		response = dialog.run()
+		filename = dialog.get_filename()
+		dialog.destroy()
+		if response != gtk.RESPONSE_OK or filename == None:
+			return
+
+		# The file name's extension picks the format
+		try:
+			file = open(filename, 'w')
+			try:
+				if filename.lower().endswith('.json'):
+					self.metrics_history.exportJSON(file)
+				else:
+					self.metrics_history.exportCSV(file, True)
+			finally:
+				file.close()
+		except IOError, error:
+			dialog = gtk.MessageDialog(type=gtk.MESSAGE_ERROR,
+			                           buttons=gtk.BUTTONS_OK,
+			                           message_format=error.strerror + ': ' + filename)
+			dialog.run()
+			dialog.destroy()
+
+	def on_forward(self, widget, data=None):
+		self.active_model.goForward()
+		self.updatePathEntry(self.active_model)
+
 	def on_guppy_window_delete_event(self, widget, event, data=None):
 		self.on_quit(widget, data)
 		
+	def on_model_load_finished(self, fs_model, error, treeview):
+		if treeview.window != None:
+			treeview.window.set_cursor(None)
+
+		if error != None:
+			msg = _('Failed to list directory')
+		else:
+			msg = ''
+
+		if fs_model == self.pvr_model:
+			if error == None:
+				# A cancelled listing would make the catalog forget the
+				# folder's contents
+				if fs_model.complete:
+					self.catalog.updateDir(fs_model.getCWD(), fs_model.getListing())
+				if fs_model.connected and not self.pvr_connected:
+					self.pvrConnected()
+			elif not self.pvr_connected:
+				# Until the PVR has answered, a failed listing means it
+				# isn't there
+				msg = _('PVR not connected')
+				self.pvrNotConnected()
+			self.crawler.resume()
+		else:
+			# The new folder may be on another file system
+			self.update_free_space()
+
+		self.getTotalSizeLabel(fs_model).set_text(msg)
+
+	# Moving to another folder cancels its listing and starts a new one
+	def on_model_load_cancelled(self, fs_model, treeview):
+		if treeview.window != None:
+			treeview.window.set_cursor(None)
+
+		if fs_model == self.pvr_model:
+			self.crawler.resume()
+
+		self.getTotalSizeLabel(fs_model).set_text('')
+
+	def on_model_load_started(self, fs_model, treeview):
+		# Leave the PVR to the listing the user is waiting for
+		if fs_model == self.pvr_model:
+			self.crawler.pause()
+			# Trying again quietly
+			if self.pvr_connected == False:
+				return
+
+		if treeview.window != None:
+			treeview.window.set_cursor(gtk.gdk.Cursor(gtk.gdk.WATCH))
+
+		self.getTotalSizeLabel(fs_model).set_text(_('Loading...'))
+
 	def on_path_entry_activate(self, widget, fs_model):
 		fs_model.changeDir(widget.get_text())
 		
+	def on_pvr_search_entry_activate(self, widget, data=None):
+		text = widget.get_text().strip()
+		if len(text) == 0:
+			return
+
+		results = self.catalog.search(text)
+		if len(results) == 0:
+			msg = _('No files matching') + ' "' + text + '" ' + _('were found on the PVR.')
+			if self.crawler.isRunning():
+				msg += '\n' + _('The PVR is still being indexed.')
+			dialog = gtk.MessageDialog(type=gtk.MESSAGE_INFO,
+			                           buttons=gtk.BUTTONS_OK,
+			                           message_format=msg)
+			dialog.run()
+			dialog.destroy()
+			return
+
+		self.showSearchResults(results)
+
 	def on_quit(self, widget, data=None):
+		self.crawler.stop()
+		self.catalog.save()
+		self.saveSession()
 		gtk.main_quit()
 		
+	def on_disk_usage_changed(self, disk_usage):
+		self.update_free_space()
+
+	def on_first_expose(self, widget, event):
+		widget.disconnect(self.expose_handler_id)
+
+		self.first_paint_time = time.time() - START_TIME
+		report = os.environ.get('GUPPY_STARTUP_TIME')
+		if report != None:
+			print >> sys.stderr, 'guppy: first paint after %.3f seconds' % self.first_paint_time
+			if report == 'exit':
+				gtk.main_quit()
+				return False
+
+		gobject.idle_add(self.startUp)
+		return False
+
+	def on_reconnect_timeout(self):
+		# The top of the PVR, in case the folder left in the last session
+		# has gone
+		if not self.pvr_model.isLoading():
+			self.pvr_model.changeDir('\\', history=False)
+		return True
+
+	def on_refresh_free_space(self, widget, data=None):
+		try:
+			self.disk_usage.refresh()
+		except puppy.PuppyError, error:
+			dialog = gtk.MessageDialog(type=gtk.MESSAGE_ERROR,
+			                           buttons=gtk.BUTTONS_OK,
+			                           message_format=_('Failed to get the free space on the PVR') + ':\n' + error.value)
+			dialog.run()
+			dialog.destroy()
+
 	def on_show_hidden_toggled(self, widget, data=None):
 		self.show_hidden = not self.show_hidden
-		self.pc_liststore.get_model().refilter()
-		self.pvr_liststore.get_model().refilter()
+		self.pc_model.setShowHidden(self.show_hidden)
+		self.pvr_model.setShowHidden(self.show_hidden)
+
+	# Mirror the PVR folder shown into the PC folder shown. Only the files in
+	# the folder itself are synced, guppy-cli.py can sync whole trees.
+	def on_sync(self, widget, data=None):
+		if self.pvr_model.isLoading() or self.pc_model.isLoading():
+			return
+
+		planner = sync.SyncPlanner(self.puppy, recursive=False, manifest=self.manifest)
+		plan = planner.planDir(self.pvr_model.getCWD(), self.pvr_model.getListing(),
+		                       self.pc_model.getCWD())
+
+		counts = sync.summarisePlan(plan)
+		if len(plan) == 0:
+			dialog = gtk.MessageDialog(type=gtk.MESSAGE_INFO,
+			                           buttons=gtk.BUTTONS_OK,
+			                           message_format=_('The PC folder is already in sync with the PVR folder.'))
+			dialog.run()
+			dialog.destroy()
+			return
+
+		msg = _('Download %(new)d new and %(changed)d changed files (%(size)s)?') % \
+		      { 'new' : counts['new'], 'changed' : counts['changed'],
+		        'size' : humanReadableSize(counts['bytes']) }
+		dialog = gtk.MessageDialog(type=gtk.MESSAGE_QUESTION,
+		                           buttons=gtk.BUTTONS_YES_NO,
+		                           message_format=msg)
+		response = dialog.run()
+		dialog.destroy()
+		if response != gtk.RESPONSE_YES:
+			return
+
+		try:
+			jobs = planner.execute(plan)
+		except OSError, error:
+			dialog = gtk.MessageDialog(type=gtk.MESSAGE_ERROR,
+			                           buttons=gtk.BUTTONS_OK,
+			                           message_format=error.strerror + ': ' + error.filename)
+			dialog.run()
+			dialog.destroy()
+			return
+
+		self.startTransfers(jobs, _('Downloading'))
 
 	def on_transfer_dialog_cancel_btn_clicked(self, widget, data=None):
-		self.transferDialogClose()
+		self.transfer_queue.cancelAll()
 		
 	def on_transfer_dialog_delete_event(self, widget, data=None):
-		self.transferDialogClose()
+		self.transfer_queue.cancelAll()
 		return True
 
+	def on_search_result_activated(self, treeview, path, col, dialog):
+		model = treeview.get_model()
+		dir = model.get_value(model.get_iter(path), 1)
+		dialog.destroy()
+
+		self.pvr_model.changeDir(dir)
+		self.updatePathEntry(self.pvr_model)
+
+	def on_transfer_finished(self, queue):
+		self.refresh_actiongrp.set_sensitive(True)
+		if self.crawler_paused:
+			self.crawler_paused = False
+			self.crawler.resume()
+
+		failed = []
+		skipped = 0
+		for job in queue.getJobs():
+			if job.state == 'failed':
+				failed.append(job.getName() + ': ' + job.error)
+			elif job.state == 'skipped':
+				skipped += 1
+		# Paused jobs stay for the scheduler to resume
+		queue.removeFinished()
+
+		self.transferDialogClose()
+
+		if len(failed) > 0:
+			msg = _('The following transfers failed:') + '\n' + '\n'.join(failed)
+			if skipped > 0:
+				msg += '\n\n' + str(skipped) + ' ' + _('files were already complete and were skipped.')
+			dialog = gtk.MessageDialog(type=gtk.MESSAGE_ERROR,
+			                           buttons=gtk.BUTTONS_OK,
+			                           message_format=msg)
+			dialog.run()
+			dialog.destroy()
+
+	# puppy prints progress several times a second, the dialog is redrawn
+	# every PROGRESS_FRAME_INTERVAL by updateTransferDialog()
+	def on_transfer_job_progress(self, queue, job, percent, speed, time):
+		self.transfer_progress = (job, percent, time)
+
+	def on_transfer_job_started(self, queue, job):
+		# Also started by the scheduler resuming jobs
+		self.refresh_actiongrp.set_sensitive(False)
+
+		progress_bar = self.glade_xml.get_widget('transfer_dialog_progressbar')
+		file_label = self.glade_xml.get_widget('transfer_dialog_file_label')
+		file_no_label = self.glade_xml.get_widget('transfer_dialog_file_no_label')
+		from_label = self.glade_xml.get_widget('transfer_dialog_from_label')
+		to_label = self.glade_xml.get_widget('transfer_dialog_to_label')
+
+		if job.direction == 'download':
+			src_dir = job.src[:job.src.rindex('\\')]
+			dst_dir = os.path.dirname(job.dst)
+		else:
+			src_dir = os.path.dirname(job.src)
+			dst_dir = job.dst[:job.dst.rindex('\\')]
+
+		files = [ queued for queued in queue.getJobs() if queued.type == 'f' ]
+		self.transfer_progress = None
+		progress_bar.set_fraction(0)
+		progress_bar.set_text('')
+		self.sparkline.setValues([])
+		file_label.set_text(job.getName())
+		from_label.set_text(src_dir)
+		to_label.set_text(dst_dir)
+		file_no_label.set_markup('<b>' + str(files.index(job) + 1) + ' ' + _('of') + ' ' + str(len(files)) + '</b>')
+
 	def on_treeview_changed(self, widget, fs_model):
 		model, files = widget.get_selected_rows()
 		
-		file_no = 1
-		file_count = len(files)
-		total_size = 0
-		for path in files:
-			iter = model.get_iter(path)
-			type = model.get_value(iter, FileSystemModel.TYPE_COL)
-			size = model.get_value(iter, FileSystemModel.SIZE_COL)
-			
-			if type != 'd':
-				total_size += convertToBytes(size)
-
-		if total_size > 0:
+		total_size, file_count, folder_count = self.getSelectionSize(fs_model, model, files)
+		if file_count + folder_count > 0:
 			msg = _('Selection Size') + ': ' + humanReadableSize(total_size)
+			if folder_count > 0:
+				msg += ' (' + str(folder_count) + ' ' + _('folders') + ')'
 		else:
 			msg = None
 		
@@ -539,6 +1284,32 @@ class GuppyWindow:
 				self.pvr_total_size_label.set_text('')
 				self.download_actiongrp.set_sensitive(False)
 		
+	# Returns the bytes, files and folders in the rows at paths. Folders on the
+	# PVR count the files the catalog knows are in them, local folders aren't
+	# walked and count nothing.
+	def getSelectionSize(self, fs_model, model, paths):
+		total_size = 0
+		file_count = 0
+		folder_count = 0
+		for path in paths:
+			iter = model.get_iter(path)
+			type = model.get_value(iter, FileSystemModel.TYPE_COL)
+			name = model.get_value(iter, FileSystemModel.NAME_COL)
+
+			if type != 'd':
+				file_count += 1
+				total_size += model.get_value(iter, FileSystemModel.BYTES_COL)
+			elif name != '..':
+				folder_count += 1
+				if isinstance(fs_model, PVRFileSystemModel):
+					total_size += self.catalog.getTreeSize(puppy.joinPath(fs_model.getCWD(), name))
+
+		return total_size, file_count, folder_count
+
+	def on_treeview_focus_in(self, widget, event, fs_model):
+		self.active_model = fs_model
+		return False
+
 	def on_treeview_row_activated(self, widget, path, col, fs_model):
 		model = widget.get_model()
 		iter = model.get_iter(path)
@@ -547,21 +1318,89 @@ class GuppyWindow:
 		
 		if type == 'd':
 			fs_model.changeDir(name)
-			path = fs_model.getCWD()
-			if isinstance(fs_model, PCFileSystemModel):
-				self.pc_path_entry.set_text(path)
-			else:
-				self.pvr_path_entry.set_text(path)
+			self.updatePathEntry(fs_model)
 			
 	def on_turbo_toggled(self, widget, data=None):
 		self.puppy.setTurbo(widget.get_active())
+
+	def on_auto_turbo_toggled(self, widget, data=None):
+		self.transfer_queue.setAutoTurbo(widget.get_active())
+		turbo_action = self.uimanager.get_action('/MenuBar/Transfer/Turbo')
+		turbo_action.set_sensitive(not widget.get_active())
+
+	def on_verify_toggled(self, widget, data=None):
+		if widget.get_active():
+			self.transfer_queue.setManifest(self.manifest)
+		else:
+			self.transfer_queue.setManifest(None)
 		
 	def on_upload_btn_clicked(self, widget, data=None):
 		self.transferFile('upload')
 
+	def on_upload_later(self, widget, data=None):
+		self.transferFile('upload', later=True)
+
+	def on_clear_schedule(self, widget, data=None):
+		count = len(self.scheduler.getTransfers())
+		if count == 0:
+			return
+
+		msg = _('Forget the %d transfers waiting for their time?') % count
+		dialog = gtk.MessageDialog(type=gtk.MESSAGE_QUESTION,
+		                           buttons=gtk.BUTTONS_YES_NO,
+		                           message_format=msg)
+		response = dialog.run()
+		dialog.destroy()
+		if response == gtk.RESPONSE_YES:
+			self.scheduler.clear()
+
+	def on_schedule_due(self, scheduler, jobs):
+		directions = [ job.direction for job in jobs ]
+		if 'upload' not in directions:
+			direction_text = _('Downloading')
+		elif 'download' not in directions:
+			direction_text = _('Uploading')
+		else:
+			direction_text = _('Transferring')
+
+		self.startTransfers(jobs, direction_text)
+
+	def showSearchResults(self, results):
+		dialog = gtk.Dialog(_('Search Results'), self.glade_xml.get_widget('guppy_window'), 0,
+		                    (gtk.STOCK_CLOSE, gtk.RESPONSE_CLOSE))
+		dialog.set_default_size(600, 300)
+		dialog.connect('response', lambda dialog, response: dialog.destroy())
+
+		store = gtk.ListStore(gobject.TYPE_STRING, gobject.TYPE_STRING,
+		                      gobject.TYPE_STRING, gobject.TYPE_STRING)
+		for dir, entry in results:
+			type, name, size, mtime = entry
+			if type == 'd':
+				size = ''
+			else:
+				size = humanReadableSize(size)
+			date = formatDate(mtime)
+			store.append([ name, dir, date, size ])
+
+		treeview = gtk.TreeView(store)
+		treeview.connect('row-activated', self.on_search_result_activated, dialog)
+		for title, col in (_('Name'), 0), (_('Location'), 1), (_('Date'), 2), (_('Size'), 3):
+			column = gtk.TreeViewColumn(title, gtk.CellRendererText(), text=col)
+			column.set_sort_column_id(col)
+			treeview.append_column(column)
+
+		scrolled_window = gtk.ScrolledWindow()
+		scrolled_window.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+		scrolled_window.set_shadow_type(gtk.SHADOW_IN)
+		scrolled_window.add(treeview)
+		dialog.vbox.pack_start(scrolled_window)
+		dialog.show_all()
+
 	def transferDialogClose(self):
-		self.puppy.cancelTransfer()
 		self.transfer_dialog.hide()
+		if self.progress_timeout_id != None:
+			gobject.source_remove(self.progress_timeout_id)
+			self.progress_timeout_id = None
 
 		# Update FileSystemModel view				
 		models = [ (self.pc_model, self.pc_treeview), (self.pvr_model, self.pvr_treeview) ]
@@ -572,23 +1411,27 @@ class GuppyWindow:
 			model.changeDir()
 			selection.handler_unblock(handler_id)
 	
-	def transferFile(self, direction):
+	# Transfer the selected files now, or if later is True when the time
+	# window chosen by the user opens
+	def transferFile(self, direction, later=False):
 		if direction == 'download':
+			fs_model = self.pvr_model
 			model, files = self.pvr_treeview.get_selection().get_selected_rows()
 			direction_text = _('Downloading')
-			selection_size = self.pvr_total_size_label.get_text().split(':')[1]
-			free_space = self.pc_model.freeSpace()
+			free_space = self.disk_usage.getLocalFree(self.pc_model.getCWD())
 		else:
+			fs_model = self.pc_model
 			model, files = self.pc_treeview.get_selection().get_selected_rows()
 			direction_text = _('Uploading')
-			selection_size = self.pc_total_size_label.get_text().split(':')[1]
-			free_space = self.pvr_model.freeSpace()
+			try:
+				free_space = self.disk_usage.getPVRFree()
+			except puppy.PuppyError:
+				free_space = None
 
 		# Check for enough free disk space
-		selection_size = convertToBytes(selection_size)
-		free_space = convertToBytes(free_space)
+		selection_size = self.getSelectionSize(fs_model, model, files)[0]
 
-		if selection_size > free_space:
+		if free_space != None and selection_size > free_space:
 			msg = _('Not enough disk space available on your')
 			if direction == 'download':
 				msg += ' ' + _('PC')
@@ -605,86 +1448,219 @@ class GuppyWindow:
 			if response == gtk.RESPONSE_NO or response == gtk.RESPONSE_DELETE_EVENT:
 				return
 		
-		# Stop free space update timer
-		gobject.source_remove(self.free_space_timeout_id)
-		
-		progress_bar = self.glade_xml.get_widget('transfer_dialog_progressbar')
-		file_label = self.glade_xml.get_widget('transfer_dialog_file_label')
-		file_no_label = self.glade_xml.get_widget('transfer_dialog_file_no_label')
-		from_label = self.glade_xml.get_widget('transfer_dialog_from_label')
-		to_label = self.glade_xml.get_widget('transfer_dialog_to_label')
-
-		dir_label = self.glade_xml.get_widget('transfer_dialog_direction_label1')
-		dir_label.set_markup('<b>' + direction_text + ' ' + _('File') + ':</b>')
-
-		dir_label = self.glade_xml.get_widget('transfer_dialog_direction_label2')
-		dir_label.set_markup('<b>' + direction_text + ':</b>')
+		if direction == 'download':
+			src_dir = self.pvr_model.getCWD()
+			dst_dir = self.pc_model.getCWD()
+		else:
+			src_dir = self.pc_model.getCWD()
+			dst_dir = self.pvr_model.getCWD()
 
-		self.transfer_dialog.show()
+		if direction == 'upload':
+			pvr_names = [ entry.name for entry in self.pvr_model.getListing() ]
 
-		file_count = len(files)
-		file_no = 1
+		jobs = []
+		existing = []
 		for path in files:
 			iter = model.get_iter(path)
+			type = model.get_value(iter, FileSystemModel.TYPE_COL)
 			file = model.get_value(iter, FileSystemModel.NAME_COL)
+			size = model.get_value(iter, FileSystemModel.BYTES_COL)
+			mtime = model.get_value(iter, FileSystemModel.MTIME_COL)
+			if file == '..':
+				continue
 
 			if direction == 'download':
-				src_dir = self.pvr_model.getCWD()
-				dst_dir = self.pc_model.getCWD()
 				src_file = src_dir + '\\' + file
 				dst_file = dst_dir + '/' + file
 			else:
-				src_dir = self.pc_model.getCWD()
-				dst_dir = self.pvr_model.getCWD()
 				src_file = src_dir + '/' + file
 				dst_file = dst_dir + '\\' + file
 
-			if os.access(dst_file, os.F_OK):
-				self.transfer_dialog.hide()
-				msg = _('The file') + ' "' + dst_file + '" ' + _('already exists. Would you like to replace it?')
-				msg2 = _('If you replace an existing file, its contents will be overwritten.')
-				dialog = gtk.MessageDialog(type=gtk.MESSAGE_QUESTION,
-				                           buttons=gtk.BUTTONS_YES_NO,
-				                           message_format=msg)
-				response = dialog.run()
-				dialog.destroy()
-
-				self.transfer_dialog.show()
+			if type == 'd':
+				# The queue lists the folder and transfers what is in it
+				job = transfer.TransferJob(src_file, dst_file, direction, type='d')
+			else:
+				job = transfer.TransferJob(src_file, dst_file, direction, size, mtime)
+			jobs.append(job)
 
-				if response == gtk.RESPONSE_NO or response == gtk.RESPONSE_DELETE_EVENT:
-					file_no += 1
-					continue
-	
+			# Complete files are skipped by the queue and partial downloads
+			# of the same file are replaced without asking. Files already
+			# in a folder that is there are covered by the same answer.
 			if direction == 'download':
-				self.puppy.getFile(src_file, dst_file)
+				if type == 'd':
+					there = os.path.isdir(dst_file)
+				else:
+					there = transfer.checkDestination(job) == 'exists'
 			else:
-				self.puppy.putFile(src_file, dst_file)
+				there = file in pvr_names
+			if there:
+				existing.append(dst_file)
+
+		# Ask about all files that would be replaced at once rather than
+		# stopping the batch for each one
+		if len(existing) > 0:
+			msg = _('The following files already exist. Would you like to replace them?') + '\n' + '\n'.join(existing)
+			msg2 = _('If you replace an existing file, its contents will be overwritten.')
+			dialog = gtk.MessageDialog(type=gtk.MESSAGE_QUESTION,
+			                           buttons=gtk.BUTTONS_YES_NO,
+			                           message_format=msg)
+			response = dialog.run()
+			dialog.destroy()
 
-			file_label.set_text(file)
-			from_label.set_text(src_dir)
-			to_label.set_text(dst_dir)
-			file_no_label.set_markup('<b>' + str(file_no) + ' ' + _('of') + ' ' + str(file_count) + '</b>')
+			if response == gtk.RESPONSE_NO or response == gtk.RESPONSE_DELETE_EVENT:
+				# Folders are still transferred, leaving out the files
+				# already in them
+				for job in jobs:
+					if job.type == 'd':
+						job.overwrite = False
+				jobs = [ job for job in jobs if job.type == 'd' or job.dst not in existing ]
+
+		if later:
+			self.scheduleTransfers(jobs)
+		else:
+			self.startTransfers(jobs, direction_text)
 
-			file_no += 1
+	# Ask when jobs may run and hand them to the scheduler
+	def scheduleTransfers(self, jobs):
+		if len(jobs) == 0:
+			return
 
-			percent, speed, time = self.puppy.getProgress()
-			while percent != None:
-				progress_bar.set_fraction(float(percent)/100)
-				progress_bar.set_text('(' + time['remaining'] + ' ' + _('Remaining') + ')')
-				while gtk.events_pending():
-					gtk.main_iteration()
-				percent, speed, time = self.puppy.getProgress()
-		
-		self.transferDialogClose()
+		dialog = gtk.Dialog(_('Transfer Later'), self.glade_xml.get_widget('guppy_window'),
+		                    gtk.DIALOG_MODAL,
+		                    (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL, gtk.STOCK_OK, gtk.RESPONSE_OK))
+
+		table = gtk.Table(4, 2)
+		table.set_border_width(6)
+		table.set_row_spacings(6)
+		table.set_col_spacings(6)
+
+		start_entry = gtk.Entry()
+		start_entry.set_text('01:00')
+		end_entry = gtk.Entry()
+		end_entry.set_text('06:00')
+		priority_spin = gtk.SpinButton(gtk.Adjustment(0, -10, 10, 1, 5, 0))
+		turbo_combo = gtk.combo_box_new_text()
+		turbo_policies = ('default', 'on', 'off', 'auto')
+		for text in (_('As set'), _('On'), _('Off'), _('Automatic')):
+			turbo_combo.append_text(text)
+		turbo_combo.set_active(0)
+
+		rows = ((_('Start after:'), start_entry), (_('Stop at:'), end_entry),
+		        (_('Priority:'), priority_spin), (_('Turbo:'), turbo_combo))
+		for row in range(len(rows)):
+			label = gtk.Label(rows[row][0])
+			label.set_alignment(0, 0.5)
+			table.attach(label, 0, 1, row, row + 1, gtk.FILL)
+			table.attach(rows[row][1], 1, 2, row, row + 1)
+
+		dialog.vbox.pack_start(table)
+		dialog.show_all()
+
+		while True:
+			response = dialog.run()
+			if response != gtk.RESPONSE_OK:
+				dialog.destroy()
+				return
+
+			try:
+				window = schedule.parseWindow(start_entry.get_text() + '-' + end_entry.get_text())
+				break
+			except schedule.ScheduleError, error:
+				error_dialog = gtk.MessageDialog(type=gtk.MESSAGE_ERROR,
+				                                 buttons=gtk.BUTTONS_OK,
+				                                 message_format=error.value)
+				error_dialog.run()
+				error_dialog.destroy()
+
+		turbo_policy = turbo_policies[turbo_combo.get_active()]
+		priority = priority_spin.get_value_as_int()
+		dialog.destroy()
+
+		for job in jobs:
+			self.scheduler.add(job, window, turbo_policy, priority)
+		self.scheduler.check()
+
+	def startTransfers(self, jobs, direction_text):
+		if len(jobs) == 0:
+			return
+
+		dir_label = self.glade_xml.get_widget('transfer_dialog_direction_label1')
+		dir_label.set_markup('<b>' + direction_text + ' ' + _('File') + ':</b>')
+
+		dir_label = self.glade_xml.get_widget('transfer_dialog_direction_label2')
+		dir_label.set_markup('<b>' + direction_text + ':</b>')
+
+		self.transfer_dialog.show()
+		if self.progress_timeout_id == None:
+			self.progress_timeout_id = gobject.timeout_add(PROGRESS_FRAME_INTERVAL,
+			                                               self.updateTransferDialog)
+		self.updateTransferDialog()
+
+		self.refresh_actiongrp.set_sensitive(False)
+
+		# The crawler mustn't compete with transfers for the PVR
+		if not self.crawler_paused:
+			self.crawler_paused = True
+			self.crawler.pause()
+
+		for job in jobs:
+			self.transfer_queue.add(job)
+		self.transfer_queue.start()
+
+	def updateTransferDialog(self):
+		if self.transfer_progress != None:
+			job, percent, time = self.transfer_progress
+			progress_bar = self.glade_xml.get_widget('transfer_dialog_progressbar')
+			progress_bar.set_fraction(float(percent)/100)
+			text = '(' + time['remaining'] + ' ' + _('Remaining') + ')'
+
+			job_metrics = self.metrics_recorder.getMetrics(job)
+			if job_metrics != None:
+				rates = job_metrics.getAverageRates()
+				if len(rates) > 0:
+					text += ' %.2f Mbits/s' % rates[-1]
+				self.sparkline.setValues(rates)
+			progress_bar.set_text(text)
+
+		summary = self.batch_progress.getSummary()
+		progress_bar = self.glade_xml.get_widget('transfer_dialog_total_progressbar')
+		if summary['bytes_total'] > 0:
+			progress_bar.set_fraction(min(float(summary['bytes_done']) / summary['bytes_total'], 1.0))
+		else:
+			progress_bar.set_fraction(0)
+
+		text = _('Total') + ': ' + humanReadableSize(summary['bytes_done']) + ' ' + \
+		       _('of') + ' ' + humanReadableSize(summary['bytes_total'])
+		if summary['rate'] != None:
+			text += ', %.2f Mbits/s' % (summary['rate'] * 8 / 1000000)
+		if summary['remaining'] != None:
+			text += ' (' + formatTime(summary['remaining']) + ' ' + _('Remaining') + ')'
+		progress_bar.set_text(text)
 
-		# Restart free space update timer
-		self.free_space_timeout_id = gobject.timeout_add(5000, self.update_free_space)
-		self.update_free_space()
-		
-	def update_free_space(self):		
-		self.pvr_free_space_label.set_text(_('Free Space') + ': ' + self.pvr_model.freeSpace())
-		self.pc_free_space_label.set_text(_('Free Space') + ': ' + self.pc_model.freeSpace())
 		return True
+
+	def updatePathEntry(self, fs_model):
+		path = fs_model.getCWD()
+		if isinstance(fs_model, PCFileSystemModel):
+			self.pc_path_entry.set_text(path)
+		else:
+			self.pvr_path_entry.set_text(path)
+
+	# Shows the free space already known, without asking the PVR
+	def update_free_space(self):
+		free = self.disk_usage.getKnownPVRFree()
+		if free == None:
+			free = _('Unknown')
+		else:
+			free = humanReadableSize(free)
+		self.pvr_free_space_label.set_text(_('Free Space') + ': ' + free)
+
+		free = self.disk_usage.getLocalFree(self.pc_model.getCWD())
+		if free == None:
+			free = _('Unknown')
+		else:
+			free = humanReadableSize(free)
+		self.pc_free_space_label.set_text(_('Free Space') + ': ' + free)
 		
 if __name__ == "__main__":
 	locale.setlocale(locale.LC_ALL, '')
@@ -692,5 +1668,8 @@ if __name__ == "__main__":
 	gettext.textdomain(APP_NAME)
 	gettext.install(APP_NAME, 'i18n', unicode=1)
 	
+	# The USB backend runs commands in a thread
+	gobject.threads_init()
+
 	guppy = GuppyWindow()
 	guppy.run()
@@ -0,0 +1,47 @@
+## jsonwriter.py - Write JSON without needing simplejson
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+def jsonString(value):
+	value = value.replace('\\', '\\\\').replace('"', '\\"')
+	chars = []
+	for char in value:
+		if ord(char) < 0x20:
+			chars.append('\\u%04x' % ord(char))
+		else:
+			chars.append(char)
+	return '"' + ''.join(chars) + '"'
+
+def jsonValue(value):
+	if value == None:
+		return 'null'
+	elif value is True:
+		return 'true'
+	elif value is False:
+		return 'false'
+	elif isinstance(value, (int, long)):
+		return str(value)
+	elif isinstance(value, float):
+		return repr(value)
+	elif isinstance(value, (list, tuple)):
+		return '[' + ', '.join([ jsonValue(item) for item in value ]) + ']'
+	elif isinstance(value, dict):
+		keys = value.keys()
+		keys.sort()
+		items = [ jsonString(str(key)) + ': ' + jsonValue(value[key]) for key in keys ]
+		return '{' + ', '.join(items) + '}'
+	else:
+		return jsonString(str(value))
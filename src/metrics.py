@@ -0,0 +1,263 @@
+## metrics.py - Record how fast transfers to and from the PVR run
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# Nothing here may import gtk, guppy-cli.py records transfers too.
+
+import time
+import csv
+import cPickle
+
+import config
+import jsonwriter
+
+# Bump when the format of the history file changes
+HISTORY_VERSION = 1
+
+# Number of transfers kept in the history
+HISTORY_SIZE = 200
+
+# Number of samples in the moving average rate
+AVERAGE_SAMPLES = 10
+
+SUMMARY_FIELDS = ('started', 'name', 'direction', 'size', 'turbo', 'state',
+                  'duration', 'rate', 'peak_rate', 'stalls', 'stall_time')
+
+SAMPLE_FIELDS = ('elapsed', 'percent', 'reported_rate', 'rate', 'average_rate')
+
+# Convert puppy's rate, e.g. ' 7.80 Mbits/s', to a float in Mbits/s
+def parseRate(speed):
+	try:
+		return float(speed.split()[0])
+	except (IndexError, ValueError):
+		return None
+
+# Convert puppy's HH:MM:SS times to seconds
+def parseTime(text):
+	seconds = 0
+	try:
+		for field in text.split(':'):
+			seconds = seconds * 60 + int(field)
+	except ValueError:
+		return None
+
+	return seconds
+
+# Time series of one transfer built from puppy's progress records. Each sample
+# is (elapsed seconds, percent, rate reported by puppy, rate since the last
+# sample, moving average rate), rates in Mbits/s. puppy's own rate is
+# averaged over the whole transfer so it hides stalls; the rate since the
+# last sample is worked out from the file size where it is known. A stall is
+# a run of samples where the percentage doesn't move.
+class TransferMetrics:
+	def __init__(self, job, turbo):
+		self.name = job.getName()
+		self.direction = job.direction
+		self.size = job.size
+		self.turbo = turbo
+		self.started = time.time()
+		self.duration = None
+		self.state = None
+
+		self.samples = []
+		self.stalls = 0
+		self.stall_time = 0
+		self.stalled = False
+
+	def addSample(self, percent, speed, times):
+		elapsed = parseTime(times['elapsed'])
+		reported_rate = parseRate(speed)
+		try:
+			percent = float(percent)
+		except ValueError:
+			return
+		if elapsed == None:
+			return
+
+		rate = reported_rate
+		if len(self.samples) > 0:
+			prev_elapsed, prev_percent = self.samples[-1][:2]
+			if elapsed <= prev_elapsed:
+				# puppy only counts whole seconds, wait for the clock to move
+				return
+
+			if percent <= prev_percent:
+				if not self.stalled:
+					self.stalls += 1
+					self.stalled = True
+				self.stall_time += elapsed - prev_elapsed
+			else:
+				self.stalled = False
+
+			if self.size != None:
+				bits = (percent - prev_percent) / 100 * self.size * 8
+				rate = bits / (elapsed - prev_elapsed) / 1000000
+
+		recent = [ sample[3] for sample in self.samples[-(AVERAGE_SAMPLES - 1):]
+		           if sample[3] != None ]
+		if rate != None:
+			recent.append(rate)
+		average_rate = None
+		if len(recent) > 0:
+			average_rate = sum(recent) / len(recent)
+
+		self.samples.append((elapsed, percent, reported_rate, rate, average_rate))
+
+	# The transfer has ended. Verifying the file afterwards isn't counted.
+	def stop(self):
+		if self.duration == None:
+			self.duration = time.time() - self.started
+
+	def finish(self, state):
+		self.state = state
+		self.stop()
+
+	def getAverageRates(self):
+		return [ sample[4] for sample in self.samples if sample[4] != None ]
+
+	def getSummary(self):
+		rate = None
+		if self.size != None and self.state == 'done' and self.duration > 0:
+			rate = self.size * 8 / self.duration / 1000000
+		rates = [ sample[3] for sample in self.samples if sample[3] != None ]
+		peak_rate = None
+		if len(rates) > 0:
+			peak_rate = max(rates)
+
+		return { 'started' : self.started, 'name' : self.name,
+		         'direction' : self.direction, 'size' : self.size,
+		         'turbo' : self.turbo, 'state' : self.state,
+		         'duration' : self.duration, 'rate' : rate,
+		         'peak_rate' : peak_rate, 'stalls' : self.stalls,
+		         'stall_time' : self.stall_time }
+
+# The most recent HISTORY_SIZE transfers, kept in a file in guppy's config
+# directory. Each transfer is stored as its summary dictionary with its
+# samples under 'samples'.
+class MetricsHistory:
+	def __init__(self, filename=None):
+		if filename == None:
+			filename = config.getConfigPath('history')
+		self.filename = filename
+
+		self.transfers = []
+		self.dirty = False
+
+		self.load()
+
+	def load(self):
+		try:
+			file = open(self.filename, 'rb')
+			try:
+				version, transfers = cPickle.load(file)
+			finally:
+				file.close()
+		except config.LOAD_ERRORS:
+			return
+
+		if version == HISTORY_VERSION:
+			self.transfers = transfers
+
+	def save(self):
+		if not self.dirty:
+			return
+
+		data = cPickle.dumps((HISTORY_VERSION, self.transfers), cPickle.HIGHEST_PROTOCOL)
+		config.writeFile(self.filename, data)
+		self.dirty = False
+
+	def add(self, metrics):
+		record = metrics.getSummary()
+		record['samples'] = metrics.samples
+		self.transfers.append(record)
+		del self.transfers[:-HISTORY_SIZE]
+		self.dirty = True
+
+	def getTransfers(self):
+		return self.transfers
+
+	# Write one row per transfer, or one row per sample if samples is True, to
+	# the file object out
+	def exportCSV(self, out, samples=False):
+		writer = csv.writer(out)
+		if samples:
+			writer.writerow(SUMMARY_FIELDS + SAMPLE_FIELDS)
+		else:
+			writer.writerow(SUMMARY_FIELDS)
+
+		for record in self.transfers:
+			row = [ record[field] for field in SUMMARY_FIELDS ]
+			if not samples:
+				writer.writerow(row)
+				continue
+			for sample in record['samples']:
+				writer.writerow(row + list(sample))
+
+	def exportJSON(self, out):
+		transfers = []
+		for record in self.transfers:
+			record = record.copy()
+			record['samples'] = [ dict(zip(SAMPLE_FIELDS, sample))
+			                      for sample in record['samples'] ]
+			transfers.append(record)
+
+		out.write(jsonwriter.jsonValue(transfers) + '\n')
+
+# Records every transfer run by a TransferQueue in a MetricsHistory
+class MetricsRecorder:
+	def __init__(self, queue, history, puppy_obj):
+		self.history = history
+		self.puppy = puppy_obj
+		self.current = {}
+
+		queue.connect('job-started', self.on_job_started)
+		queue.connect('job-progress', self.on_job_progress)
+		queue.connect('job-transferred', self.on_job_transferred)
+		queue.connect('job-finished', self.on_job_finished)
+		queue.connect('finished', self.on_finished)
+
+	# Returns the TransferMetrics of a job that is transferring, or None
+	def getMetrics(self, job):
+		return self.current.get(job)
+
+	def on_job_started(self, queue, job):
+		self.current[job] = TransferMetrics(job, self.puppy.turbo)
+
+	def on_job_progress(self, queue, job, percent, speed, times):
+		metrics = self.current.get(job)
+		if metrics != None:
+			metrics.addSample(percent, speed, times)
+
+	def on_job_transferred(self, queue, job):
+		metrics = self.current.get(job)
+		if metrics != None:
+			metrics.stop()
+
+	def on_job_finished(self, queue, job):
+		# Jobs which were skipped never started
+		if not self.current.has_key(job):
+			return
+
+		metrics = self.current.pop(job)
+		metrics.finish(job.state)
+		self.history.add(metrics)
+
+	def on_finished(self, queue):
+		try:
+			self.history.save()
+		except (IOError, OSError):
+			# Losing the history mustn't fail the transfers
+			pass
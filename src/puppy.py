@@ -16,27 +16,71 @@
 ## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
 
 import os
-import popen2
 import signal
+import fcntl
+import errno
+import time
+import re
 
-# Set to True for debug output
-DEBUG = False
+import backends
+
+# Number of bytes to read from puppy's output in one go
+READ_SIZE = 8192
+
+# Seconds a cached directory listing is used before asking the PVR again
+LISTING_CACHE_TTL = 300
+# Maximum number of directory listings to keep cached
+LISTING_CACHE_SIZE = 64
+
+# A line of 'puppy -c dir' output: type, size, the date as printed by ctime()
+# and the name, which may have runs of spaces of its own
+LIST_ENTRY_RE = re.compile(r'(\S) +(\d+) \w{3} (\w{3}) +(\d+) (\d+):(\d+):(\d+) (\d+) (.*?)\r?$')
+
+MONTHS = { 'Jan' : 1, 'Feb' : 2, 'Mar' : 3, 'Apr' : 4, 'May' : 5, 'Jun' : 6,
+           'Jul' : 7, 'Aug' : 8, 'Sep' : 9, 'Oct' : 10, 'Nov' : 11, 'Dec' : 12 }
+
+# Normalise a PVR path so that equivalent paths compare equal
+def normPath(path):
+	if path == None:
+		return '\\'
+
+	norm_path = os.path.normpath(path.replace('\\', '/'))
+	if norm_path == '.':
+		return '\\'
+	
+	norm_path = norm_path.replace('/', '\\')
+	if norm_path[0] != '\\':
+		norm_path = '\\' + norm_path
+
+	return norm_path
+
+def parentPath(path):
+	path = normPath(path)
+	return normPath(path[:path.rindex('\\')])
+
+def joinPath(dir, name):
+	dir = normPath(dir)
+	if dir == '\\':
+		return '\\' + name
+	return dir + '\\' + name
 
 class Puppy:
-	def __init__(self):
-		self.cmd = 'puppy'
+	# cache is an optional ListingCache which may be shared with other Puppy
+	# objects. backend runs the commands, backends.getDefaultBackend() if
+	# None. The default backend is only created by the first command, as the
+	# usb backend imports pyusb.
+	def __init__(self, cache=None, backend=None):
+		self.backend = backend
 		self.turbo = False
+		self.cache = cache
+		self.cancelled = False
 		
 	def cancelTransfer(self):
-		if self.getStatus(wait=False) == -1:
-			os.kill(self.popen_obj.pid, signal.SIGTERM)
-		
-		return
+		self.cancelled = True
+		self.popen_obj.cancel()
 
 	def getDiskSpace(self):		
-		args = '-c size'
-
-		output_file = self._execute(args)
+		output_file = self._execute('size')
 
 		output = output_file.readlines()
 		output_file.close()
@@ -66,57 +110,70 @@ class Puppy:
 
 		
 	def listDir(self, path=None):
-		args = '-c dir'
-		if path != None:
-			args += ' ' + path
-			
-		output_file = self._execute(args)
+		listing = self.getCachedDir(path)
+		if listing != None:
+			return listing
 
-		output = output_file.readlines()
-		output_file.close()
+		reader = self.startListDir(path)
+		reader.setBlocking(True)
+		reader.read()
+		return reader.finish()
+
+	# Returns the cached listing of path or None if it isn't cached
+	def getCachedDir(self, path=None):
+		if self.cache == None:
+			return None
 		
-		listing = []
-		# Parse output of output_file and return it as a list
-		for line in output:
-			entry = line.split()
-			space = ' '
-			item = [ entry[0], space.join(entry[7:]),
-			         "%s %s %s %s" % (entry[2], entry[3], entry[4], entry[6]),
-			         entry[1] ]
-			listing.append(item)
-			
-		if self.getStatus() != 0:
-			raise PuppyError("listDir failed. puppy returned: " + str(output))
+		return self.cache.get(path)
 		
-		return listing
+	# Start listing path without waiting for puppy. Entries are read as puppy
+	# prints them using the ListingReader returned.
+	def startListDir(self, path=None):
+		args = []
+		if path != None:
+			args.append(path)
+			
+		output_file = self._execute('dir', args)
+
+		return ListingReader(output_file, self.popen_obj, path, self.cache)
 		
 		# FIXME: Can getFile() be merged with putFile()
 	def getFile(self, src_file, dest_file=None):
-		args = '-c get' + ' "' + src_file + '"'
+		args = [ src_file ]
 		if dest_file != None:
-			args += ' "' + dest_file + '"'
+			args.append(dest_file)
 		else:
-			args += ' "' + os.path.basename(src_file) + '"'
+			args.append(os.path.basename(src_file))
 			
-		self.progress_output = self._execute(args)
+		self.progress_output = self._execute('get', args)
+		self.progress_reader = ProgressReader(self.progress_output)
 		
 		return
 
 	def putFile(self, src_file, dest_file=None):
-		args = '-c put' + ' "' + src_file + '"'
+		args = [ src_file ]
 		if dest_file != None:
-			args += ' "' + dest_file + '"'
+			args.append(dest_file)
 		else:
-			args += ' "' + os.path.basename(src_file) + '"'
+			args.append(os.path.basename(src_file))
+
+		if self.cache != None:
+			if dest_file != None:
+				self.cache.invalidate(parentPath(dest_file))
+			else:
+				# puppy puts the file in the PVR's root directory
+				self.cache.invalidate(None)
 			
-		self.progress_output = self._execute(args)
+		self.progress_output = self._execute('put', args)
+		self.progress_reader = ProgressReader(self.progress_output)
 		
 		return
 
 	def makeDir(self, dirname):
-		args = '-c mkdir' + ' ' + dirname
+		if self.cache != None:
+			self.cache.invalidate(parentPath(dirname))
 			
-		output_file = self._execute(args)
+		output_file = self._execute('mkdir', [ dirname ])
 
 		output = output_file.readlines()
 		output_file.close()
@@ -129,9 +186,12 @@ class Puppy:
 		return
 
 	def rename(self, old_name, new_name):
-		args = '-c rename' + ' ' + old_name + ' ' + new_name
+		if self.cache != None:
+			self.cache.invalidateTree(old_name)
+			self.cache.invalidate(parentPath(old_name))
+			self.cache.invalidate(parentPath(new_name))
 			
-		output_file = self._execute(args)
+		output_file = self._execute('rename', [ old_name, new_name ])
 
 		output = output_file.readlines()
 		output_file.close()
@@ -144,9 +204,11 @@ class Puppy:
 		return
 
 	def delete(self, filename):
-		args = '-c delete' + ' ' + filename
+		if self.cache != None:
+			self.cache.invalidateTree(filename)
+			self.cache.invalidate(parentPath(filename))
 			
-		output_file = self._execute(args)
+		output_file = self._execute('delete', [ filename ])
 
 		output = output_file.readlines()
 		output_file.close()
@@ -158,22 +220,32 @@ class Puppy:
 		
 		return
 
-	def getProgress(self):
-		exit_status = self.getStatus(wait=False)
-		if exit_status != -1:
-			if exit_status != 0 and exit_status != 15:
-				raise PuppyError("Transfer failed")
-			
-		# Move to first non \r character
-		char = self.progress_output.read(1)
-		while char == '\r':
-			char = self.progress_output.read(1)
+	# Read all progress output currently available without blocking. Returns
+	# False once puppy has finished the transfer.
+	def readProgress(self):
+		self.progress_reader.read()
+		if not self.progress_reader.eof:
+			return True
+
+		self.progress_output.close()
+		status = self.popen_obj.wait()
+		# puppy is killed with SIGTERM by cancelTransfer(). Killed by anything
+		# else, the file is incomplete.
+		if os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGTERM:
+			if self.cancelled:
+				return False
+			raise PuppyError("Transfer was killed")
+		if os.WEXITSTATUS(status) != 0:
+			raise PuppyError("Transfer failed")
+
+		return False
 
-		line = char
-		# Read all characters up to \r
-		while char != '\r' and char != '':
-			char = self.progress_output.read(1)
-			line += char
+	# Returns None, None, None if puppy has not printed a complete progress
+	# record since the last call
+	def getProgress(self):
+		line = self.progress_reader.takeRecord()
+		if line == None:
+			return None, None, None
 
 		tokens = line.split(',')
 		
@@ -190,6 +262,9 @@ class Puppy:
 		
 		return percent, speed, time
 
+	def getProgressFd(self):
+		return self.progress_reader.fileno()
+
 	def getStatus(self, wait=True):
 		if wait:
 			status = os.WEXITSTATUS(self.popen_obj.wait())
@@ -201,20 +276,227 @@ class Puppy:
 	def setTurbo(self, value):
 		self.turbo = value
 		
-	def _execute(self, args):
-		cmd = self.cmd
-		if self.turbo == True:
-			cmd += ' -t'
-		cmd += ' ' + args
-		
-		if DEBUG:
-			print 'cmd = ', cmd
-		
-		self.popen_obj = popen2.Popen4(cmd)
-		self.popen_obj.tochild.close()
+	def _execute(self, command, args=()):
+		if self.backend == None:
+			try:
+				self.backend = backends.getDefaultBackend()
+			except backends.TransportError, e:
+				raise PuppyError(e.value)
+		self.popen_obj = self.backend.execute(command, args, self.turbo == True)
+		self.cancelled = False
 		
 		return self.popen_obj.fromchild
 
+# Non-blocking reader for the \r separated progress records puppy prints
+# during a transfer. Only the newest complete record is kept.
+class ProgressReader:
+	def __init__(self, pipe):
+		self.fd = pipe.fileno()
+		flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+		fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+		self.buffer = ''
+		self.record = None
+		self.eof = False
+
+	def fileno(self):
+		return self.fd
+
+	def read(self):
+		while not self.eof:
+			try:
+				data = os.read(self.fd, READ_SIZE)
+			except OSError, e:
+				if e.errno == errno.EAGAIN:
+					break
+				elif e.errno == errno.EINTR:
+					continue
+				raise
+
+			if len(data) == 0:
+				# Whatever follows the last \r is complete once puppy exits
+				self.eof = True
+				data = '\r'
+
+			records = (self.buffer + data).split('\r')
+			self.buffer = records.pop()
+			
+			records.reverse()
+			for record in records:
+				record = record.strip()
+				if len(record) > 0:
+					self.record = record
+					break
+
+	def takeRecord(self):
+		record = self.record
+		self.record = None
+		return record
+
+# An entry of a PVR directory listing. type is 'd' or 'f', size is in bytes
+# and mtime in seconds since the epoch. Entries are shared between listings
+# and the ListingCache so they mustn't be changed.
+class ListEntry(object):
+	__slots__ = ('type', 'size', 'mtime', 'name')
+
+	def __init__(self, type, size, mtime, name):
+		self.type = type
+		self.size = size
+		self.mtime = mtime
+		self.name = name
+
+	def __repr__(self):
+		return 'ListEntry(%r, %r, %r, %r)' % (self.type, self.size, self.mtime, self.name)
+
+# Parse a line of 'puppy -c dir' output into a ListEntry. Returns None if the
+# line is not a directory entry.
+def parseListEntry(line):
+	match = LIST_ENTRY_RE.match(line)
+	if match == None:
+		return None
+
+	type, size, month, day, hour, minute, second, year, name = match.groups()
+	try:
+		mtime = long(time.mktime((int(year), MONTHS[month], int(day), int(hour),
+		                          int(minute), int(second), 0, 1, -1)))
+	except (KeyError, ValueError, OverflowError):
+		mtime = 0L
+
+	return ListEntry(type, long(size), mtime, name)
+
+# Non-blocking reader for the output of 'puppy -c dir'. Each call to read()
+# returns the entries puppy has printed since the last call.
+class ListingReader:
+	def __init__(self, pipe, popen_obj, path=None, cache=None):
+		self.pipe = pipe
+		self.fd = pipe.fileno()
+		self.popen_obj = popen_obj
+		self.path = path
+		self.cache = cache
+		self.setBlocking(False)
+
+		self.buffer = ''
+		self.listing = []
+		# Lines which are not directory entries, for error messages
+		self.output = []
+		self.eof = False
+
+	def fileno(self):
+		return self.fd
+
+	def setBlocking(self, blocking):
+		flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+		if blocking:
+			flags &= ~os.O_NONBLOCK
+		else:
+			flags |= os.O_NONBLOCK
+		fcntl.fcntl(self.fd, fcntl.F_SETFL, flags)
+
+	def read(self):
+		entries = []
+		while not self.eof:
+			try:
+				data = os.read(self.fd, READ_SIZE)
+			except OSError, e:
+				if e.errno == errno.EAGAIN:
+					break
+				elif e.errno == errno.EINTR:
+					continue
+				raise
+
+			if len(data) == 0:
+				self.eof = True
+				data = '\n'
+
+			lines = (self.buffer + data).split('\n')
+			self.buffer = lines.pop()
+
+			for line in lines:
+				entry = parseListEntry(line)
+				if entry != None:
+					entries.append(entry)
+				elif len(line.strip()) > 0:
+					self.output.append(line)
+
+		self.listing.extend(entries)
+		return entries
+
+	# Wait for puppy to exit and return the complete listing
+	def finish(self):
+		self.pipe.close()
+
+		if os.WEXITSTATUS(self.popen_obj.wait()) != 0:
+			raise PuppyError("listDir failed. puppy returned: " + str(self.output))
+
+		if self.cache != None:
+			self.cache.put(self.path, self.listing)
+
+		return self.listing
+
+	def cancel(self):
+		self.popen_obj.cancel()
+
+		self.pipe.close()
+		# Only a puppy process needs waiting for, so it doesn't linger as a
+		# zombie. A backend thread finishes its commands itself.
+		if self.popen_obj.pid != None:
+			self.popen_obj.wait()
+
+# In memory cache of PVR directory listings keyed by normalised path. Listings
+# expire after ttl seconds and the least recently used listing is dropped once
+# more than size listings are cached.
+class ListingCache:
+	def __init__(self, ttl=LISTING_CACHE_TTL, size=LISTING_CACHE_SIZE):
+		self.ttl = ttl
+		self.size = size
+		self.entries = {}
+		# Least recently used path first
+		self.order = []
+
+	def get(self, path):
+		path = normPath(path)
+		if not self.entries.has_key(path):
+			return None
+
+		timestamp, listing = self.entries[path]
+		if time.time() - timestamp > self.ttl:
+			self.invalidate(path)
+			return None
+
+		self.order.remove(path)
+		self.order.append(path)
+
+		# Callers are free to modify the list they get back, not its entries
+		return listing[:]
+
+	def put(self, path, listing):
+		path = normPath(path)
+		if self.entries.has_key(path):
+			self.order.remove(path)
+
+		self.entries[path] = (time.time(), listing[:])
+		self.order.append(path)
+
+		while len(self.order) > self.size:
+			del self.entries[self.order.pop(0)]
+
+	def invalidate(self, path):
+		path = normPath(path)
+		if self.entries.has_key(path):
+			del self.entries[path]
+			self.order.remove(path)
+
+	# Invalidate path and every directory below it
+	def invalidateTree(self, path):
+		path = normPath(path)
+		for cached_path in self.order[:]:
+			if cached_path == path or cached_path.startswith(path + '\\'):
+				self.invalidate(cached_path)
+
+	def clear(self):
+		self.entries = {}
+		self.order = []
+
 class PuppyError(Exception):
 	def __init__(self, value):
 		self.value = value
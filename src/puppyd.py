@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+## puppyd.py - Share the PVR between guppy, guppy-cli.py and scripts
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# Owns the connection to the PVR and runs commands sent by
+# backends.BrokerBackend over a Unix socket, one at a time. Commands which
+# only read or change metadata (dir, size, mkdir, rename, delete) go ahead of
+# queued transfers, and identical dir and size commands waiting to run are
+# run once for all of their clients.
+#
+# A client sends one request per connection: a line of tab separated fields,
+# turbo ('0' or '1'), the command and its arguments. puppyd answers with
+# 'D<length>\n' frames holding the command's output and finishes with
+# 'S<status>\n', where status is as returned by os.wait(). A client may send
+# 'C\n' to cancel its command.
+#
+# Client sockets don't block. Output waits in each client's buffer until its
+# socket can take it, so a client that stops reading doesn't hold up the
+# others, and one that falls more than MAX_OUTGOING bytes behind is dropped.
+
+import sys
+import os
+import errno
+import select
+import signal
+import socket
+import optparse
+
+import config
+import backends
+
+# Commands run before any queued transfer
+METADATA_COMMANDS = ('dir', 'size', 'mkdir', 'rename', 'delete')
+
+# Commands whose waiting requests can share one run
+SHARED_COMMANDS = ('dir', 'size')
+
+READ_SIZE = 8192
+
+# Bytes of output kept for a client that isn't reading it
+MAX_OUTGOING = 1024 * 1024
+
+class Request:
+	def __init__(self, turbo, command, args):
+		self.turbo = turbo
+		self.command = command
+		self.args = args
+		self.clients = []
+		self.process = None
+
+	def key(self):
+		return (self.turbo, self.command, tuple(self.args))
+
+class Client:
+	def __init__(self, sock):
+		self.sock = sock
+		self.sock.setblocking(False)
+		self.buffer = ''
+		self.outgoing = ''
+		self.request = None
+		# True once the client has its status, it is closed when outgoing
+		# has been sent
+		self.closing = False
+
+	def send(self, data):
+		self.outgoing += data
+
+	# Send as much of outgoing as the socket will take. Returns False if the
+	# client has gone.
+	def flush(self):
+		try:
+			sent = self.sock.send(self.outgoing)
+		except socket.error, error:
+			return error[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+		self.outgoing = self.outgoing[sent:]
+		return True
+
+class Broker:
+	def __init__(self, backend, socket_path):
+		self.backend = backend
+		self.socket_path = socket_path
+		self.clients = {}
+		self.pending = []
+		self.current = None
+
+	def serve(self):
+		self.listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.listen_sock.bind(self.socket_path)
+		os.chmod(self.socket_path, 0600)
+		self.listen_sock.listen(5)
+
+		try:
+			while True:
+				fds = [ self.listen_sock ] + [ client.sock for client in self.clients.values() ]
+				if self.current != None:
+					fds.append(self.current.process.fromchild)
+				writers = [ client.sock for client in self.clients.values()
+				            if len(client.outgoing) > 0 ]
+
+				try:
+					readable, writable = select.select(fds, writers, [])[:2]
+				except select.error, error:
+					if error[0] == errno.EINTR:
+						continue
+					raise
+
+				for fd in writable:
+					if self.clients.has_key(fd):
+						self._on_writable(self.clients[fd])
+
+				for fd in readable:
+					if fd == self.listen_sock:
+						self._accept()
+					elif self.current != None and fd == self.current.process.fromchild:
+						self._on_output()
+					elif self.clients.has_key(fd):
+						self._on_client(self.clients[fd])
+		finally:
+			self.listen_sock.close()
+			os.remove(self.socket_path)
+
+	def _accept(self):
+		sock = self.listen_sock.accept()[0]
+		self.clients[sock] = Client(sock)
+
+	def _dropClient(self, client):
+		del self.clients[client.sock]
+		client.sock.close()
+
+		request = client.request
+		if request == None:
+			return
+		client.request = None
+		self._leave(request, client)
+
+	# Take client off request, cancelling the request if nobody else is
+	# waiting for it
+	def _leave(self, request, client):
+		request.clients.remove(client)
+		if len(request.clients) > 0:
+			return
+
+		# Nobody wants the result any more
+		if request == self.current:
+			request.process.cancel()
+		else:
+			self.pending.remove(request)
+
+	# Queue data for client, dropping it if it has stopped reading
+	def _send(self, client, data):
+		client.send(data)
+		if len(client.outgoing) > MAX_OUTGOING:
+			self._dropClient(client)
+
+	# Answer client with status and close it once that has been sent
+	def _finish(self, client, status):
+		client.request = None
+		client.closing = True
+		client.send('S%d\n' % status)
+
+	def _on_writable(self, client):
+		if not client.flush():
+			self._dropClient(client)
+		elif client.closing and len(client.outgoing) == 0:
+			self._dropClient(client)
+
+	def _on_client(self, client):
+		try:
+			data = client.sock.recv(READ_SIZE)
+		except socket.error:
+			data = ''
+		if len(data) == 0:
+			self._dropClient(client)
+			return
+
+		client.buffer += data
+		while '\n' in client.buffer and not client.closing:
+			line, client.buffer = client.buffer.split('\n', 1)
+			if client.request == None:
+				self._addRequest(client, line)
+			elif line == 'C':
+				self._cancel(client)
+
+	def _addRequest(self, client, line):
+		fields = line.split('\t')
+		if len(fields) < 2:
+			self._finish(client, 1 << 8)
+			return
+
+		request = Request(fields[0] == '1', fields[1], fields[2:])
+		if request.command in SHARED_COMMANDS:
+			for pending in self.pending:
+				if pending.key() == request.key():
+					request = pending
+					break
+
+		request.clients.append(client)
+		client.request = request
+		if request not in self.pending:
+			self._schedule(request)
+
+		if self.current == None:
+			self._startNext()
+
+	def _schedule(self, request):
+		if request.command not in METADATA_COMMANDS:
+			self.pending.append(request)
+			return
+
+		# After other metadata commands but before any transfer
+		index = 0
+		while index < len(self.pending) and self.pending[index].command in METADATA_COMMANDS:
+			index += 1
+		self.pending.insert(index, request)
+
+	# Other clients sharing the request still get its result
+	def _cancel(self, client):
+		request = client.request
+		self._leave(request, client)
+		self._finish(client, signal.SIGTERM)
+
+	def _startNext(self):
+		if len(self.pending) == 0:
+			return
+
+		request = self.pending.pop(0)
+		request.process = self.backend.execute(request.command, request.args, request.turbo)
+		self.current = request
+
+	def _on_output(self):
+		request = self.current
+		data = os.read(request.process.fromchild.fileno(), READ_SIZE)
+		if len(data) > 0:
+			for client in request.clients[:]:
+				self._send(client, 'D%d\n' % len(data) + data)
+			return
+
+		request.process.fromchild.close()
+		status = request.process.wait()
+		# One request per connection
+		for client in request.clients:
+			self._finish(client, status)
+
+		self.current = None
+		self._startNext()
+
+def main(argv):
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('-s', '--socket', default=None,
+	                  help='Unix socket to listen on [default: ~/.guppy/puppyd.sock]')
+	parser.add_option('-b', '--backend', default='puppy',
+	                  help="how to reach the PVR: 'puppy', 'puppy:COMMAND' "
+	                       "or 'loopback:DIR' [default: %default]")
+	options, args = parser.parse_args(argv[1:])
+
+	socket_path = options.socket
+	if socket_path == None:
+		socket_path = config.getConfigPath('puppyd.sock')
+
+	try:
+		backend = backends.createBackend(options.backend)
+	except backends.TransportError, error:
+		parser.error(error.value)
+	if isinstance(backend, backends.BrokerBackend):
+		parser.error("puppyd can't use itself as its backend")
+
+	# A socket left behind by a puppyd that died is in the way
+	if os.path.exists(socket_path):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(socket_path)
+		except socket.error:
+			os.remove(socket_path)
+		else:
+			sock.close()
+			print >> sys.stderr, 'puppyd: already running on', socket_path
+			return 1
+
+	# Clean up the socket when killed
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		Broker(backend, socket_path).serve()
+	except KeyboardInterrupt:
+		pass
+
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -0,0 +1,248 @@
+## schedule.py - Run transfers at quiet times of the day
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# A Scheduler holds transfers until the time window they are allowed to run
+# in opens and then emits 'due' with their jobs, highest priority first, for
+# the owner to add to the TransferQueue. When a window closes its jobs are
+# paused in the queue, which kills puppy part way through a running one, and
+# are started again when the window next opens. The jobs a scheduled folder
+# adds to the queue are scheduled in the same window. Scheduled transfers are
+# kept in ~/.guppy/schedule until they finish, so they survive a restart.
+
+import time
+import cPickle
+
+import gobject
+
+import config
+import transfer
+
+# Bump when the format of the schedule file changes
+SCHEDULE_VERSION = 1
+
+# Seconds between checks of the time windows
+CHECK_INTERVAL = 30
+
+# Turbo policies of a scheduled transfer and the TransferJob.turbo they give
+TURBO_POLICIES = { 'default' : None, 'on' : True, 'off' : False, 'auto' : 'auto' }
+
+# The times of day, in minutes after midnight, that transfers may run
+# between. A window that ends before it starts runs past midnight, one that
+# starts and ends at the same time is always open.
+class TimeWindow:
+	def __init__(self, start, end):
+		self.start = start
+		self.end = end
+
+	def __str__(self):
+		return '%02d:%02d-%02d:%02d' % (self.start / 60, self.start % 60,
+		                                self.end / 60, self.end % 60)
+
+	def isOpen(self, now=None):
+		if now == None:
+			now = time.time()
+		local = time.localtime(now)
+		minute = local[3] * 60 + local[4]
+
+		if self.start < self.end:
+			return self.start <= minute < self.end
+		elif self.start > self.end:
+			return minute >= self.start or minute < self.end
+		return True
+
+def parseTimeOfDay(text):
+	try:
+		hour, minute = [ int(field) for field in text.strip().split(':') ]
+	except ValueError:
+		raise ScheduleError("Times must be HH:MM, not " + text)
+	if not (0 <= hour < 24 and 0 <= minute < 60):
+		raise ScheduleError("No such time of day: " + text)
+
+	return hour * 60 + minute
+
+# Parse a window such as '01:00-06:00'
+def parseWindow(text):
+	if text.count('-') != 1:
+		raise ScheduleError("Time windows must be HH:MM-HH:MM, not " + text)
+
+	start, end = text.split('-')
+	return TimeWindow(parseTimeOfDay(start), parseTimeOfDay(end))
+
+class ScheduledTransfer:
+	def __init__(self, job, window, turbo='default', priority=0):
+		self.job = job
+		self.window = window
+		self.turbo = turbo
+		self.priority = priority
+		# True while the job is paused because its window is closed
+		self.held = True
+
+		job.turbo = TURBO_POLICIES[turbo]
+
+class Scheduler(gobject.GObject):
+	__gsignals__ = {
+		# List of jobs whose window has opened, to be added to the queue
+		'due'     : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		             (gobject.TYPE_PYOBJECT,)),
+		# Transfers were added to or removed from the schedule
+		'changed' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+	}
+
+	def __init__(self, queue, filename=None):
+		gobject.GObject.__init__(self)
+
+		if filename == None:
+			filename = config.getConfigPath('schedule')
+		self.filename = filename
+		self.queue = queue
+		self.transfers = []
+
+		self.load()
+
+		queue.connect('job-added', self.on_job_added)
+		queue.connect('job-finished', self.on_job_finished)
+
+	def load(self):
+		try:
+			file = open(self.filename, 'rb')
+			try:
+				version, records = cPickle.load(file)
+			finally:
+				file.close()
+		except config.LOAD_ERRORS:
+			return
+
+		if version != SCHEDULE_VERSION:
+			return
+
+		for record in records:
+			job = transfer.TransferJob(record['src'], record['dst'], record['direction'],
+			                           record['size'], record['mtime'], record.get('type', 'f'))
+			job.state = 'paused'
+			job.overwrite = record.get('overwrite', True)
+			window = TimeWindow(*record['window'])
+			self.transfers.append(ScheduledTransfer(job, window, record['turbo'],
+			                                        record['priority']))
+
+	def save(self):
+		records = []
+		for scheduled in self.transfers:
+			job = scheduled.job
+			records.append({ 'src' : job.src, 'dst' : job.dst,
+			                 'direction' : job.direction, 'size' : job.size,
+			                 'mtime' : job.mtime, 'type' : job.type,
+			                 'overwrite' : job.overwrite,
+			                 'window' : (scheduled.window.start, scheduled.window.end),
+			                 'turbo' : scheduled.turbo,
+			                 'priority' : scheduled.priority })
+
+		data = cPickle.dumps((SCHEDULE_VERSION, records), cPickle.HIGHEST_PROTOCOL)
+		config.writeFile(self.filename, data)
+
+	# Run job in window. turbo is one of the keys of TURBO_POLICIES and
+	# transfers with a higher priority run first.
+	def add(self, job, window, turbo='default', priority=0):
+		job.state = 'paused'
+		self.transfers.append(ScheduledTransfer(job, window, turbo, priority))
+		self.save()
+		self.emit('changed')
+
+	def getTransfers(self):
+		return self.transfers
+
+	# Drop every scheduled transfer that isn't running
+	def clear(self):
+		for scheduled in self.transfers[:]:
+			job = scheduled.job
+			if job.state in ('running', 'verifying'):
+				continue
+
+			self.transfers.remove(scheduled)
+			if job in self.queue.getJobs():
+				self.queue.cancel(job)
+
+		self.save()
+		self.emit('changed')
+
+	# Start the transfers whose window has opened and pause those whose
+	# window has closed. Returns True so it can be used as a gobject timeout.
+	def check(self):
+		now = time.time()
+		transfers = self.transfers[:]
+		transfers.sort(key=lambda scheduled: -scheduled.priority)
+
+		due = []
+		for scheduled in transfers:
+			job = scheduled.job
+			if job.isFinished():
+				continue
+
+			if scheduled.window.isOpen(now):
+				if not scheduled.held:
+					continue
+				scheduled.held = False
+				if job in self.queue.getJobs():
+					self.queue.resume(job)
+				else:
+					job.state = 'queued'
+					job.bytes_done = 0
+					job.percent = 0.0
+					due.append(job)
+			elif not scheduled.held and job.state in ('queued', 'ready', 'running'):
+				scheduled.held = True
+				self.queue.pause(job)
+
+		if len(due) > 0:
+			self.emit('due', due)
+
+		return True
+
+	def on_job_added(self, queue, job):
+		if job.parent == None:
+			return
+
+		for scheduled in self.transfers:
+			if scheduled.job == job.parent:
+				break
+		else:
+			return
+
+		child = ScheduledTransfer(job, scheduled.window, scheduled.turbo, scheduled.priority)
+		child.held = not scheduled.window.isOpen()
+		if child.held:
+			job.state = 'paused'
+		self.transfers.append(child)
+
+	def on_job_finished(self, queue, job):
+		for scheduled in self.transfers:
+			if scheduled.job == job:
+				self.transfers.remove(scheduled)
+				try:
+					self.save()
+				except (IOError, OSError):
+					# Tried again when the schedule next changes
+					pass
+				self.emit('changed')
+				break
+
+gobject.type_register(Scheduler)
+
+class ScheduleError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
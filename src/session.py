@@ -0,0 +1,93 @@
+## session.py - Remember where guppy was left between runs
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# A Session holds the folder and sort of each of guppy's panes and the
+# listing of the PVR folder when guppy last exited, kept in ~/.guppy/session.
+# The next start shows the PVR folder from the listing straight away and
+# lists it again once the window is up.
+
+import cPickle
+
+import config
+import puppy
+
+# Bump when the format of the session file changes
+SESSION_VERSION = 1
+
+# Folders with more entries than this aren't kept, so starting doesn't wait
+# on a large file
+MAX_SNAPSHOT_ENTRIES = 10000
+
+class Session:
+	def __init__(self, filename=None):
+		if filename == None:
+			filename = config.getConfigPath('session')
+		self.filename = filename
+
+		self.pvr_dir = None
+		self.pc_dir = None
+		# (column, order) of each pane, or None for the default
+		self.pvr_sort = None
+		self.pc_sort = None
+		# Entries of pvr_dir as (type, size, mtime, name) tuples, or None
+		self.pvr_listing = None
+
+		self.load()
+
+	def load(self):
+		try:
+			file = open(self.filename, 'rb')
+			try:
+				version, state = cPickle.load(file)
+			finally:
+				file.close()
+
+			if version != SESSION_VERSION:
+				return
+			# Nothing is kept from a session file that is only partly right
+			values = (state['pvr_dir'], state['pc_dir'], state['pvr_sort'],
+			          state['pc_sort'], state['pvr_listing'])
+		except config.LOAD_ERRORS:
+			return
+
+		self.pvr_dir, self.pc_dir, self.pvr_sort, self.pc_sort, self.pvr_listing = values
+
+	def save(self):
+		state = { 'pvr_dir' : self.pvr_dir, 'pc_dir' : self.pc_dir,
+		          'pvr_sort' : self.pvr_sort, 'pc_sort' : self.pc_sort,
+		          'pvr_listing' : self.pvr_listing }
+
+		data = cPickle.dumps((SESSION_VERSION, state), cPickle.HIGHEST_PROTOCOL)
+		config.writeFile(self.filename, data)
+
+	# Returns the listing of pvr_dir as puppy.ListEntry objects, or None if
+	# there isn't one
+	def getPVRListing(self):
+		if self.pvr_listing == None:
+			return None
+
+		return [ puppy.ListEntry(*entry) for entry in self.pvr_listing ]
+
+	# Keep listing, as returned by Puppy.listDir(), as the listing of pvr_dir.
+	# None forgets it.
+	def setPVRListing(self, listing):
+		if listing == None or len(listing) > MAX_SNAPSHOT_ENTRIES:
+			self.pvr_listing = None
+			return
+
+		self.pvr_listing = [ (entry.type, entry.size, entry.mtime, entry.name)
+		                     for entry in listing ]
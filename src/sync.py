@@ -0,0 +1,188 @@
+## sync.py - Mirror a directory on the PVR to a local directory
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import stat
+
+import puppy
+import transfer
+
+# Orders in which a sync plan's downloads can be run
+PRIORITIES = ('smallest', 'oldest', 'name')
+
+class SyncAction:
+	# kind is 'new' or 'changed' for files to download, 'mkdir' for local
+	# directories to create and 'delete' for local files that are no longer
+	# on the PVR. src is None for 'mkdir' and 'delete'.
+	def __init__(self, kind, src, dst, size=0, mtime=None):
+		self.kind = kind
+		self.src = src
+		self.dst = dst
+		self.size = size
+		self.mtime = mtime
+		# The OSError from a 'delete' that execute() couldn't do
+		self.error = None
+
+# Works out the smallest set of downloads that makes a local directory a copy
+# of a PVR directory. Each PVR directory costs one listing, which comes from
+# the Puppy object's cache when possible. A local file is up to date when it
+# has the same size as the PVR's and was modified no earlier, or when the
+# optional verify.Manifest says it was verified and it hasn't changed since.
+class SyncPlanner:
+	def __init__(self, puppy_obj, priority='smallest', delete=False, recursive=True,
+	             manifest=None):
+		if priority not in PRIORITIES:
+			raise SyncError("Unknown sync priority: " + priority)
+
+		self.puppy = puppy_obj
+		self.priority = priority
+		self.delete = delete
+		self.recursive = recursive
+		self.manifest = manifest
+
+	def plan(self, pvr_dir, local_dir):
+		actions = []
+		pending = [ (puppy.normPath(pvr_dir), local_dir) ]
+		while len(pending) > 0:
+			pvr_dir, local_dir = pending.pop(0)
+			listing = self.puppy.listDir(pvr_dir)
+			subdirs = self._planDir(pvr_dir, listing, local_dir, actions)
+			if self.recursive:
+				pending.extend(subdirs)
+
+		return self._order(actions)
+
+	# Plan a single directory using a listing we already have
+	def planDir(self, pvr_dir, listing, local_dir):
+		actions = []
+		self._planDir(puppy.normPath(pvr_dir), listing, local_dir, actions)
+		return self._order(actions)
+
+	# Make the plan's local changes and return transfer jobs for its
+	# downloads, to be run by a TransferQueue. A file that can't be deleted
+	# has the error set on its action rather than stopping the sync.
+	def execute(self, plan):
+		jobs = []
+		for action in plan:
+			if action.kind == 'mkdir':
+				if not os.path.isdir(action.dst):
+					os.makedirs(action.dst)
+			elif action.kind == 'delete':
+				try:
+					os.remove(action.dst)
+				except OSError, error:
+					action.error = error
+					continue
+				if self.manifest != None:
+					self.manifest.remove(action.dst)
+			else:
+				jobs.append(transfer.TransferJob(action.src, action.dst, 'download',
+				                                 action.size, action.mtime))
+
+		return jobs
+
+	def _planDir(self, pvr_dir, listing, local_dir, actions):
+		local_files = {}
+		if os.path.isdir(local_dir):
+			for name in os.listdir(local_dir):
+				try:
+					local_files[name] = os.stat(os.path.join(local_dir, name))
+				except OSError:
+					pass
+		else:
+			actions.append(SyncAction('mkdir', None, local_dir))
+
+		subdirs = []
+		pvr_names = {}
+		for entry in listing:
+			name = entry.name
+			if name == '..' or name == '.':
+				continue
+			pvr_names[name] = True
+
+			if pvr_dir == '\\':
+				src = '\\' + name
+			else:
+				src = pvr_dir + '\\' + name
+			dst = os.path.join(local_dir, name)
+
+			if entry.type == 'd':
+				if self.recursive:
+					if not local_files.has_key(name):
+						actions.append(SyncAction('mkdir', None, dst))
+					subdirs.append((src, dst))
+				continue
+
+			size = entry.size
+			mtime = entry.mtime
+			if not local_files.has_key(name):
+				actions.append(SyncAction('new', src, dst, size, mtime))
+				continue
+
+			# A file verified since it was downloaded needn't be looked at
+			if self.manifest != None and self.manifest.isVerified(dst, src, size, mtime):
+				continue
+
+			job = transfer.TransferJob(src, dst, 'download', size, mtime)
+			state = transfer.checkDestination(job)
+			local_stat = local_files[name]
+			if state == 'partial' or \
+			   (state == 'exists' and (local_stat.st_size != size or local_stat.st_mtime < mtime)):
+				actions.append(SyncAction('changed', src, dst, size, mtime))
+
+		if self.delete:
+			for name, local_stat in local_files.items():
+				if pvr_names.has_key(name) or name.startswith('.'):
+					continue
+				if stat.S_ISREG(local_stat.st_mode):
+					actions.append(SyncAction('delete', None,
+					                          os.path.join(local_dir, name),
+					                          local_stat.st_size))
+
+		return subdirs
+
+	def _order(self, actions):
+		mkdirs = [ action for action in actions if action.kind == 'mkdir' ]
+		deletes = [ action for action in actions if action.kind == 'delete' ]
+		downloads = [ action for action in actions if action.src != None ]
+
+		if self.priority == 'smallest':
+			keys = [ (action.size, action.dst, action) for action in downloads ]
+		elif self.priority == 'oldest':
+			keys = [ (action.mtime, action.dst, action) for action in downloads ]
+		else:
+			keys = [ (action.dst, action.dst, action) for action in downloads ]
+		keys.sort()
+
+		# Directories must exist before anything is downloaded into them and
+		# deleting first frees space for the downloads
+		return mkdirs + deletes + [ key[2] for key in keys ]
+
+def summarisePlan(plan):
+	counts = { 'new' : 0, 'changed' : 0, 'delete' : 0, 'mkdir' : 0, 'bytes' : 0 }
+	for action in plan:
+		counts[action.kind] += 1
+		if action.src != None:
+			counts['bytes'] += action.size
+
+	return counts
+
+class SyncError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
@@ -0,0 +1,324 @@
+## topfield.py - Talk to a Topfield PVR over USB without puppy
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# The protocol puppy uses, as a transport for backends.SessionBackend. Needs
+# pyusb; importing this module raises ImportError without it.
+#
+# Every packet is a 16 bit length, a 16 bit CRC of everything after it, a 32
+# bit command and the command's data, big endian. On the bus each pair of
+# bytes is swapped, so packets are sent as whole 16 bit words. The PVR answers each command with SUCCESS, FAIL or data
+# packets, and the host acknowledges each data packet with SUCCESS.
+
+import time
+import struct
+import calendar
+
+import usb
+
+from backends import TransportError
+
+VENDOR_ID = 0x11db
+PRODUCT_ID = 0x1000
+EP_OUT = 0x01
+EP_IN = 0x82
+
+# Milliseconds to wait for the PVR
+TIMEOUT = 11000
+
+MAX_PACKET_SIZE = 0xffff
+HEADER_SIZE = 8
+# Bytes of file data in one packet
+DATA_SIZE = 0xfe00
+
+FAIL = 0x0001
+SUCCESS = 0x0002
+CANCEL = 0x0003
+CMD_READY = 0x0100
+CMD_RESET = 0x0101
+CMD_TURBO = 0x0102
+CMD_HDD_SIZE = 0x1000
+DATA_HDD_SIZE = 0x1001
+CMD_HDD_DIR = 0x1002
+DATA_HDD_DIR = 0x1003
+DATA_HDD_DIR_END = 0x1004
+CMD_HDD_DEL = 0x1005
+CMD_HDD_RENAME = 0x1006
+CMD_HDD_CREATE_DIR = 0x1007
+CMD_HDD_FILE_SEND = 0x1008
+DATA_HDD_FILE_START = 0x1009
+DATA_HDD_FILE_DATA = 0x100a
+DATA_HDD_FILE_END = 0x100b
+
+# Directions of CMD_HDD_FILE_SEND
+PUT = 0
+GET = 1
+
+# Size of a directory entry: date (5 bytes), type, 64 bit size, name (95
+# bytes), unused byte and 32 bit attributes
+TYPEFILE_SIZE = 114
+TYPE_DIR = 1
+TYPE_FILE = 2
+
+# Modified Julian Date of 1 Jan 1970
+MJD_EPOCH = 40587
+
+def _crcTable():
+	table = []
+	for byte in range(256):
+		crc = byte
+		for bit in range(8):
+			if crc & 1:
+				crc = (crc >> 1) ^ 0xa001
+			else:
+				crc >>= 1
+		table.append(crc)
+	return table
+
+CRC_TABLE = _crcTable()
+
+def crc16(data):
+	crc = 0
+	for char in data:
+		crc = (crc >> 8) ^ CRC_TABLE[(crc ^ ord(char)) & 0xff]
+	return crc
+
+def byteSwap(data):
+	if len(data) % 2:
+		data += '\0'
+	swapped = []
+	for i in range(0, len(data), 2):
+		swapped.append(data[i + 1] + data[i])
+	return ''.join(swapped)
+
+# PVR times are local time as a Modified Julian Date and hour, minute, second
+def decodeTime(data):
+	mjd, hour, minute, second = struct.unpack('>HBBB', data)
+	utc = time.gmtime((mjd - MJD_EPOCH) * 86400 + hour * 3600 + minute * 60 + second)
+	return time.mktime(utc[:8] + (-1,))
+
+def encodeTime(mtime):
+	local = time.localtime(mtime)
+	days = calendar.timegm(local) / 86400
+	return struct.pack('>HBBB', days + MJD_EPOCH, local[3], local[4], local[5])
+
+def decodeEntry(data):
+	stamp = decodeTime(data[:5])
+	filetype, size = struct.unpack('>BQ', data[5:14])
+	name = data[14:109].split('\0', 1)[0]
+	if filetype == TYPE_DIR:
+		return ('d', 0, stamp, name)
+	return ('f', size, stamp, name)
+
+def encodeEntry(name, size, mtime):
+	return encodeTime(mtime) + struct.pack('>BQ', TYPE_FILE, size) + \
+	       name[:94].ljust(95, '\0') + '\0' + struct.pack('>I', 0)
+
+def encodeName(name):
+	return struct.pack('>H', len(name) + 1) + name + '\0'
+
+class TopfieldTransport:
+	def __init__(self):
+		self.handle = None
+		self.turbo = None
+
+	def open(self):
+		for bus in usb.busses():
+			for device in bus.devices:
+				if device.idVendor == VENDOR_ID and device.idProduct == PRODUCT_ID:
+					self.handle = device.open()
+					try:
+						self.handle.claimInterface(0)
+					except usb.USBError, error:
+						self.handle = None
+						raise TransportError("Cannot claim the PVR: " + str(error))
+					self.turbo = None
+					return
+
+		raise TransportError("PVR not found on USB")
+
+	def close(self):
+		if self.handle != None:
+			try:
+				self.handle.releaseInterface()
+			except usb.USBError:
+				pass
+			self.handle = None
+
+	# As puppy does, commands are padded to a whole number of words with the
+	# padding counted in the length and CRC. File data packets keep their
+	# real length, so the PVR doesn't write the padding, and are only padded
+	# on the bus.
+	def send(self, cmd, data='', pad=True):
+		body = struct.pack('>I', cmd) + data
+		if pad and len(body) % 2:
+			body += '\0'
+		packet = struct.pack('>HH', len(body) + 4, crc16(body)) + body
+		try:
+			self.handle.bulkWrite(EP_OUT, byteSwap(packet), TIMEOUT)
+		except usb.USBError, error:
+			raise TransportError("USB write failed: " + str(error))
+
+	# Returns the command and data of the next packet from the PVR
+	def receive(self):
+		try:
+			data = self.handle.bulkRead(EP_IN, MAX_PACKET_SIZE, TIMEOUT)
+		except usb.USBError, error:
+			raise TransportError("USB read failed: " + str(error))
+
+		packet = byteSwap(''.join([ chr(byte & 0xff) for byte in data ]))
+		if len(packet) < HEADER_SIZE:
+			raise TransportError("Short packet from the PVR")
+
+		length, crc = struct.unpack('>HH', packet[:4])
+		body = packet[4:length]
+		if crc16(body) != crc:
+			raise TransportError("Corrupt packet from the PVR")
+
+		cmd = struct.unpack('>I', body[:4])[0]
+		if cmd == FAIL:
+			code = 0
+			if len(body) >= 8:
+				code = struct.unpack('>I', body[4:8])[0]
+			raise TransportError("Device reports error %d" % code)
+		return cmd, body[4:]
+
+	def expect(self, expected):
+		cmd, data = self.receive()
+		if cmd != expected:
+			raise TransportError("Unexpected reply 0x%04x from the PVR" % cmd)
+		return data
+
+	def setTurbo(self, turbo):
+		if turbo == self.turbo:
+			return
+		self.send(CMD_TURBO, struct.pack('>I', int(turbo)))
+		self.expect(SUCCESS)
+		self.turbo = turbo
+
+	def getDiskSpace(self):
+		self.send(CMD_HDD_SIZE)
+		total, free = struct.unpack('>II', self.expect(DATA_HDD_SIZE)[:8])
+		# Sizes are in kiB
+		return long(total) * 1024, long(free) * 1024
+
+	def listDir(self, path):
+		self.send(CMD_HDD_DIR, path + '\0')
+		entries = []
+		while True:
+			cmd, data = self.receive()
+			if cmd == DATA_HDD_DIR_END:
+				break
+			if cmd != DATA_HDD_DIR:
+				raise TransportError("Unexpected reply 0x%04x from the PVR" % cmd)
+
+			for offset in range(0, len(data) - TYPEFILE_SIZE + 1, TYPEFILE_SIZE):
+				entries.append(decodeEntry(data[offset:offset + TYPEFILE_SIZE]))
+			self.send(SUCCESS)
+
+		return entries
+
+	def openRead(self, path):
+		self.send(CMD_HDD_FILE_SEND, struct.pack('>B', GET) + encodeName(path) +
+		                             struct.pack('>Q', 0))
+		entry = decodeEntry(self.expect(DATA_HDD_FILE_START)[:TYPEFILE_SIZE])
+		self.send(SUCCESS)
+		return TopfieldReader(self, entry[1])
+
+	def openWrite(self, path, size, mtime):
+		self.send(CMD_HDD_FILE_SEND, struct.pack('>B', PUT) + encodeName(path) +
+		                             struct.pack('>Q', 0))
+		self.expect(SUCCESS)
+		self.send(DATA_HDD_FILE_START, encodeEntry(path, size, mtime))
+		self.expect(SUCCESS)
+		return TopfieldWriter(self)
+
+	def makeDir(self, path):
+		self.send(CMD_HDD_CREATE_DIR, encodeName(path))
+		self.expect(SUCCESS)
+
+	def rename(self, old_path, new_path):
+		self.send(CMD_HDD_RENAME, encodeName(old_path) + encodeName(new_path))
+		self.expect(SUCCESS)
+
+	def delete(self, path):
+		self.send(CMD_HDD_DEL, path + '\0')
+		self.expect(SUCCESS)
+
+	def cancel(self):
+		self.send(CANCEL)
+		# The PVR may still have data packets on the way
+		while True:
+			cmd, data = self.receive()
+			if cmd == SUCCESS:
+				break
+
+# Reads a file the PVR is sending. read() ignores the length asked for and
+# returns whatever came in the next data packet.
+class TopfieldReader:
+	def __init__(self, transport, size):
+		self.transport = transport
+		self.size = size
+		self.finished = False
+
+	def read(self, length):
+		if self.finished:
+			return ''
+
+		cmd, data = self.transport.receive()
+		if cmd == DATA_HDD_FILE_END:
+			self.finished = True
+			self.transport.send(SUCCESS)
+			return ''
+		if cmd != DATA_HDD_FILE_DATA:
+			raise TransportError("Unexpected reply 0x%04x from the PVR" % cmd)
+
+		# Each data packet starts with its offset in the file
+		self.transport.send(SUCCESS)
+		return data[8:]
+
+	def close(self):
+		while not self.finished:
+			self.read(DATA_SIZE)
+
+	def cancel(self):
+		if not self.finished:
+			self.finished = True
+			self.transport.cancel()
+
+class TopfieldWriter:
+	def __init__(self, transport):
+		self.transport = transport
+		self.offset = 0
+		self.finished = False
+
+	def write(self, data):
+		for start in range(0, len(data), DATA_SIZE):
+			chunk = data[start:start + DATA_SIZE]
+			self.transport.send(DATA_HDD_FILE_DATA, struct.pack('>Q', self.offset) + chunk,
+			                    pad=False)
+			self.transport.expect(SUCCESS)
+			self.offset += len(chunk)
+
+	def close(self):
+		self.finished = True
+		self.transport.send(DATA_HDD_FILE_END)
+		self.transport.expect(SUCCESS)
+
+	def cancel(self):
+		if not self.finished:
+			self.finished = True
+			self.transport.cancel()
@@ -0,0 +1,781 @@
+## transfer.py - Queue of file transfers to and from the PVR
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+import os
+import stat
+import time
+import math
+
+import gobject
+
+import puppy
+import config
+import verify
+
+# Suffix of the journal kept next to a file while it is being downloaded
+JOURNAL_SUFFIX = '.guppy-journal'
+
+# Bytes transferred between updates of a download's journal
+JOURNAL_INTERVAL = 64 * 1024 * 1024
+
+# Seconds of folder listing allowed between two file transfers
+LISTING_TIME = 2.0
+
+# Seconds over which BatchProgress smooths the transfer rate
+RATE_TIME_CONSTANT = 10.0
+
+# Records which PVR file a download came from and how much of it has been
+# written, in a hidden file next to the destination. It is removed once the
+# download has been verified, so a journal next to a file means the file is
+# incomplete.
+class TransferJournal:
+	def __init__(self, dst):
+		dir, name = os.path.split(dst)
+		self.filename = os.path.join(dir, '.' + name + JOURNAL_SUFFIX)
+		self.bytes_written = 0
+
+	# Returns a dictionary with the source, size, mtime and bytes recorded in
+	# the journal or None if there is no journal
+	def read(self):
+		try:
+			file = open(self.filename)
+			try:
+				lines = file.readlines()
+			finally:
+				file.close()
+		except IOError:
+			return None
+
+		values = {}
+		for line in lines:
+			if '=' not in line:
+				continue
+			key, value = line.rstrip('\n').split('=', 1)
+			values[key] = value
+
+		try:
+			for key in 'size', 'mtime', 'bytes':
+				if values.has_key(key) and values[key] != 'None':
+					values[key] = long(values[key])
+				else:
+					values[key] = None
+		except ValueError:
+			return None
+
+		return values
+
+	def write(self, job):
+		data = 'source=%s\nsize=%s\nmtime=%s\nbytes=%d\n' % (job.src, job.size, job.mtime, job.bytes_done)
+		try:
+			config.writeFile(self.filename, data)
+		except (IOError, OSError):
+			# The journal only saves work later, don't fail the transfer
+			return
+		self.bytes_written = job.bytes_done
+
+	def remove(self):
+		try:
+			os.remove(self.filename)
+		except OSError:
+			pass
+
+# Work out what is already at a download's destination. Returns None if
+# there is nothing there, 'partial' if it is left over from an earlier
+# download of the same file that didn't finish, 'complete' if the file's size
+# and modification time match the PVR's listing, or 'exists' for any other
+# file. A download's journal is only removed once the download has finished,
+# so a file with a journal from the same PVR file is 'partial' even if all of
+# it was written.
+def checkDestination(job):
+	try:
+		stats = os.stat(job.dst)
+	except OSError:
+		return None
+
+	journal = TransferJournal(job.dst).read()
+	if journal != None and journal['source'] == job.src:
+		return 'partial'
+
+	if job.size != None and job.mtime != None and \
+	   stats.st_size == job.size and long(stats.st_mtime) == job.mtime:
+		return 'complete'
+
+	return 'exists'
+
+class TransferJob:
+	# direction is either 'download' or 'upload'. size is in bytes, or None if
+	# it is not known exactly. mtime is the source's modification time in
+	# seconds since the epoch, if known. type is 'f' for a file or 'd' for a
+	# folder, which is created at the destination and has a job added to the
+	# queue for each of its entries.
+	def __init__(self, src, dst, direction, size=None, mtime=None, type='f'):
+		self.src = src
+		self.dst = dst
+		self.direction = direction
+		self.size = size
+		self.mtime = mtime
+		self.type = type
+		# The folder job whose listing this job came from
+		self.parent = None
+
+		# One of 'queued', 'ready', 'running', 'paused', 'verifying', 'done',
+		# 'skipped', 'failed' or 'cancelled'
+		self.state = 'queued'
+		self.bytes_done = 0
+		self.percent = 0.0
+		self.error = None
+		self.journal = None
+		# True or False to force turbo mode, 'auto' to let the queue's
+		# TurboTuner choose or None to use the queue's setting
+		self.turbo = None
+		# False to skip the job if a different file is already at dst. The
+		# jobs of a folder's entries get the folder's setting.
+		self.overwrite = True
+
+	def getName(self):
+		if self.direction == 'download':
+			return self.src.split('\\')[-1]
+		else:
+			return os.path.basename(self.src)
+
+	def isFinished(self):
+		return self.state in ('done', 'skipped', 'failed', 'cancelled')
+
+# Runs transfer jobs through puppy one at a time. Only one job can use the USB
+# bus at once, so the local side work for the next job (disk space checks,
+# destination checks) and the verification of the previous job are done from
+# idle handlers while the current job is transferring. Given a
+# verify.Manifest, downloads are also read back and their checksums recorded
+# in it, in a thread. Given a turbo.TurboTuner, the tuner chooses turbo mode
+# for jobs which ask for it, and for every job after setAutoTurbo(True).
+#
+# A folder job lists its folder and adds a job for each entry. Listing a PVR
+# folder needs the USB bus too, so waiting folders are listed between file
+# transfers for up to LISTING_TIME seconds each time. The first files start
+# without waiting for the whole tree and the total size of the batch grows
+# quickly. Folder jobs don't emit 'job-started' or 'job-progress'.
+class TransferQueue(gobject.GObject):
+	__gsignals__ = {
+		'job-added'       : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		                     (gobject.TYPE_PYOBJECT,)),
+		'job-started'     : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		                     (gobject.TYPE_PYOBJECT,)),
+		# job, percent, speed, time as returned by Puppy.getProgress()
+		'job-progress'    : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		                     (gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT,
+		                      gobject.TYPE_PYOBJECT, gobject.TYPE_PYOBJECT)),
+		# puppy has finished a job's transfer, it may still be verified
+		'job-transferred' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		                     (gobject.TYPE_PYOBJECT,)),
+		'job-finished'    : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE,
+		                     (gobject.TYPE_PYOBJECT,)),
+		'finished'        : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
+	}
+
+	def __init__(self, puppy_obj, manifest=None):
+		gobject.GObject.__init__(self)
+
+		self.puppy = puppy_obj
+		self.manifest = manifest
+		self.hasher = None
+		self.turbo_tuner = None
+		self.auto_turbo = False
+		self.jobs = []
+		self.current = None
+		self.verifying = []
+		self.running = False
+		self.watch_id = None
+		self.prepare_id = None
+		# ListingReader of the folder job being listed
+		self.folder_reader = None
+		self.folder_started = None
+		# Seconds spent listing folders since the last file transfer started
+		self.listing_time = 0
+
+	def add(self, job):
+		self.jobs.append(job)
+		self.emit('job-added', job)
+		if self.running:
+			self._schedulePrepare()
+
+	def clear(self):
+		if self.running:
+			raise TransferError("Cannot clear a running transfer queue")
+		self.jobs = []
+
+	# Drop the jobs that have finished, keeping those that are paused until
+	# they are resumed
+	def removeFinished(self):
+		if self.running:
+			raise TransferError("Cannot clear a running transfer queue")
+		self.jobs = [ job for job in self.jobs if not job.isFinished() ]
+
+	def getJobs(self):
+		return self.jobs
+
+	def getCurrentJob(self):
+		return self.current
+
+	def isRunning(self):
+		return self.running
+
+	def start(self):
+		if self.running:
+			return
+
+		self.running = True
+		self._startNext()
+
+	# A folder being listed can't be paused, it soon finishes anyway
+	def pause(self, job):
+		if job.state == 'running' and job.type == 'f':
+			job.state = 'paused'
+			self.puppy.cancelTransfer()
+		elif job.state in ('queued', 'ready'):
+			job.state = 'paused'
+
+	def resume(self, job):
+		if job.state != 'paused':
+			return
+
+		# puppy can't continue a partial transfer so the job starts again.
+		# The part already downloaded is removed so _prepare() doesn't take
+		# it for another file and skip the job.
+		if job.journal != None:
+			try:
+				os.remove(job.dst)
+			except OSError:
+				pass
+			job.journal.remove()
+			job.journal = None
+
+		job.state = 'queued'
+		job.bytes_done = 0
+		job.percent = 0.0
+		if self.running:
+			self._schedulePrepare()
+		else:
+			self.start()
+
+	def cancel(self, job):
+		if job.isFinished():
+			return
+
+		was_running = job.state == 'running'
+		job.state = 'cancelled'
+		if was_running and job.type == 'd':
+			gobject.source_remove(self.watch_id)
+			self.folder_reader.cancel()
+			self._finishFolder(job)
+		elif was_running:
+			# _on_progress() finishes the job once puppy has exited
+			self.puppy.cancelTransfer()
+		else:
+			self.emit('job-finished', job)
+
+	def cancelAll(self):
+		for job in self.jobs:
+			if job.state in ('queued', 'ready', 'paused', 'running'):
+				self.cancel(job)
+
+		self._checkFinished()
+
+	# Move job to position index in the queue
+	def move(self, job, index):
+		self.jobs.remove(job)
+		self.jobs.insert(index, job)
+		if self.running:
+			self._schedulePrepare()
+
+	def _nextJob(self):
+		waiting = [ job for job in self.jobs if job.state in ('queued', 'ready') ]
+		if len(waiting) == 0:
+			return None
+
+		if self.listing_time < LISTING_TIME:
+			for job in waiting:
+				if job.type == 'd':
+					return job
+		else:
+			for job in waiting:
+				if job.type == 'f':
+					return job
+
+		return waiting[0]
+
+	def _startNext(self):
+		job = self._nextJob()
+		while job != None and job.state != 'ready':
+			self._prepare(job)
+			job = self._nextJob()
+
+		if job == None:
+			self._checkFinished()
+			return
+
+		self.current = job
+		job.state = 'running'
+		job.bytes_done = 0
+		job.percent = 0.0
+
+		if job.type == 'd':
+			self._startFolder(job)
+			return
+		self.listing_time = 0
+
+		# Handlers of 'job-started' see the setting the job runs with, the
+		# Puppy's own setting is put back afterwards
+		turbo = self.puppy.turbo
+		self.puppy.setTurbo(self._chooseTurbo(job))
+		try:
+			if job.direction == 'download':
+				job.journal = TransferJournal(job.dst)
+				job.journal.write(job)
+				self.puppy.getFile(job.src, job.dst)
+			else:
+				self.puppy.putFile(job.src, job.dst)
+
+			self.watch_id = gobject.io_add_watch(self.puppy.getProgressFd(),
+			                                     gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+			                                     self._on_progress)
+			self.emit('job-started', job)
+		finally:
+			self.puppy.setTurbo(turbo)
+
+		# Get the next job ready while this one is on the USB bus
+		self._schedulePrepare()
+
+	def _chooseTurbo(self, job):
+		turbo = job.turbo
+		if turbo == None:
+			if not self.auto_turbo:
+				return self.puppy.turbo
+			turbo = 'auto'
+
+		if turbo == 'auto':
+			if self.turbo_tuner == None:
+				return self.puppy.turbo
+			return self.turbo_tuner.chooseTurbo(job)
+
+		return turbo
+
+	def _schedulePrepare(self):
+		if self.prepare_id == None:
+			self.prepare_id = gobject.idle_add(self._prepareNext)
+
+	def _prepareNext(self):
+		self.prepare_id = None
+
+		job = self._nextJob()
+		if job != None and job.state == 'queued':
+			self._prepare(job)
+
+		return False
+
+	def _prepare(self, job):
+		if job.type == 'd':
+			job.state = 'ready'
+			return
+
+		if job.direction == 'download':
+			# Don't download files we already have. puppy can't continue a
+			# partial download so those are started again.
+			destination = checkDestination(job)
+			if destination == 'complete':
+				job.state = 'skipped'
+				job.percent = 100.0
+				if job.size != None:
+					job.bytes_done = job.size
+				self.emit('job-finished', job)
+				return
+			elif destination == 'exists' and not job.overwrite:
+				job.state = 'skipped'
+				self.emit('job-finished', job)
+				return
+
+			dst_dir = os.path.dirname(job.dst)
+			if not os.access(dst_dir, os.W_OK):
+				self._fail(job, "Cannot write to " + dst_dir)
+				return
+
+			if job.size != None:
+				stats = os.statvfs(dst_dir)
+				free = stats.f_bavail * stats.f_frsize - self._reservedSpace()
+				if job.size > free:
+					self._fail(job, "Not enough disk space for " + job.dst)
+					return
+		else:
+			try:
+				job.size = os.stat(job.src).st_size
+			except OSError, error:
+				self._fail(job, error.strerror + ": " + job.src)
+				return
+
+		job.state = 'ready'
+
+	# Bytes still to be written by downloads that have already been checked
+	# for free disk space
+	def _reservedSpace(self):
+		reserved = 0
+		for job in self.jobs:
+			if job.direction == 'download' and job.size != None and \
+			   job.state in ('ready', 'running'):
+				reserved += job.size - job.bytes_done
+
+		return reserved
+
+	def _on_progress(self, source, condition):
+		job = self.current
+
+		try:
+			running = self.puppy.readProgress()
+		except puppy.PuppyError, error:
+			running = False
+			if job.state == 'running':
+				job.state = 'failed'
+				job.error = error.value
+
+		percent, speed, time = self.puppy.getProgress()
+		if percent != None:
+			job.percent = float(percent)
+			if job.size != None:
+				job.bytes_done = long(job.size * job.percent / 100)
+			if job.journal != None and \
+			   job.bytes_done - job.journal.bytes_written >= JOURNAL_INTERVAL:
+				job.journal.write(job)
+			self.emit('job-progress', job, percent, speed, time)
+
+		if running:
+			return True
+
+		self.watch_id = None
+		self.current = None
+		self.emit('job-transferred', job)
+
+		if job.state == 'running':
+			job.state = 'verifying'
+			self.verifying.append(job)
+			gobject.idle_add(self._verify, job)
+		elif job.state != 'paused':
+			self.emit('job-finished', job)
+
+		if self.running:
+			self._startNext()
+
+		return False
+
+	def _startFolder(self, job):
+		self.folder_started = time.time()
+
+		if job.direction == 'upload':
+			try:
+				existing = []
+				if self._makePVRDir(job.dst):
+					existing = [ entry.name for entry in self.puppy.listDir(job.dst) ]
+				entries = listLocalDir(job.src)
+			except puppy.PuppyError, error:
+				self._finishFolder(job, error.value)
+			except OSError, error:
+				self._finishFolder(job, error.strerror + ": " + job.src)
+			else:
+				self._addFolderEntries(job, entries, existing)
+				self._finishFolder(job)
+			return
+
+		try:
+			if not os.path.isdir(job.dst):
+				os.makedirs(job.dst)
+		except OSError, error:
+			self._finishFolder(job, error.strerror + ": " + job.dst)
+			return
+
+		listing = self.puppy.getCachedDir(job.src)
+		if listing != None:
+			self._addFolderEntries(job, listing)
+			self._finishFolder(job)
+			return
+
+		self.folder_reader = self.puppy.startListDir(job.src)
+		self.watch_id = gobject.io_add_watch(self.folder_reader.fileno(),
+		                                     gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+		                                     self._on_folder_listing)
+
+	# Returns True if the directory was already there
+	def _makePVRDir(self, path):
+		for entry in self.puppy.listDir(puppy.parentPath(path)):
+			if entry.type == 'd' and entry.name == path.split('\\')[-1]:
+				return True
+
+		self.puppy.makeDir(path)
+		return False
+
+	# Jobs for a folder's entries are added as puppy lists them
+	def _on_folder_listing(self, source, condition):
+		job = self.current
+		self._addFolderEntries(job, self.folder_reader.read())
+		if not self.folder_reader.eof:
+			return True
+
+		error = None
+		try:
+			self.folder_reader.finish()
+		except puppy.PuppyError, e:
+			error = e.value
+		self._finishFolder(job, error)
+
+		return False
+
+	# existing holds the names already in an upload's PVR folder
+	def _addFolderEntries(self, folder, entries, existing=()):
+		for entry in entries:
+			if entry.name == '.' or entry.name == '..':
+				continue
+
+			if folder.direction == 'download':
+				src = puppy.joinPath(folder.src, entry.name)
+				dst = os.path.join(folder.dst, entry.name)
+			else:
+				src = os.path.join(folder.src, entry.name)
+				dst = puppy.joinPath(folder.dst, entry.name)
+
+			size = entry.size
+			if entry.type == 'd':
+				size = None
+			job = TransferJob(src, dst, folder.direction, size, entry.mtime, entry.type)
+			job.parent = folder
+			job.turbo = folder.turbo
+			job.overwrite = folder.overwrite
+			skip = entry.type == 'f' and not folder.overwrite and entry.name in existing
+			if skip:
+				job.state = 'skipped'
+			self.add(job)
+			if skip:
+				self.emit('job-finished', job)
+
+	def _finishFolder(self, job, error=None):
+		self.watch_id = None
+		self.folder_reader = None
+		self.current = None
+		self.listing_time += time.time() - self.folder_started
+
+		if job.state == 'running':
+			if error != None:
+				job.state = 'failed'
+				job.error = error
+			else:
+				job.state = 'done'
+		self.emit('job-finished', job)
+
+		# Not called directly so a tree of folders that finish at once
+		# doesn't recurse through _startNext()
+		if self.running:
+			gobject.idle_add(self._continue)
+
+	def _continue(self):
+		if self.running and self.current == None:
+			self._startNext()
+		return False
+
+	def setManifest(self, manifest):
+		self.manifest = manifest
+
+	# tuner chooses turbo mode for jobs whose turbo is 'auto'
+	def setTurboTuner(self, tuner):
+		self.turbo_tuner = tuner
+
+	# If auto is True the tuner also chooses for jobs without a turbo setting
+	# of their own, otherwise they use the Puppy's setting
+	def setAutoTurbo(self, auto):
+		self.auto_turbo = auto
+
+	def _verify(self, job):
+		if job.direction == 'download':
+			try:
+				size = os.stat(job.dst).st_size
+			except OSError, error:
+				size = None
+
+			if size == None:
+				self._fail(job, "Downloaded file is missing: " + job.dst)
+			elif job.size != None and size != job.size:
+				self._fail(job, "Downloaded file is %d bytes, expected %d bytes" % (size, job.size))
+
+		if job.state == 'verifying' and job.direction == 'download' and self.manifest != None:
+			if self.hasher == None:
+				self.hasher = verify.Hasher()
+			self.hasher.hash(job, self._on_hashed)
+			return False
+
+		self._finishVerify(job)
+		return False
+
+	def _on_hashed(self, job, digest, error):
+		if error != None and job.state == 'verifying':
+			self._fail(job, error)
+		self._finishVerify(job, digest)
+		return False
+
+	def _finishVerify(self, job, digest=None):
+		self.verifying.remove(job)
+
+		if job.state == 'verifying':
+			job.state = 'done'
+			job.percent = 100.0
+			if job.size != None:
+				job.bytes_done = job.size
+
+			if job.journal != None:
+				# Give the file the PVR's time so later runs can tell it is
+				# complete from its size and modification time
+				if job.mtime != None:
+					try:
+						os.utime(job.dst, (os.stat(job.dst).st_atime, job.mtime))
+					except OSError:
+						pass
+				job.journal.remove()
+				job.journal = None
+
+			if digest != None and self.manifest != None:
+				self.manifest.add(job, digest)
+
+			self.emit('job-finished', job)
+
+		self._checkFinished()
+
+	def _fail(self, job, error):
+		job.state = 'failed'
+		job.error = error
+		self.emit('job-finished', job)
+
+	def _checkFinished(self):
+		if not self.running or self.current != None or len(self.verifying) > 0:
+			return
+		if self._nextJob() != None:
+			return
+
+		self.running = False
+		if self.manifest != None:
+			self.manifest.save()
+		self.emit('finished')
+
+gobject.type_register(TransferQueue)
+
+# Returns a puppy.ListEntry for each file and folder in the local directory
+# path. Raises OSError if it can't be read.
+def listLocalDir(path):
+	entries = []
+	for name in os.listdir(path):
+		try:
+			stats = os.stat(os.path.join(path, name))
+		except OSError:
+			continue
+
+		if stat.S_ISDIR(stats.st_mode):
+			entries.append(puppy.ListEntry('d', 0L, long(stats.st_mtime), name))
+		elif stat.S_ISREG(stats.st_mode):
+			entries.append(puppy.ListEntry('f', long(stats.st_size), long(stats.st_mtime), name))
+
+	return entries
+
+# Progress of all the jobs in a TransferQueue together. Job sizes are exact,
+# from the PVR listing or os.stat(), and the running job's progress comes
+# from puppy's percentage. The rate includes the time between jobs and is
+# smoothed exponentially over time_constant seconds, so the time remaining
+# doesn't jump with every progress record.
+class BatchProgress:
+	def __init__(self, queue, time_constant=RATE_TIME_CONSTANT):
+		self.queue = queue
+		self.time_constant = time_constant
+		self.reset()
+
+		queue.connect('job-started', self.on_job_started)
+		queue.connect('job-progress', self.on_job_progress)
+		queue.connect('finished', self.on_finished)
+
+	def reset(self):
+		# Bytes per second, None until there are two samples
+		self.rate = None
+		self.last_time = None
+		self.last_bytes = 0
+
+	# Returns the files and bytes done, the total, the smoothed rate in bytes
+	# per second and the seconds remaining, which are None if not known yet
+	def getSummary(self):
+		files_done = 0
+		files_total = 0
+		bytes_done = 0
+		bytes_total = 0
+		for job in self.queue.getJobs():
+			if job.type == 'd' or job.state in ('skipped', 'failed', 'cancelled'):
+				continue
+
+			files_total += 1
+			if job.state == 'done':
+				files_done += 1
+			if job.size != None:
+				bytes_total += job.size
+				if job.state == 'done':
+					bytes_done += job.size
+				else:
+					bytes_done += job.bytes_done
+
+		remaining = None
+		if self.rate != None and self.rate > 0:
+			remaining = (bytes_total - bytes_done) / self.rate
+
+		return { 'files_done' : files_done, 'files_total' : files_total,
+		         'bytes_done' : bytes_done, 'bytes_total' : bytes_total,
+		         'rate' : self.rate, 'remaining' : remaining }
+
+	def _addSample(self):
+		now = time.time()
+		bytes_done = self.getSummary()['bytes_done']
+		if self.last_time == None:
+			self.last_time = now
+			self.last_bytes = bytes_done
+			return
+
+		elapsed = now - self.last_time
+		if elapsed <= 0:
+			return
+
+		# Bytes of a failed job drop out of the total
+		rate = max(bytes_done - self.last_bytes, 0) / elapsed
+		if self.rate == None:
+			self.rate = rate
+		else:
+			weight = 1 - math.exp(-elapsed / self.time_constant)
+			self.rate += weight * (rate - self.rate)
+
+		self.last_time = now
+		self.last_bytes = bytes_done
+
+	def on_job_started(self, queue, job):
+		self._addSample()
+
+	def on_job_progress(self, queue, job, percent, speed, times):
+		self._addSample()
+
+	# Start again for the next batch
+	def on_finished(self, queue):
+		self.reset()
+
+class TransferError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
@@ -0,0 +1,222 @@
+## turbo.py - Choose turbo mode from measured transfer rates
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# Turbo mode is faster on some hubs and cables and no faster on others, and
+# the PVR copes badly with it while recording. A TurboTuner watches the
+# transfers run by a TransferQueue and keeps the rate puppy reported for each
+# turbo setting, by device, direction and size class. A queue given the tuner
+# with setTurboTuner() asks it which setting to use for each job: both are
+# tried PROBE_TRANSFERS times, then the faster one is used and the other tried
+# again every REPROBE_INTERVAL transfers. A turbo transfer that stalls or
+# fails keeps turbo mode off for the next BACKOFF_TRANSFERS transfers, longer
+# if it keeps happening.
+
+import cPickle
+
+import config
+import metrics
+
+# Bump when the format of the tuning file changes
+TUNING_VERSION = 1
+
+# Upper bounds in bytes of the file size classes. Larger files, and files of
+# unknown size, are in a class of their own.
+SIZE_CLASSES = (16 * 1024 * 1024, 512 * 1024 * 1024)
+
+# Transfers run with each setting before choosing between them
+PROBE_TRANSFERS = 2
+
+# Transfers between tries of the slower setting
+REPROBE_INTERVAL = 20
+
+# Turbo mode is only used if it is at least this much faster
+TURBO_MARGIN = 1.05
+
+# Weight of the newest transfer in a setting's average rate
+RATE_WEIGHT = 0.3
+
+# Seconds without progress that count as a stall
+STALL_TIME = 10
+
+# Transfers turbo mode sits out after a stall or failure
+BACKOFF_TRANSFERS = 10
+# Most transfers turbo mode sits out after repeated stalls or failures
+MAX_BACKOFF_TRANSFERS = 100
+
+def sizeClass(size):
+	if size == None:
+		return len(SIZE_CLASSES)
+
+	for index in range(len(SIZE_CLASSES)):
+		if size < SIZE_CLASSES[index]:
+			return index
+
+	return len(SIZE_CLASSES)
+
+# What is known about transfers of one direction and size class on a device.
+# Rates are in Mbits/s, keyed by turbo setting.
+class TuningRecord:
+	def __init__(self):
+		self.rates = { False : None, True : None }
+		self.counts = { False : 0, True : 0 }
+		self.transfers = 0
+		# Turbo transfers in a row that stalled or failed
+		self.turbo_failures = 0
+		self.backoff = 0
+
+	def choose(self):
+		if self.backoff > 0:
+			return False
+
+		for turbo in (False, True):
+			if self.counts[turbo] < PROBE_TRANSFERS:
+				return turbo
+
+		best = self.rates[True] > self.rates[False] * TURBO_MARGIN
+		if self.transfers % REPROBE_INTERVAL == 0:
+			return not best
+		return best
+
+	def addRate(self, turbo, rate):
+		if self.rates[turbo] == None:
+			self.rates[turbo] = rate
+		else:
+			self.rates[turbo] += RATE_WEIGHT * (rate - self.rates[turbo])
+		self.counts[turbo] += 1
+
+		if turbo:
+			self.turbo_failures = 0
+
+	def addFailure(self):
+		self.turbo_failures += 1
+		self.backoff = min(BACKOFF_TRANSFERS * self.turbo_failures, MAX_BACKOFF_TRANSFERS)
+
+	def addTransfer(self):
+		self.transfers += 1
+		if self.backoff > 0:
+			self.backoff -= 1
+
+# A transfer being watched by a TurboTuner
+class TunedTransfer:
+	def __init__(self, turbo):
+		self.turbo = turbo
+		# Last rate reported by puppy, which averages over the whole transfer
+		self.rate = None
+		self.stalled = False
+		self.last_percent = None
+		self.last_moved = None
+
+	def addSample(self, percent, speed, times):
+		rate = metrics.parseRate(speed)
+		if rate != None:
+			self.rate = rate
+
+		elapsed = metrics.parseTime(times['elapsed'])
+		if elapsed == None:
+			return
+		if percent != self.last_percent:
+			self.last_percent = percent
+			self.last_moved = elapsed
+		elif elapsed - self.last_moved >= STALL_TIME:
+			self.stalled = True
+
+# Learns the best turbo setting from the transfers run by a TransferQueue.
+# device names how the PVR is reached, e.g. the backend description, as the
+# best setting depends on the hub and cable.
+class TurboTuner:
+	def __init__(self, queue, puppy_obj, device, filename=None):
+		if filename == None:
+			filename = config.getConfigPath('turbo')
+		self.filename = filename
+		self.puppy = puppy_obj
+		self.device = device
+
+		self.records = {}
+		self.dirty = False
+		# TunedTransfer of each job that has started but not finished
+		self.current = {}
+
+		self.load()
+
+		queue.connect('job-started', self.on_job_started)
+		queue.connect('job-progress', self.on_job_progress)
+		queue.connect('job-finished', self.on_job_finished)
+		queue.connect('finished', self.on_finished)
+
+	def load(self):
+		try:
+			file = open(self.filename, 'rb')
+			try:
+				version, records = cPickle.load(file)
+			finally:
+				file.close()
+		except config.LOAD_ERRORS:
+			return
+
+		if version == TUNING_VERSION:
+			self.records = records
+
+	def save(self):
+		if not self.dirty:
+			return
+
+		data = cPickle.dumps((TUNING_VERSION, self.records), cPickle.HIGHEST_PROTOCOL)
+		config.writeFile(self.filename, data)
+		self.dirty = False
+
+	def getRecord(self, direction, size):
+		key = (self.device, direction, sizeClass(size))
+		if not self.records.has_key(key):
+			self.records[key] = TuningRecord()
+		return self.records[key]
+
+	# Returns the turbo setting to transfer job with
+	def chooseTurbo(self, job):
+		return self.getRecord(job.direction, job.size).choose()
+
+	def on_job_started(self, queue, job):
+		self.current[job] = TunedTransfer(self.puppy.turbo == True)
+
+	def on_job_progress(self, queue, job, percent, speed, times):
+		transfer = self.current.get(job)
+		if transfer != None:
+			transfer.addSample(percent, speed, times)
+
+	def on_job_finished(self, queue, job):
+		# Jobs which were skipped never started
+		if not self.current.has_key(job):
+			return
+		transfer = self.current.pop(job)
+
+		# Cancelled and paused jobs say nothing about the setting
+		if job.state not in ('done', 'failed'):
+			return
+
+		record = self.getRecord(job.direction, job.size)
+		record.addTransfer()
+		if transfer.turbo and (transfer.stalled or job.state == 'failed'):
+			record.addFailure()
+		elif job.state == 'done' and not transfer.stalled and transfer.rate != None:
+			record.addRate(transfer.turbo, transfer.rate)
+		self.dirty = True
+
+	def on_finished(self, queue):
+		try:
+			self.save()
+		except (IOError, OSError):
+			# Forgetting what was learnt mustn't fail the transfers
+			pass
@@ -0,0 +1,214 @@
+## verify.py - Checksums of downloaded files
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# A TransferQueue given a Manifest reads each finished download back in a
+# Hasher thread, while the next file is on the USB bus, and records its
+# checksum in the manifest along with the PVR file it came from. A file whose
+# size and modification time still match its manifest entry is taken to be
+# intact without reading it again. check(), used by 'guppy-cli.py verify',
+# reads a file again and compares it with its checksum.
+
+import os
+import time
+import atexit
+import cPickle
+import threading
+import Queue
+
+import gobject
+
+import config
+
+try:
+	import hashlib
+	newHash = hashlib.sha1
+except ImportError:
+	# Python 2.4
+	import sha
+	newHash = sha.new
+
+MANIFEST_VERSION = 1
+
+# Bytes read from the disk in one go while hashing
+READ_SIZE = 4 * 1024 * 1024
+
+def hashFile(filename):
+	digest = newHash()
+	file = open(filename, 'rb')
+	try:
+		while True:
+			data = file.read(READ_SIZE)
+			if len(data) == 0:
+				break
+			digest.update(data)
+	finally:
+		file.close()
+
+	return digest.hexdigest()
+
+class ManifestEntry:
+	def __init__(self, source, size, mtime, local_mtime, digest):
+		self.source = source
+		self.size = size
+		# Modification time on the PVR
+		self.mtime = mtime
+		self.local_mtime = local_mtime
+		self.digest = digest
+		self.verified = time.time()
+
+# Checksums of downloaded files, by absolute local path
+class Manifest:
+	def __init__(self, filename=None):
+		if filename == None:
+			filename = config.getConfigPath('manifest')
+		self.filename = filename
+
+		self.entries = {}
+		self.dirty = False
+
+		self.load()
+
+	def load(self):
+		try:
+			file = open(self.filename, 'rb')
+			try:
+				version, entries = cPickle.load(file)
+			finally:
+				file.close()
+		except config.LOAD_ERRORS:
+			return
+
+		if version == MANIFEST_VERSION:
+			self.entries = entries
+
+	def save(self):
+		if not self.dirty:
+			return
+
+		data = cPickle.dumps((MANIFEST_VERSION, self.entries), cPickle.HIGHEST_PROTOCOL)
+		config.writeFile(self.filename, data)
+		self.dirty = False
+
+	# Record the checksum of a finished download
+	def add(self, job, digest):
+		path = os.path.abspath(job.dst)
+		try:
+			local_mtime = long(os.stat(path).st_mtime)
+		except OSError:
+			return
+
+		self.entries[path] = ManifestEntry(job.src, job.size, job.mtime, local_mtime, digest)
+		self.dirty = True
+
+	def get(self, path):
+		return self.entries.get(os.path.abspath(path))
+
+	# Returns the paths in the manifest, sorted, only those below dir if it
+	# is given
+	def getPaths(self, dir=None):
+		paths = self.entries.keys()
+		if dir != None:
+			dir = os.path.join(os.path.abspath(dir), '')
+			paths = [ path for path in paths if path.startswith(dir) ]
+		paths.sort()
+		return paths
+
+	def remove(self, path):
+		path = os.path.abspath(path)
+		if self.entries.has_key(path):
+			del self.entries[path]
+			self.dirty = True
+
+	# Returns True if path was verified as a download of the PVR file src of
+	# the given size and modification time, and hasn't changed since. Doesn't
+	# read the file, so it can be used from the main loop, a file touched
+	# since isn't verified.
+	def isVerified(self, path, src, size, mtime):
+		entry = self.get(path)
+		if entry == None:
+			return False
+		if entry.source != src or entry.size != size or entry.mtime != mtime:
+			return False
+
+		try:
+			stats = os.stat(path)
+		except OSError:
+			return False
+		return stats.st_size == entry.size and long(stats.st_mtime) == entry.local_mtime
+
+	# Read path and compare it with its checksum. Returns 'ok', 'changed',
+	# 'missing' if it can't be read or None if it isn't in the manifest.
+	def check(self, path):
+		entry = self.get(path)
+		if entry == None:
+			return None
+
+		path = os.path.abspath(path)
+		try:
+			local_mtime = long(os.stat(path).st_mtime)
+			digest = hashFile(path)
+		except (IOError, OSError):
+			return 'missing'
+
+		if digest != entry.digest:
+			return 'changed'
+
+		entry.local_mtime = local_mtime
+		entry.verified = time.time()
+		self.dirty = True
+		return 'ok'
+
+# Hashes files one at a time in a thread. The callback given to hash() is
+# called from the gobject main loop with the job and its checksum, or None
+# and an error message, so users must call gobject.threads_init().
+class Hasher:
+	def __init__(self):
+		self.queue = Queue.Queue()
+		self.thread = None
+
+	def hash(self, job, callback):
+		if self.thread == None:
+			self.thread = threading.Thread(target=self._run)
+			self.thread.setDaemon(True)
+			self.thread.start()
+			atexit.register(self.close)
+
+		self.queue.put((job, callback))
+
+	def close(self):
+		if self.thread == None:
+			return
+
+		self.queue.put(None)
+		self.thread.join()
+		self.thread = None
+
+	def _run(self):
+		while True:
+			item = self.queue.get()
+			if item == None:
+				break
+
+			job, callback = item
+			digest = None
+			error = None
+			try:
+				digest = hashFile(job.dst)
+			except IOError, e:
+				error = "Cannot read back %s: %s" % (job.dst, e.strerror)
+
+			gobject.idle_add(callback, job, digest, error)
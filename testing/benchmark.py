@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+
+## benchmark.py - Time guppy's listing, progress and file view code
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# Run from anywhere, e.g.
+#
+#	$ python testing/benchmark.py --save
+#	(change something)
+#	$ python testing/benchmark.py
+#
+# Each benchmark is run several times and the fastest time kept. Times more
+# than --threshold slower than the saved baseline are reported as
+# regressions and make the exit status non-zero. Benchmarks of the file views
+# need PyGTK and are skipped without it, the startup benchmark also needs a
+# display.
+
+import sys
+import os
+import time
+import random
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(TESTING_DIR, '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+import puppy
+import backends
+
+try:
+	import gtk
+	import guppy
+except ImportError:
+	guppy = None
+
+DEFAULT_BASELINE = os.path.join(TESTING_DIR, 'benchmark-baseline')
+DEFAULT_SIZES = '1000,10000,100000'
+DEFAULT_RECORDS = 20000
+
+# Timestamps of synthetic entries are spread over this many seconds
+DATE_RANGE = 5 * 365 * 24 * 60 * 60
+
+def randomName(rand):
+	words = ('NEWS', 'DOCTOR WHO', 'INSIGHT', 'LOST', 'The Nanny', 'IRONCHEF',
+	         'MONARCHY', 'FOODLOVERS', 'SBS DIGITAL', 'BOSTON LEGAL')
+	return '%s-#-%d.rec' % (rand.choice(words), rand.randint(0, 1000000))
+
+# Lines in the format of 'puppy -c dir' output, one in twenty a directory
+def generateListing(count, seed=0):
+	rand = random.Random(seed)
+	now = time.time()
+	lines = [ 'd                    0 Thu Jan  1 09:59:59 1970 ..\n' ]
+	for i in xrange(count):
+		date = time.strftime('%a %b %d %H:%M:%S %Y',
+		                     time.localtime(now - rand.randint(0, DATE_RANGE)))
+		if i % 20 == 0:
+			lines.append('d %20d %s DIR%d\n' % (0, date, i))
+		else:
+			lines.append('f %20d %s %s\n' % (rand.randint(0, 4 * 1024 ** 3), date, randomName(rand)))
+
+	return ''.join(lines)
+
+# \r terminated records in the format puppy prints while transferring
+def generateProgress(count):
+	records = []
+	for i in xrange(count):
+		percent = 100.0 * (i + 1) / count
+		remaining = count - i
+		records.append('%6.2f%%, %5.2f Mbits/s, %02d:%02d:%02d elapsed, %d:%02d:%02d remaining\r' %
+		               (percent, 7.5 + (i % 10) / 10.0, i / 3600, i / 60 % 60, i % 60,
+		                remaining / 3600, remaining / 60 % 60, remaining % 60))
+
+	return records
+
+# Returns the fastest of repeat runs of func in seconds. setup is called
+# before each run, untimed, and its result passed to func.
+def timeIt(func, setup=None, repeat=3):
+	best = None
+	for i in range(repeat):
+		arg = None
+		if setup != None:
+			arg = setup()
+		start = time.time()
+		func(arg)
+		elapsed = time.time() - start
+		if best == None or elapsed < best:
+			best = elapsed
+
+	return best
+
+class Benchmarks:
+	def __init__(self, sizes, records, repeat):
+		self.sizes = sizes
+		self.records = records
+		self.repeat = repeat
+		self.tmp_dir = tempfile.mkdtemp(prefix='guppy-benchmark-')
+		# (name, seconds or None if skipped)
+		self.results = []
+
+	def cleanUp(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def run(self):
+		for size in self.sizes:
+			self.benchListDir(size)
+		self.benchProgress(self.records)
+		for size in self.sizes:
+			self.benchPCChangeDir(size)
+		for size in self.sizes:
+			self.benchSortFuncs(size)
+		for size in self.sizes:
+			self.benchUpdateEntries(size)
+		self.benchStartup()
+
+		return self.results
+
+	def add(self, name, seconds):
+		self.results.append((name, seconds))
+
+	# Puppy.listDir() reading from cat instead of puppy, so everything but
+	# the USB transfer is timed
+	def benchListDir(self, size):
+		filename = os.path.join(self.tmp_dir, 'listing-%d.txt' % size)
+		file = open(filename, 'w')
+		file.write(generateListing(size))
+		file.close()
+
+		# The shell ignores the arguments Puppy adds after the #
+		pup = puppy.Puppy(backend=backends.SubprocessBackend("cat '%s' #" % filename))
+		self.add('listdir-%d' % size, timeIt(lambda arg: pup.listDir('\\'), repeat=self.repeat))
+
+	# Records are written to a pipe one at a time and taken with
+	# Puppy.getProgress(), as when the transfer queue is woken for each one
+	def benchProgress(self, count):
+		records = generateProgress(count)
+
+		def run(arg):
+			read_fd, write_fd = os.pipe()
+			pipe = os.fdopen(read_fd)
+			pup = puppy.Puppy()
+			pup.progress_reader = puppy.ProgressReader(pipe)
+			try:
+				for record in records:
+					os.write(write_fd, record)
+					pup.progress_reader.read()
+					pup.getProgress()
+			finally:
+				os.close(write_fd)
+				pipe.close()
+
+		self.add('progress-%d' % count, timeIt(run, repeat=self.repeat))
+
+	def benchPCChangeDir(self, size):
+		name = 'pc-changedir-%d' % size
+		if guppy == None:
+			self.add(name, None)
+			return
+
+		dir = os.path.join(self.tmp_dir, 'pc-%d' % size)
+		os.mkdir(dir)
+		rand = random.Random(size)
+		for i in xrange(size):
+			if i % 20 == 0:
+				os.mkdir(os.path.join(dir, 'DIR%d' % i))
+			else:
+				open(os.path.join(dir, randomName(rand)), 'w').close()
+
+		model = guppy.PCFileSystemModel()
+
+		def run(arg):
+			model.changeDir(dir)
+			# Add the entries the model would add from idle handlers
+			model.cancelLoad()
+			while model.loadEntries():
+				pass
+
+		self.add(name, timeIt(run, repeat=self.repeat))
+
+	# Sorting the PVR view's model on each column, as when a column header is
+	# clicked
+	def benchSortFuncs(self, size):
+		names = ('name', 'date', 'size')
+		if guppy == None:
+			for col_name in names:
+				self.add('sort-%s-%d' % (col_name, size), None)
+			return
+
+		cols = zip(names, (guppy.FileSystemModel.NAME_COL,
+		                   guppy.FileSystemModel.DATE_COL,
+		                   guppy.FileSystemModel.SIZE_COL))
+
+		listing = [ puppy.parseListEntry(line) for line in generateListing(size).splitlines() ]
+		model = guppy.PVRFileSystemModel()
+		model.cancelListing()
+		model.setEntries(listing)
+
+		for col_name, col in cols:
+			def run(arg):
+				model.setSortColumn(col, gtk.SORT_DESCENDING)
+			self.add('sort-%s-%d' % (col_name, size), timeIt(run, repeat=self.repeat))
+
+	# Refreshing the PVR view's model with a listing in which one file has
+	# changed, as when the folder restored from the last session is listed
+	def benchUpdateEntries(self, size):
+		name = 'update-entries-%d' % size
+		if guppy == None:
+			self.add(name, None)
+			return
+
+		listing = [ puppy.parseListEntry(line) for line in generateListing(size).splitlines() ]
+		changed = listing[:-1]
+		last = listing[-1]
+		changed.append(puppy.ListEntry(last.type, last.size + 1, last.mtime, last.name))
+
+		model = guppy.PVRFileSystemModel()
+
+		def setup():
+			model.clearEntries()
+			model.setEntries(listing)
+
+		self.add(name, timeIt(lambda arg: model.updateEntries(changed), setup, self.repeat))
+
+	# Time to the window first being drawn, as measured by guppy.py itself,
+	# with no PVR connected
+	def benchStartup(self):
+		name = 'startup'
+		if guppy == None or not os.environ.has_key('DISPLAY'):
+			self.add(name, None)
+			return
+
+		env = os.environ.copy()
+		env['GUPPY_STARTUP_TIME'] = 'exit'
+		env['GUPPY_BACKEND'] = 'loopback:' + os.path.join(self.tmp_dir, 'no-pvr')
+		# Keep away from the user's ~/.guppy
+		env['HOME'] = self.tmp_dir
+
+		best = None
+		for i in range(self.repeat):
+			process = subprocess.Popen([ sys.executable, 'guppy.py' ], cwd=SRC_DIR,
+			                           env=env, stderr=subprocess.PIPE)
+			output = process.communicate()[1]
+			for line in output.splitlines():
+				if line.startswith('guppy: first paint after '):
+					seconds = float(line.split()[4])
+					if best == None or seconds < best:
+						best = seconds
+
+		self.add(name, best)
+
+def loadBaseline(filename):
+	baseline = {}
+	try:
+		file = open(filename)
+	except IOError:
+		return baseline
+
+	try:
+		for line in file:
+			fields = line.split()
+			if len(fields) == 2:
+				baseline[fields[0]] = float(fields[1])
+	finally:
+		file.close()
+
+	return baseline
+
+# Benchmarks which weren't run this time keep their old baseline
+def saveBaseline(filename, results):
+	baseline = loadBaseline(filename)
+	for name, seconds in results:
+		if seconds != None:
+			baseline[name] = seconds
+
+	names = baseline.keys()
+	names.sort()
+	file = open(filename, 'w')
+	try:
+		for name in names:
+			file.write('%s %.6f\n' % (name, baseline[name]))
+	finally:
+		file.close()
+
+# Print results against the baseline. Returns the names of the benchmarks
+# which regressed.
+def report(results, baseline, threshold):
+	regressions = []
+	print '%-24s %10s %10s %8s' % ('benchmark', 'seconds', 'baseline', 'change')
+	for name, seconds in results:
+		if seconds == None:
+			print '%-24s %10s' % (name, 'skipped')
+			continue
+
+		if not baseline.has_key(name):
+			print '%-24s %10.4f %10s' % (name, seconds, '-')
+			continue
+
+		change = (seconds - baseline[name]) / baseline[name]
+		flag = ''
+		if change > threshold:
+			flag = '  REGRESSION'
+			regressions.append(name)
+		print '%-24s %10.4f %10.4f %+7.1f%%%s' % (name, seconds, baseline[name], change * 100, flag)
+
+	return regressions
+
+def main(argv):
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('-b', '--baseline', default=DEFAULT_BASELINE,
+	                  help='file holding the baseline times [default: %default]')
+	parser.add_option('-s', '--save', action='store_true', default=False,
+	                  help='save the times as the new baseline')
+	parser.add_option('-t', '--threshold', type='float', default=0.2,
+	                  help='fraction slower than the baseline that counts as a '
+	                       'regression [default: %default]')
+	parser.add_option('-n', '--sizes', default=DEFAULT_SIZES,
+	                  help='comma separated numbers of directory entries '
+	                       '[default: %default]')
+	parser.add_option('-p', '--progress-records', type='int', default=DEFAULT_RECORDS,
+	                  help='number of progress records [default: %default]')
+	parser.add_option('-r', '--repeat', type='int', default=3,
+	                  help='runs of each benchmark, the fastest is kept '
+	                       '[default: %default]')
+
+	options, args = parser.parse_args(argv[1:])
+	try:
+		sizes = [ int(size) for size in options.sizes.split(',') ]
+	except ValueError:
+		parser.error('--sizes must be a comma separated list of numbers')
+
+	benchmarks = Benchmarks(sizes, options.progress_records, options.repeat)
+	try:
+		results = benchmarks.run()
+	finally:
+		benchmarks.cleanUp()
+
+	regressions = report(results, loadBaseline(options.baseline), options.threshold)
+
+	if options.save:
+		saveBaseline(options.baseline, results)
+		print 'Saved baseline to', options.baseline
+
+	if len(regressions) > 0 and not options.save:
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))
@@ -1,43 +1,404 @@
 #!/usr/bin/python
 
+## fakepuppy.py - Simulate puppy and a Topfield PVR for testing guppy
+## Copyright (C) 2005 Tony Tsui <tsui.tony@gmail.com>
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+
+# Takes the same arguments as puppy and prints the same output, using a
+# directory on the PC as the PVR's disk. Files are really copied, at the
+# speed of a simulated USB bus. Only one fakepuppy can use the PVR at once,
+# like puppy.
+#
+# Settings are given as long options before puppy's options, or in the
+# FAKEPUPPY_OPTIONS environment variable so guppy can run fakepuppy without
+# changes, e.g.
+#
+#	$ export FAKEPUPPY_OPTIONS='--root=/tmp/pvr --bandwidth=80 --stall-rate=0.1'
+#
+# and GUPPY_BACKEND to 'puppy:python testing/fakepuppy.py'. If the root
+# directory doesn't exist it is created with a DataFiles directory holding
+# the recordings in puppy-listdir.txt, scaled down by --scale.
+
 import sys
-import getopt
-import time
 import os
+import time
+import errno
+import fcntl
+import getopt
+import random
+import shutil
+import signal
+import tempfile
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+
+USAGE = """Usage: fakepuppy.py [SETTINGS] [-pPtvq] [-d <device>] -c <command> [args]
+
+Settings:
+ --root=DIR         - directory used as the PVR's disk
+ --disk-size=GIB    - size of the PVR's disk in GiB [160]
+ --scale=FACTOR     - size of the created recordings compared to the
+                      listing in puppy-listdir.txt [0.001]
+ --bandwidth=MBITS  - transfer speed in Mbits/s [8]
+ --turbo=FACTOR     - transfer speed multiplier in turbo mode [2]
+ --latency=SECS     - delay before each command is answered [0.1]
+ --interval=SECS    - time between progress updates [1]
+ --stall-rate=P     - chance of a stall in each progress interval [0]
+ --stall-time=SECS  - length of a stall [5]
+ --fail-rate=P      - chance that a command fails [0]
+ --fail-at=PERCENT  - make transfers fail once this much is done
+ --seed=N           - seed for stalls and failures
+"""
+
+# Bytes copied between checks of the clock
+CHUNK_SIZE = 64 * 1024
+
+class Settings:
+	def __init__(self):
+		self.root = os.path.join(tempfile.gettempdir(), 'fakepuppy-%d' % os.getuid())
+		self.disk_size = 160
+		self.scale = 0.001
+		self.bandwidth = 8.0
+		self.turbo = 2.0
+		self.latency = 0.1
+		self.interval = 1.0
+		self.stall_rate = 0.0
+		self.stall_time = 5.0
+		self.fail_rate = 0.0
+		self.fail_at = None
+		self.seed = None
+
+SETTINGS = ('root=', 'disk-size=', 'scale=', 'bandwidth=', 'turbo=', 'latency=',
+            'interval=', 'stall-rate=', 'stall-time=', 'fail-rate=', 'fail-at=',
+            'seed=')
+
+class DeviceError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+class FakePVR:
+	def __init__(self, settings, turbo, quiet):
+		self.settings = settings
+		self.turbo = turbo
+		self.quiet = quiet
+		self.random = random.Random(settings.seed)
+		self.lock_file = None
+
+		if not os.path.isdir(settings.root):
+			self.populate()
+
+	# Create DataFiles with the recordings listed in puppy-listdir.txt
+	def populate(self):
+		data_dir = os.path.join(self.settings.root, 'DataFiles')
+		os.makedirs(data_dir)
+
+		listing = open(os.path.join(TESTING_DIR, 'puppy-listdir.txt'))
+		try:
+			for line in listing:
+				fields = line.split()
+				if len(fields) < 8 or fields[0] != 'f':
+					continue
+
+				name = ' '.join(fields[7:])
+				path = os.path.join(data_dir, name)
+				file = open(path, 'wb')
+				file.write('\0' * int(int(fields[1]) * self.settings.scale))
+				file.close()
+
+				mtime = time.mktime(time.strptime(' '.join(fields[3:7]), '%b %d %H:%M:%S %Y'))
+				os.utime(path, (mtime, mtime))
+		finally:
+			listing.close()
+
+	# Only one puppy can talk to the PVR at a time
+	def lock(self):
+		self.lock_file = open(os.path.join(self.settings.root, '.fakepuppy-lock'), 'a+')
+		try:
+			fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError, error:
+			if error.errno in (errno.EAGAIN, errno.EACCES):
+				raise DeviceError("Can not obtain exclusive lock on the PVR")
+			raise
+
+		self.lock_file.truncate(0)
+		self.lock_file.write(str(os.getpid()))
+		self.lock_file.flush()
+
+	def localPath(self, path):
+		parts = [ part for part in path.split('\\') if part != '' ]
+		if '..' in parts:
+			raise DeviceError("Device reports Invalid filename")
+		return os.path.join(self.settings.root, *parts)
+
+	def maybeFail(self):
+		if self.random.random() < self.settings.fail_rate:
+			raise DeviceError("Device reports Failure")
+
+	def run(self, command, args):
+		if command == 'cancel':
+			self.cancel()
+			return
+
+		self.lock()
+		time.sleep(self.settings.latency)
+
+		commands = { 'size' : self.size, 'dir' : self.dir, 'get' : self.get,
+		             'put' : self.put, 'mkdir' : self.mkdir, 'rename' : self.rename,
+		             'delete' : self.delete, 'reboot' : self.reboot }
+		if not commands.has_key(command):
+			raise DeviceError("Unknown command " + command)
+
+		if command not in ('get', 'put'):
+			self.maybeFail()
+		commands[command](args)
+
+	def usedSpace(self):
+		used = 0
+		for dir, dirs, files in os.walk(self.settings.root):
+			for name in files:
+				used += os.path.getsize(os.path.join(dir, name))
+		return used
+
+	def printSize(self, label, bytes):
+		kib = bytes / 1024
+		print '%s %10u kiB %7u MiB %4u GiB' % (label, kib % 1024, kib / 1024 % 1024, kib / 1024 / 1024)
+
+	def size(self, args):
+		total = self.settings.disk_size * 1024 ** 3
+		self.printSize('Total', total)
+		self.printSize('Free ', max(total - self.usedSpace(), 0))
+
+	def dir(self, args):
+		path = '\\'
+		if len(args) > 0:
+			path = args[0]
+
+		dir = self.localPath(path)
+		if not os.path.isdir(dir):
+			raise DeviceError("Device reports File not found")
+
+		if dir != self.settings.root:
+			print 'd %20d %s ..' % (0, time.ctime(0))
+
+		names = os.listdir(dir)
+		names.sort()
+		for name in names:
+			if name.startswith('.fakepuppy'):
+				continue
+			stats = os.stat(os.path.join(dir, name))
+			if os.path.isdir(os.path.join(dir, name)):
+				print 'd %20d %s %s' % (0, time.ctime(stats.st_mtime), name)
+			else:
+				print 'f %20d %s %s' % (stats.st_size, time.ctime(stats.st_mtime), name)
+
+	def get(self, args):
+		if len(args) == 0:
+			raise DeviceError("get needs a source file")
+
+		src = self.localPath(args[0])
+		if len(args) > 1:
+			dst = args[1]
+		else:
+			dst = os.path.basename(src)
+		if not os.path.isfile(src):
+			raise DeviceError("Device reports File not found")
+
+		self.copy(src, dst)
+
+	def put(self, args):
+		if len(args) == 0:
+			raise DeviceError("put needs a source file")
+
+		src = args[0]
+		if len(args) > 1:
+			dst = self.localPath(args[1])
+		else:
+			dst = self.localPath(os.path.basename(src))
+		if not os.path.isfile(src):
+			raise DeviceError("Can not open source file " + src)
+		if not os.path.isdir(os.path.dirname(dst)):
+			raise DeviceError("Device reports File not found")
+
+		size = os.path.getsize(src)
+		if size > self.settings.disk_size * 1024 ** 3 - self.usedSpace():
+			raise DeviceError("Device reports Disk full")
+
+		self.copy(src, dst)
+
+	# Copy src to dst at the speed of the USB bus, printing progress records
+	# like puppy
+	def copy(self, src, dst):
+		size = os.path.getsize(src)
+		rate = self.settings.bandwidth * 1000000 / 8
+		if self.turbo:
+			rate *= self.settings.turbo
+
+		fail_at = self.settings.fail_at
+		if fail_at == None and self.random.random() < self.settings.fail_rate:
+			fail_at = self.random.uniform(0, 100)
+
+		src_file = open(src, 'rb')
+		dst_file = open(dst, 'wb')
+		try:
+			began = time.time()
+			# Moved on by stalls so the bus stays idle while stalled
+			start = began
+			last_report = began
+			done = 0
+			while done < size:
+				percent = 100.0 * done / size
+				if fail_at != None and percent >= fail_at:
+					raise DeviceError("Device reports Failure")
+
+				data = src_file.read(CHUNK_SIZE)
+				if len(data) == 0:
+					break
+				dst_file.write(data)
+				done += len(data)
+
+				# Sleep until the bus would have carried this much
+				delay = start + done / rate - time.time()
+				if delay > 0:
+					time.sleep(delay)
+
+				now = time.time()
+				if now - last_report >= self.settings.interval:
+					last_report = now
+					if self.random.random() < self.settings.stall_rate:
+						time.sleep(self.settings.stall_time)
+						start += self.settings.stall_time
+					self.progress(done, size, time.time() - began)
+		finally:
+			src_file.close()
+			dst_file.close()
+
+		self.progress(size, size, time.time() - began)
+		if not self.quiet:
+			print >> sys.stderr
+
+	def progress(self, done, size, elapsed):
+		if self.quiet:
+			return
+
+		percent = 100.0
+		if size > 0:
+			percent = 100.0 * done / size
+		mbits = 0.0
+		if elapsed > 0:
+			mbits = done * 8 / elapsed / 1000000
+		remaining = 0
+		if done > 0:
+			remaining = int(elapsed * (size - done) / done)
+		elapsed = int(elapsed)
+
+		sys.stderr.write('\r%6.2f%%, %5.2f Mbits/s, %02d:%02d:%02d elapsed, %d:%02d:%02d remaining' %
+		                 (percent, mbits, elapsed / 3600, elapsed / 60 % 60, elapsed % 60,
+		                  remaining / 3600, remaining / 60 % 60, remaining % 60))
+		sys.stderr.flush()
+
+	def mkdir(self, args):
+		if len(args) != 1:
+			raise DeviceError("mkdir needs a directory")
+
+		path = self.localPath(args[0])
+		if os.path.exists(path) or not os.path.isdir(os.path.dirname(path)):
+			raise DeviceError("Device reports Invalid filename")
+		os.mkdir(path)
+
+	def rename(self, args):
+		if len(args) != 2:
+			raise DeviceError("rename needs an old and a new name")
+
+		old_path = self.localPath(args[0])
+		new_path = self.localPath(args[1])
+		if not os.path.exists(old_path) or os.path.exists(new_path):
+			raise DeviceError("Device reports Invalid filename")
+		os.rename(old_path, new_path)
+
+	def delete(self, args):
+		if len(args) != 1:
+			raise DeviceError("delete needs a file")
+
+		path = self.localPath(args[0])
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		elif os.path.exists(path):
+			os.remove(path)
+		else:
+			raise DeviceError("Device reports File not found")
+
+	def reboot(self, args):
+		pass
+
+	# Stop the transfer another fakepuppy is doing
+	def cancel(self):
+		try:
+			pid = int(open(os.path.join(self.settings.root, '.fakepuppy-lock')).read())
+			os.kill(pid, signal.SIGTERM)
+		except (IOError, OSError, ValueError):
+			pass
+
+def main(argv):
+	args = argv[1:]
+	if os.environ.has_key('FAKEPUPPY_OPTIONS'):
+		args = os.environ['FAKEPUPPY_OPTIONS'].split() + args
+
+	try:
+		opts, args = getopt.getopt(args, 'pPtvqd:c:', SETTINGS)
+	except getopt.GetoptError, error:
+		print USAGE
+		return 1
+
+	settings = Settings()
+	command = None
+	turbo = False
+	quiet = False
+	try:
+		for opt, optarg in opts:
+			if opt == '-c':
+				command = optarg
+			elif opt == '-t':
+				turbo = True
+			elif opt == '-q':
+				quiet = True
+			elif opt == '--root':
+				settings.root = optarg
+			elif opt == '--seed':
+				settings.seed = int(optarg)
+			elif opt == '--fail-at':
+				settings.fail_at = float(optarg)
+			elif opt[2:] + '=' in SETTINGS:
+				setattr(settings, opt[2:].replace('-', '_'), float(optarg))
+	except ValueError:
+		print USAGE
+		return 1
+
+	if command == None:
+		print USAGE
+		return 1
+
+	try:
+		FakePVR(settings, turbo, quiet).run(command, args)
+	except DeviceError, error:
+		print >> sys.stderr, 'ERROR:', error.value
+		return 1
+
+	return 0
 
-DATA_DIR='/local/devel/guppy/testing/'
-
-opts, args = getopt.getopt(sys.argv[1:], 'c:t')
-
-transfer = False
-listdir = False
-
-for opt, optarg in opts:
-	if opt == '-c':
-		if optarg == 'get' or optarg == 'put':
-			transfer = True
-		if optarg == 'dir':
-			listdir = True
-		if optarg == 'cancel':
-			os.system("pkill -f 'fakepuppy.py -c get.*'")
-		if optarg == 'size':
-			size = True
-
-if transfer:
-	inc = 10
-	percent = 0.0
-	for i in xrange(100/inc):
-		percent = percent + inc
-		print >> sys.stderr, "\r%6.2f%%, %5.2f Mbits/s, %02d:%02d:%02d elapsed, %d:%02d:%02d remaining" % (percent, 2.2, 1, 1, 1, 2, 2, 2),
-		time.sleep(0.5)
-	print
-elif listdir:
-	listing = open(DATA_DIR + 'puppy-listdir.txt')
-	for line in listing:
-		print line,
-	listing.close()
-elif size:
-	print 'Total %10u kiB %7u MiB %4u GiB' % (0, 0, 120)
-	print 'Free  %10u kiB %7u MiB %4u GiB' % (0, 500, 0)
-else:
-	print opts, '|', args,
+if __name__ == "__main__":
+	sys.exit(main(sys.argv))